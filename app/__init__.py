@@ -13,6 +13,11 @@ from flask_sqlalchemy import SQLAlchemy
 from redis import Redis
 import rq
 
+from app.cache import ResponseCache, TaggedCache, TokenCache
+from app.compression import Compress
+from app.encoders import configure_json
+from app.graph import FollowGraph
+from app.hashing import PasswordHasher
 
 db = SQLAlchemy()
 migrate = Migrate()
@@ -23,7 +28,13 @@ login.login_view = 'auth.login'  # Redirect to the login view
 login.login_message = 'Please log in to access this page.'
 login.session_protection = 'strong'
 mail = Mail()
+compress = Compress()
 moment = Moment()
+token_cache = TokenCache()
+count_cache = TaggedCache('count')
+response_cache = ResponseCache()
+follow_graph = FollowGraph()
+password_hasher = PasswordHasher()
 
 app_settings = os.getenv('APP_SETTINGS') or 'config.DevelopmentConfig'
 
@@ -31,10 +42,12 @@ app_settings = os.getenv('APP_SETTINGS') or 'config.DevelopmentConfig'
 def create_app(config_class=app_settings):
     app = Flask(__name__, subdomain_matching=True)
     app.config.from_object(config_class)
+    configure_json(app)
 
     db.init_app(app)
     migrate.init_app(app, db)
     cors.init_app(app)
+    compress.init_app(app)
     #cors = CORS(app)
     #csrf.init_app(app)
     login.init_app(app)
@@ -43,6 +56,11 @@ def create_app(config_class=app_settings):
 
     app.redis = Redis.from_url(app.config['REDIS_URL'])
     app.task_queue = rq.Queue('%s-tasks' % app.config['APP_NICKNAME'], connection=app.redis)
+    token_cache.init_app(app)
+    count_cache.init_app(app)
+    response_cache.init_app(app)
+    follow_graph.init_app(app)
+    password_hasher.init_app(app)
 
     from app.api.v1 import bp as api_v1_bp    # NOQA
     app.register_blueprint(api_v1_bp, subdomain='api', url_prefix='/v1')
@@ -86,14 +104,21 @@ def create_test_app(config_class=app_settings):
     """Use only for unittests"""
     app = Flask(__name__)
     app.config.from_object(config_class)
+    configure_json(app)
 
     db.init_app(app)
     migrate.init_app(app, db)
     cors.init_app(app)
+    compress.init_app(app)
     moment.init_app(app)
 
     app.redis = Redis.from_url(app.config['REDIS_URL'])
     app.task_queue = rq.Queue('%s-tasks' % app.config['APP_NICKNAME'], connection=app.redis)
+    token_cache.init_app(app)
+    count_cache.init_app(app)
+    response_cache.init_app(app)
+    follow_graph.init_app(app)
+    password_hasher.init_app(app)
 
     from app.api.v1 import bp as api_v1_bp    # NOQA
     app.register_blueprint(api_v1_bp, url_prefix='/v1')
@@ -1,4 +1,4 @@
-from flask import g
+from flask import current_app, g
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
 from app.models import User
 from app.api.v1.errors import error_response
@@ -28,7 +28,15 @@ def basic_auth_error():
 @token_auth.verify_token
 def verify_token(token):
     """Return True if the provided token belongs to an existing user"""
-    g.current_user = User.check_token(token) if token else None
+    g.current_user = None
+    if not token:
+        return False
+    if current_app.config['TOKEN_MODE'] == 'jwt':
+        g.token_claims = User.decode_access_token(token)
+        if g.token_claims is not None:
+            g.current_user = User.check_access_token(g.token_claims)
+    else:
+        g.current_user = User.check_token(token)
     return g.current_user is not None
 
 
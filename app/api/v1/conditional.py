@@ -0,0 +1,82 @@
+from datetime import timezone
+import hashlib
+from io import BytesIO
+
+from flask import current_app, jsonify, request
+from werkzeug.wsgi import wrap_file
+
+
+def _http_time(value):
+    """Return the naive UTC datetime as an aware datetime with the whole
+    second precision of HTTP dates"""
+    return value.replace(microsecond=0, tzinfo=timezone.utc)
+
+
+def not_modified(etag, last_modified=None):
+    """Return whether the request's If-None-Match, or If-Modified-Since if
+    there is no If-None-Match, shows the client has this version already"""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def resource_response(item, build, *variant):
+    """Return the response of a single item with a weak ETag and a
+    Last-Modified header taken from its timestamps. If the client has this
+    version already, a 304 is returned without calling build, so the item is
+    never serialized.
+
+    :param item: Model instance using the TimestampMixin
+    :param build: Function returning the full response
+    :param variant: Anything else the representation depends on
+    """
+    etag = item.etag(*variant)
+    last_modified = _http_time(item.last_modified)
+    if not_modified(etag, last_modified):
+        response = current_app.response_class(status=304)
+    else:
+        response = build()
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    return response
+
+
+def ranged_response(item, load, mimetype, *variant):
+    """Return a raw body of an item that supports byte Range requests, with
+    a strong ETag for If-Range and a Last-Modified header taken from its
+    timestamps. The body is sent in blocks, with the Content-Length of the
+    range. If the client has this version already, a 304 is returned without
+    calling load.
+
+    :param item: Model instance using the TimestampMixin
+    :param load: Function returning the body as bytes
+    :param mimetype: String of the body's mimetype
+    :param variant: Anything else the body depends on
+    """
+    etag = item.etag(*variant)
+    last_modified = _http_time(item.last_modified)
+    if not_modified(etag, last_modified):
+        response = current_app.response_class(status=304)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        return response
+    body = load()
+    response = current_app.response_class(
+            wrap_file(request.environ, BytesIO(body)), mimetype=mimetype,
+            direct_passthrough=True)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.accept_ranges = 'bytes'    # Also advertised on full responses
+    response.content_length = len(body)     # Replaced by the range's length
+    return response.make_conditional(request, accept_ranges=True,
+            complete_length=len(body))
+
+
+def collection_response(data):
+    """Return the JSON response of a collection with a strong ETag hashed
+    from its body, answering a matching If-None-Match with a 304"""
+    response = jsonify(data)
+    response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+    return response.make_conditional(request)
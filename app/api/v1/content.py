@@ -1,31 +1,217 @@
+from math import ceil
+
 from flask import abort, g, jsonify, request, url_for
 from sqlalchemy import exc
+from sqlalchemy.orm import defer, joinedload, load_only, selectinload
 
-from app import db
+from app import db, response_cache
 from app.api.v1 import bp
 from app.api.v1.auth import token_auth
-from app.models import Content
+from app.api.v1.conditional import collection_response, ranged_response, \
+        resource_response
+from app.api.v1.errors import bad_request, error_response, \
+        violated_constraint
+from app.api.v1.pagination import arg_flag, collection_dict, datetime_arg, \
+        fields_arg, per_page_arg
+from app.counts import count_query
+from app.models import Content, ContentRevision, Tag, User
+
+
+# The unique constraint numbering the revisions of a content, by the name
+# the database reports it with: Postgres names it after the table and
+# columns, SQLite reports the columns
+_REVISION_CONSTRAINTS = ('content_revision_content_id_revision_key',
+        'content_revision.content_id, content_revision.revision')
+
+
+def _item_options(query, text=False):
+    """Add the loader options of content items to the query. The authors'
+    usernames are loaded in the same query with a join, and the text is only
+    loaded if it's included in the items. The tags of all the items are
+    loaded with one more query."""
+    fields = fields_arg(Content)
+    if fields is None or 'username' in fields:
+        query = query.options(joinedload(Content.user).load_only(User.username))
+    if fields is None or 'tags' in fields:
+        query = query.options(selectinload(Content.tags))
+    if fields is None and not text:
+        query = query.options(defer(Content.text))
+    return query
 
 
 @bp.route('/content', methods=['GET'])
+@response_cache.cached(tags=lambda: ('content',))
 def get_all_content():
-    """Retrieve all content."""
+    """Retrieve all content.
+
+    Filter with ?author= (a username), ?created_after= and ?created_before=
+    (ISO 8601 times), ?comments=true or false, and ?tags= (comma separated
+    tag names, all of which must match unless ?match=any). Sort with ?sort=
+    created (the default), -created, title or -title. The text is only
+    included with ?text=true or when it's listed in ?fields=, and otherwise
+    isn't loaded at all.
+    """
+    sort = request.args.get('sort', 'created')
+    if sort not in Content.listing_sorts:
+        return bad_request('sort must be one of %s' %
+                ', '.join(Content.listing_sorts))
+    comments = None
+    if request.args.get('comments') is not None:
+        comments = arg_flag('comments')
+    match = request.args.get('match', 'all')
+    if match not in ('all', 'any'):
+        return bad_request('match must be all or any')
+    try:
+        tags = Tag.normalize(request.args['tags'].split(',')) \
+                if 'tags' in request.args else None
+    except ValueError as e:
+        return bad_request(str(e))
+    query, sort_key, descending = Content.listing(
+            author=request.args.get('author'),
+            created_after=datetime_arg('created_after'),
+            created_before=datetime_arg('created_before'),
+            comments=comments, tags=tags, match=match, sort=sort)
+    # Keep the filters and sort in the pagination links
+    kwargs = {name: request.args[name] for name in ('author',
+        'created_after', 'created_before', 'comments', 'tags', 'match',
+        'sort') if name in request.args}
+    text = arg_flag('text')
+    if text:
+        kwargs['text'] = 'true'
+    data = collection_dict(Content, _item_options(query, text),
+            'api.v1.get_all_content',
+            per_page=30, sort_key=sort_key, descending=descending,
+            to_dict=lambda item, fields: item.to_dict(text=text,
+                fields=fields), **kwargs)
+    return collection_response(data)
+
+
+@bp.route('/content/search', methods=['GET'])
+@response_cache.cached(tags=lambda: ('content',))
+def search_content():
+    """Search the title and text of content for all the words in ?q=. The
+    results are ranked best match first, and include a snippet of the text
+    with the matching words in <mark> tags."""
+    terms = request.args.get('q', '').strip()
+    if not terms:
+        return bad_request('must include a q argument to search for')
     page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 30, type=int), 100)
-    text = request.args.get('text', False, type=bool)
-    data = Content.content_to_collection_dict(
-            Content.query \
-                .filter(Content.status) \
-                .order_by(Content.phase.asc(), Content.section.asc()),
-            page, per_page, 'api.v1.get_all_content', text=text)
-    return jsonify(data)
+    per_page = per_page_arg()
+    fields = fields_arg(Content)
+    kwargs = {'q': terms}
+    matches = Content.search(terms)
+    query = _item_options(matches)
+    if fields is not None:
+        query = query.options(Content.load_fields(fields))
+        kwargs['fields'] = request.args['fields']
+
+    def to_dict(row):
+        data = row.Content.to_dict(fields=fields)
+        data['rank'] = row.rank
+        data['snippet'] = row.snippet
+        return data
+    data = Content.to_collection_dict(query, page, per_page,
+            'api.v1.search_content', total=False, to_dict=to_dict, **kwargs)
+    if arg_flag('count', True):
+        # Count the matches without ranking them or building snippets
+        total, estimated = count_query(matches.with_entities(Content.id))
+        data['_meta'].update(total_items=total,
+                total_pages=ceil(total / per_page), total_estimated=estimated)
+    return collection_response(data)
 
 
 @bp.route('/content/<public_id>', methods=['GET'])
+@response_cache.cached(tags=lambda public_id: ('content:%s' % public_id,))
 def get_content(public_id):
-    """Retrieve a specified content."""
-    query_results = Content.query.filter_by(public_id=public_id).first_or_404()
-    return jsonify(query_results.to_dict(true=True))
+    """Retrieve a specified content. Use ?fields= to only retrieve some of
+    the fields. Supports conditional requests with If-None-Match and
+    If-Modified-Since."""
+    fields = fields_arg(Content)
+    query = _item_options(Content.query, text=True)
+    if fields is not None:
+        query = query.options(Content.load_fields(fields, Content.created,
+            Content.updated))
+    content = query.filter_by(public_id=public_id).first_or_404()
+    return resource_response(content, lambda: jsonify(content.to_dict(
+        text=True, fields=fields)), request.args.get('fields'))
+
+
+@bp.route('/content/<public_id>/text', methods=['GET'])
+def get_content_text(public_id):
+    """Retrieve the text of a content as a plain UTF-8 body. Supports byte
+    Range requests, so clients can fetch only the start of a long text or
+    resume a download, and conditional requests. The text isn't loaded if
+    the client has it already."""
+    content = Content.query.options(load_only(Content.id, Content.created,
+        Content.updated)).filter_by(public_id=public_id).first_or_404()
+    return ranged_response(content,
+            lambda: (content.text or '').encode('utf-8'),
+            'text/plain', 'text')
+
+
+@bp.route('/content/<public_id>/history', methods=['GET'])
+@response_cache.cached(tags=lambda public_id: ('content:%s' % public_id,))
+def get_content_history(public_id):
+    """Retrieve the revisions of a content, newest first, without their
+    text."""
+    content = Content.query.options(load_only(Content.id)) \
+            .filter_by(public_id=public_id).first_or_404()
+    page = request.args.get('page', 1, type=int)
+    per_page = per_page_arg()
+    query = ContentRevision.query.filter_by(content_id=content.id) \
+            .order_by(ContentRevision.revision.desc())
+
+    def to_dict(revision):
+        data = revision.to_dict()
+        data['_links'] = {'self': url_for('api.v1.get_content_revision',
+            public_id=public_id, revision=revision.revision)}
+        return data
+    data = ContentRevision.to_collection_dict(query, page, per_page,
+            'api.v1.get_content_history', to_dict=to_dict,
+            public_id=public_id)
+    return collection_response(data)
+
+
+@bp.route('/content/<public_id>/history/<int:revision>', methods=['GET'])
+@response_cache.cached(tags=lambda public_id, revision:
+        ('content:%s' % public_id,))
+def get_content_revision(public_id, revision):
+    """Retrieve the title and text of a content as of a revision."""
+    content = Content.query.options(load_only(Content.id)) \
+            .filter_by(public_id=public_id).first_or_404()
+    item, text = ContentRevision.text_of(content.id, revision)
+    if item is None:
+        abort(404)
+    data = item.to_dict(text=text)
+    data['_links'] = {
+        'self': url_for('api.v1.get_content_revision', public_id=public_id,
+            revision=revision),
+        'history': url_for('api.v1.get_content_history', public_id=public_id),
+        'content': url_for('api.v1.get_content', public_id=public_id),
+    }
+    return jsonify(data)
+
+
+def _tags_arg(data):
+    """Return the normalized tag names in the request data, or None if it
+    has none. Aborts with a 400 error if they aren't a list of strings."""
+    if 'tags' not in data:
+        return None
+    tags = data['tags']
+    if not isinstance(tags, list) or \
+            not all(isinstance(tag, str) for tag in tags):
+        abort(bad_request('tags must be a list of strings'))
+    try:
+        return Tag.normalize(tags)
+    except ValueError as e:
+        abort(bad_request(str(e)))
+
+
+def _check_text(data):
+    """Abort with a 400 error if the request data has a text that isn't a
+    string, as it can't be stored compressed"""
+    if data.get('text') is not None and not isinstance(data['text'], str):
+        abort(bad_request('text must be a string'))
 
 
 @bp.route('/content', methods=['POST'])
@@ -35,12 +221,18 @@ def create_content():
     if g.current_user.group not in ['admin']:
         abort(403)
     data = request.get_json() or {}
+    data.setdefault('user_id', g.current_user.id)
+    tags = _tags_arg(data)
+    _check_text(data)
 
     # Add the content section
     content = Content()
     content.from_dict(data, new=True)
     try:
         db.session.add(content)
+        if tags:
+            db.session.flush()
+            content.set_tags(tags)
         db.session.commit()
     except exc.IntegrityError:
         db.session().rollback()
@@ -59,20 +251,37 @@ def update_content(public_id):
     """Update an existing content section"""
     if g.current_user.group not in ['admin']:
         abort(403)
-    content = Content.query.filter_by(public_id=public_id).first_or_404()
+    # Lock the row until the commit, so concurrent edits number their
+    # revisions one after the other
+    content = Content.query.filter_by(public_id=public_id) \
+            .with_for_update().first_or_404()
     data = request.get_json() or {}
+    tags = _tags_arg(data)
+    _check_text(data)
 
     # Update the main content data
     content.from_dict(data, new=False)
+    if tags is not None:
+        content.set_tags(tags)
 
-    db.session.commit()
+    try:
+        db.session.commit()
+    except exc.IntegrityError as e:
+        db.session.rollback()
+        constraint = violated_constraint(e)
+        if any(name in constraint for name in _REVISION_CONSTRAINTS):
+            # A database without row locks let another edit take the
+            # revision
+            return error_response(409, 'the content was changed by another '
+                    'request, try again')
+        return bad_request('invalid content data')
     return jsonify(content.to_dict())
 
 
 @bp.route('/content/<public_id>', methods=['DELETE'])
 @token_auth.login_required
 def delete_content(public_id):
-    """Delete an existing content section. Does NOT retain history."""
+    """Delete an existing content section, along with its history."""
     if g.current_user.group != 'admin':
         abort(403)
     content = Content.query.filter_by(public_id=public_id).first_or_404()
@@ -1,6 +1,9 @@
 from flask import jsonify
 from werkzeug.http import HTTP_STATUS_CODES
 
+from app.api.v1 import bp
+from app.hashing import PasswordHasherBusy
+
 
 def error_response(status_code, message=None):
     """Return a JSON object of the HTTP status code and optional message"""
@@ -14,3 +17,18 @@ def error_response(status_code, message=None):
 
 def bad_request(message):
     return error_response(400, message)
+
+
+def violated_constraint(error):
+    """Return the constraint name of the IntegrityError, or its message if
+    the driver doesn't report the name"""
+    diag = getattr(error.orig, 'diag', None)
+    return getattr(diag, 'constraint_name', None) or str(error.orig)
+
+
+@bp.app_errorhandler(PasswordHasherBusy)
+def password_hasher_busy(e):
+    """Shed login load quickly when the password hashing queue is full"""
+    response = error_response(503, 'too many login attempts, try again soon')
+    response.headers['Retry-After'] = 1
+    return response
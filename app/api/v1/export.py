@@ -0,0 +1,78 @@
+from flask import abort, current_app, g, json, stream_with_context
+
+from app import db
+from app.api.v1 import bp
+from app.api.v1.auth import token_auth
+from app.api.v1.pagination import datetime_arg
+from app.models import Content, followers, User
+
+
+def _modified_since(model, query):
+    """Filter the query to the rows created or updated since ?since="""
+    since = datetime_arg('since')
+    if since is None:
+        return query
+    return query.filter(db.func.coalesce(model.updated, model.created) >=
+            since)
+
+
+def ndjson_response(query):
+    """Stream the rows of the query as newline delimited JSON objects. Rows
+    are fetched in batches from a server side cursor and sent as they are
+    read, so memory use doesn't grow with the size of the table."""
+    batch_size = current_app.config['EXPORT_BATCH_SIZE']
+
+    def generate():
+        lines = []
+        for row in query.yield_per(batch_size):
+            lines.append(json.dumps(row._asdict()))
+            if len(lines) == batch_size:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+        if lines:
+            yield '\n'.join(lines) + '\n'
+    return current_app.response_class(stream_with_context(generate()),
+            mimetype='application/x-ndjson')
+
+
+@bp.route('/users/export', methods=['GET'])
+@token_auth.login_required
+def export_users():
+    """Stream every user as NDJSON, ordered by id. Use ?since= to only export
+    the users created or updated since an ISO 8601 time. Admins only."""
+    if g.current_user.group != 'admin':
+        abort(403)
+    query = db.session.query(User.id, User.public_id, User.username,
+            User.email, User.group, User.name, User.about_me, User.privacy,
+            User.follower_count, User.followed_count, User.last_seen,
+            User.created, User.updated)
+    return ndjson_response(_modified_since(User, query).order_by(User.id))
+
+
+@bp.route('/followers/export', methods=['GET'])
+@token_auth.login_required
+def export_followers():
+    """Stream every follow as NDJSON follower_id and followed_id pairs of
+    user ids. Admins only."""
+    if g.current_user.group != 'admin':
+        abort(403)
+    query = db.session.query(followers.c.follower_id,
+            followers.c.followed_id).order_by(followers.c.follower_id,
+                followers.c.followed_id)
+    return ndjson_response(query)
+
+
+@bp.route('/content/export', methods=['GET'])
+@token_auth.login_required
+def export_content():
+    """Stream all content, including its text, as NDJSON ordered by id. Use
+    ?since= to only export the content created or updated since an ISO 8601
+    time. Admins only."""
+    if g.current_user.group != 'admin':
+        abort(403)
+    query = db.session.query(Content.id, Content.public_id, Content.title,
+            Content.text, Content.comments, Content.user_id,
+            User.username, Content.created, Content.updated) \
+            .join(User, Content.user_id == User.id)
+    return ndjson_response(_modified_since(Content, query)
+            .order_by(Content.id))
@@ -0,0 +1,19 @@
+from flask import abort, g, jsonify
+
+from app import password_hasher, response_cache, token_cache
+from app.api.v1 import bp
+from app.api.v1.auth import token_auth
+
+
+@bp.route('/metrics', methods=['GET'])
+@token_auth.login_required
+def get_metrics():
+    """Retrieve the cache and password hashing counters of the worker serving
+    the request. Only available to admins."""
+    if g.current_user.group != 'admin':
+        abort(403)
+    return jsonify({
+        'token_cache': token_cache.stats(),
+        'response_cache': response_cache.stats(),
+        'password_hasher': password_hasher.stats(),
+    })
@@ -0,0 +1,28 @@
+from flask import g, jsonify, request, url_for
+
+from app.api.v1 import bp
+from app.api.v1.auth import token_auth
+from app.models import Notification
+
+
+@bp.route('/notifications', methods=['GET'])
+@token_auth.login_required
+def get_notifications():
+    """Retrieve the current user's notifications added or updated after the
+    ?since= timestamp, oldest first. Poll the next link to only get the newer
+    ones. There is at most one notification per name, so the list stays
+    short. A notification whose transaction commits after a newer one was
+    polled has an older timestamp and is skipped; see
+    User.add_notification."""
+    since = request.args.get('since', 0.0, type=float)
+    notifications = g.current_user.notifications \
+            .filter(Notification.timestamp > since) \
+            .order_by(Notification.timestamp.asc()).all()
+    if notifications:
+        since = notifications[-1].timestamp
+    return jsonify({
+        'items': [n.to_dict() for n in notifications],
+        '_links': {
+            'next': url_for('api.v1.get_notifications', since=since),
+        },
+    })
@@ -0,0 +1,93 @@
+from datetime import datetime, timezone
+
+from flask import abort, request
+
+from app.api.v1.errors import bad_request
+
+
+def arg_flag(name, default=False):
+    """Return a boolean query string argument. Unlike type=bool, 'false' and
+    '0' are False."""
+    value = request.args.get(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def per_page_arg(default=10):
+    """Return the ?per_page= argument, limited to 1 to 100 items"""
+    return max(min(request.args.get('per_page', default, type=int), 100), 1)
+
+
+def datetime_arg(name):
+    """Return an ISO 8601 time query string argument as a naive UTC
+    datetime, or None if it's missing. Aborts with a 400 response if it isn't
+    a valid time."""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        abort(bad_request('%s must be an ISO 8601 time' % name))
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def fields_arg(model):
+    """Return the set of fields listed in the comma separated ?fields=
+    argument, or None if every field should be included. Aborts with a 400
+    response if a field isn't one of the model's api_fields."""
+    value = request.args.get('fields')
+    if value is None:
+        return None
+    fields = {field.strip() for field in value.split(',') if field.strip()}
+    unknown = fields - model.api_fields.keys()
+    if unknown:
+        abort(bad_request('unknown fields: %s' % ', '.join(sorted(unknown))))
+    return fields
+
+
+def collection_dict(model, query, endpoint, per_page=10, sort_key=None,
+        to_dict=None, descending=False, **kwargs):
+    """Return the collection dictionary of the query for the request.
+
+    Clients use page numbers (?page=) by default. Passing ?pagination=cursor,
+    ?after= or ?before= switches to keyset pagination over the sort key, which
+    defaults to the model's (created, id) index; ?total=true adds the total
+    item count to the keyset page. Page number clients that don't need the
+    totals can skip counting with ?count=false. With ?fields= only the listed
+    fields are serialized and only their columns are loaded.
+
+    :param to_dict: Optional function of an item and the set of requested
+        fields (None for all of them) that serializes the item
+    :param descending: True if the sort key is in descending order
+    """
+    per_page = per_page_arg(per_page)
+    sort_key = sort_key or (model.created, model.id)
+    fields = fields_arg(model)
+    if fields is not None:
+        query = query.options(model.load_fields(fields, *sort_key))
+        kwargs['fields'] = request.args['fields']
+    to_dict = to_dict or (lambda item, fields: item.to_dict(fields=fields))
+
+    def serialize(item):
+        return to_dict(item, fields)
+
+    after = request.args.get('after')
+    before = request.args.get('before')
+    if after or before or request.args.get('pagination') == 'cursor':
+        try:
+            return model.to_cursor_collection_dict(query, per_page, endpoint,
+                    sort_key, after=after, before=before,
+                    total=arg_flag('total'), to_dict=serialize,
+                    descending=descending, pagination='cursor', **kwargs)
+        except ValueError:
+            abort(bad_request('invalid pagination cursor'))
+    page = request.args.get('page', 1, type=int)
+    total = arg_flag('count', True)
+    if not total:
+        kwargs['count'] = 'false'
+    return model.to_collection_dict(query, page, per_page, endpoint,
+            total=total, to_dict=serialize, **kwargs)
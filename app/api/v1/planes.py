@@ -1,6 +1,7 @@
 from flask import abort, jsonify
 
 from app.api.v1 import bp
+from app.compression import StaticPayload
 
 """Example file showing how to create API routes for data"""
 
@@ -22,16 +23,21 @@ data = {
         'type': 'long haul', 'uses': ['passenger', 'cargo']},
 }
 
+# The planes never change, so serialize and compress them only once
+catalog = StaticPayload(lambda: jsonify(data).get_data())
+plane_payloads = {model: StaticPayload(lambda model=model:
+    jsonify(data[model]).get_data()) for model in data}
+
 
 @bp.route('/planes', methods=['GET'])
 def get_planes():
     """Retrieve a JSON list of many planes."""
-    return jsonify(data)
+    return catalog.response()
 
 
 @bp.route('/planes/<model>', methods=['GET'])
 def get_plane(model):
     if data.get(model):
-        return jsonify(data[model])
+        return plane_payloads[model].response()
     else:
         abort(404)
@@ -0,0 +1,17 @@
+from flask import jsonify, request
+
+from app import response_cache
+from app.api.v1 import bp
+from app.models import Tag
+
+
+@bp.route('/tags', methods=['GET'])
+@response_cache.cached(tags=lambda: ('content',))
+def get_tags():
+    """Retrieve the tag cloud: the most used tags and the number of content
+    items carrying each, most used first. Use ?limit= to change the number
+    of tags (50 by default, 1 to 500). Served from the maintained counts alone."""
+    limit = max(min(request.args.get('limit', 50, type=int), 500), 1)
+    tags = Tag.query.filter(Tag.content_count > 0) \
+            .order_by(Tag.content_count.desc(), Tag.name).limit(limit)
+    return jsonify({'items': [tag.to_dict() for tag in tags]})
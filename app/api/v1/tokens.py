@@ -1,8 +1,10 @@
-from flask import g, jsonify
+from flask import abort, current_app, g, jsonify, request
 
 from app import db
 from app.api.v1 import bp
 from app.api.v1.auth import basic_auth, token_auth
+from app.api.v1.errors import error_response
+from app.models import User
 
 
 @bp.route('/tokens', methods=['GET'])
@@ -21,20 +23,50 @@ def get_token():
     """Generate a token for the user, but only after ensuring they have
     authenticated themselves via the basic auth login (providing a valid
     username and password).
+
+    In jwt token mode the token is a short lived access token, and the
+    refresh_token can be exchanged for new access tokens at /tokens/refresh.
     """
-    token = g.current_user.get_token(expires_in=60*60*24*7)
-    db.session.commit()
-    return jsonify({
+    data = {
         'public_id': g.current_user.public_id,
         'username': g.current_user.username,
         'group': g.current_user.group,
-        'token': token
+    }
+    if current_app.config['TOKEN_MODE'] == 'jwt':
+        data['refresh_token'] = g.current_user.get_token(
+                expires_in=current_app.config['REFRESH_TOKEN_EXPIRES'])
+        expires_in = current_app.config['ACCESS_TOKEN_EXPIRES']
+        data['token'] = g.current_user.get_access_token(expires_in=expires_in)
+        data['expires_in'] = expires_in
+    else:
+        data['token'] = g.current_user.get_token(expires_in=60*60*24*7)
+    db.session.commit()
+    return jsonify(data)
+
+
+@bp.route('/tokens/refresh', methods=['POST'])
+def refresh_token():
+    """Exchange a refresh token for a new access token. Only available in jwt
+    token mode."""
+    if current_app.config['TOKEN_MODE'] != 'jwt':
+        abort(404)
+    data = request.get_json() or {}
+    user = User.check_token(data['refresh_token']) \
+            if data.get('refresh_token') else None
+    if user is None:
+        return error_response(401)
+    expires_in = current_app.config['ACCESS_TOKEN_EXPIRES']
+    return jsonify({
+        'token': user.get_access_token(expires_in=expires_in),
+        'expires_in': expires_in,
     })
 
 
 @bp.route('/tokens', methods=['DELETE'])
 @token_auth.login_required
 def revoke_token():
+    if current_app.config['TOKEN_MODE'] == 'jwt':
+        User.revoke_access_token(g.token_claims)
     g.current_user.revoke_token()
     db.session.commit()
     return '', 204
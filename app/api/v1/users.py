@@ -1,9 +1,15 @@
+from math import ceil
+
 from flask import abort, current_app, g, jsonify, request, url_for
+from sqlalchemy import exc
 
-from app import db
+from app import db, follow_graph
 from app.api.v1 import bp
 from app.api.v1.auth import token_auth
-from app.api.v1.errors import bad_request
+from app.api.v1.conditional import collection_response, resource_response
+from app.api.v1.errors import bad_request, violated_constraint
+from app.api.v1.pagination import collection_dict, fields_arg, \
+        per_page_arg
 from app.models import User
 
 
@@ -13,24 +19,30 @@ def get_users():
     """Retrieve a JSON list of all users who's account isn't private."""
     if g.current_user.username == 'guest':
         abort(403)
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(User.query, page, per_page,
-            'api.v1.get_users')
-    return jsonify(data)
+    data = collection_dict(User, User.query, 'api.v1.get_users')
+    return collection_response(data)
 
 
 @bp.route('/users/<public_id>', methods=['GET'])
 @token_auth.login_required
 def get_user(public_id):
     """Retrieve a user's profile. If it's the user's own profile, inlcude
-    their email."""
+    their email. Use ?fields= to only retrieve some of the fields. Supports
+    conditional requests with If-None-Match and If-Modified-Since."""
     if g.current_user.username == 'guest':
         abort(403)
-    query_results = User.query.filter_by(public_id=public_id).first()
-    if g.current_user.public_id == public_id:
-        return jsonify(query_results.to_dict(include_email=True))
-    return jsonify(query_results.to_dict())
+    fields = fields_arg(User)
+    # The current user may be in the session already, built from the token
+    # cache; refresh it from the row
+    query = User.query.populate_existing()
+    if fields is not None:
+        query = query.options(User.load_fields(fields, User.created,
+            User.updated))
+    user = query.filter_by(public_id=public_id).first_or_404()
+    include_email = g.current_user.public_id == public_id
+    return resource_response(user, lambda: jsonify(user.to_dict(
+        include_email=include_email, fields=fields)), include_email,
+        request.args.get('fields'))
 
 
 @bp.route('/users/<public_id>/follow', methods=['POST'])
@@ -40,6 +52,7 @@ def follow_user(public_id):
         abort(403)
     follow_user = User.query.filter_by(public_id=public_id).first()
     g.current_user.follow(follow_user)
+    db.session.commit()
     #query_results = User.query.filter_by(public_id=public_id).first()
     #return jsonify(query_results.to_dict())
     return '', 200
@@ -56,17 +69,66 @@ def unfollow_user(public_id):
     return '', 204
 
 
+def _bulk_follow_targets():
+    """Return the users listed in the request's public_ids, and the list of
+    public ids that don't exist. Returns a 400 response instead if the list
+    is missing, too long, or holds anything but strings."""
+    data = request.get_json()
+    public_ids = data.get('public_ids') if isinstance(data, dict) else None
+    if not isinstance(public_ids, list) or not public_ids or \
+            len(public_ids) > 100 or \
+            not all(isinstance(p, str) for p in public_ids):
+        return None, bad_request('must include a list of 1 to 100 public_ids')
+    users = User.query.filter(User.public_id.in_(set(public_ids))).all()
+    found = {user.public_id for user in users}
+    return users, [p for p in public_ids if p not in found]
+
+
+@bp.route('/users/follow', methods=['POST'])
+@token_auth.login_required
+def follow_users():
+    """Follow every user in the public_ids list in one transaction. Users
+    already followed are skipped."""
+    if g.current_user.username == 'guest':
+        abort(403)
+    users, unknown = _bulk_follow_targets()
+    if users is None:
+        return unknown
+    followed = g.current_user.follow_many(users)
+    db.session.commit()
+    return jsonify({
+        'followed': [user.public_id for user in followed],
+        'unknown': unknown,
+    })
+
+
+@bp.route('/users/unfollow', methods=['POST'])
+@token_auth.login_required
+def unfollow_users():
+    """Unfollow every user in the public_ids list in one transaction. Users
+    not followed are skipped."""
+    if g.current_user.username == 'guest':
+        abort(403)
+    users, unknown = _bulk_follow_targets()
+    if users is None:
+        return unknown
+    unfollowed = g.current_user.unfollow_many(users)
+    db.session.commit()
+    return jsonify({
+        'unfollowed': [user.public_id for user in unfollowed],
+        'unknown': unknown,
+    })
+
+
 @bp.route('/users/<public_id>/followers', methods=['GET'])
 @token_auth.login_required
 def get_followers(public_id):
     if g.current_user.username == 'guest':
         abort(403)
     user = User.query.filter_by(public_id=public_id).first()
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(user.followers, page, per_page,
-            'api.v1.get_followers', public_id=public_id)
-    return jsonify(data)
+    data = collection_dict(User, user.followers, 'api.v1.get_followers',
+            public_id=public_id)
+    return collection_response(data)
 
 
 @bp.route('/users/<public_id>/followed', methods=['GET'])
@@ -75,11 +137,159 @@ def get_followed(public_id):
     if g.current_user.username == 'guest':
         abort(403)
     user = User.query.filter_by(public_id=public_id).first()
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(user.followed, page, per_page,
-            'api.v1.get_followed', public_id=public_id)
-    return jsonify(data)
+    data = collection_dict(User, user.followed, 'api.v1.get_followed',
+            public_id=public_id)
+    return collection_response(data)
+
+
+def _id_collection_dict(user_ids, endpoint, **kwargs):
+    """Return a page of the users with the given ids, ordered by id, in the
+    collection dictionary format."""
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = per_page_arg()
+    fields = fields_arg(User)
+    if fields is not None:
+        kwargs['fields'] = request.args['fields']
+    user_ids = sorted(user_ids)
+    page_ids = user_ids[(page - 1) * per_page:page * per_page]
+    users = []
+    if page_ids:
+        users = User.query.filter(User.id.in_(page_ids)).order_by(User.id)
+        if fields is not None:
+            users = users.options(User.load_fields(fields))
+    return {
+        'items': [user.to_dict(fields=fields) for user in users],
+        '_meta': {
+            'page': page,
+            'per_page': per_page,
+            'total_pages': ceil(len(user_ids) / per_page),
+            'total_items': len(user_ids),
+        },
+        '_links': User.page_links(page, per_page, endpoint,
+            page * per_page < len(user_ids), **kwargs),
+    }
+
+
+def _public_ids_arg():
+    """Return the users listed in the comma separated public_ids argument"""
+    public_ids = [p for p in request.args.get('public_ids', '').split(',')
+            if p][:100]
+    return User.query.filter(User.public_id.in_(public_ids)).all() \
+            if public_ids else []
+
+
+@bp.route('/users/<public_id>/mutuals', methods=['GET'])
+@token_auth.login_required
+def get_mutuals(public_id):
+    """Retrieve the users that both follow and are followed by the user"""
+    if g.current_user.username == 'guest':
+        abort(403)
+    user = User.query.filter_by(public_id=public_id).first_or_404()
+    user_ids = follow_graph.intersection(('followers', user.id),
+            ('followed', user.id))
+    return collection_response(_id_collection_dict(user_ids,
+            'api.v1.get_mutuals', public_id=public_id))
+
+
+@bp.route('/users/<public_id>/known_followers', methods=['GET'])
+@token_auth.login_required
+def get_known_followers(public_id):
+    """Retrieve the followers of the user that the current user follows"""
+    if g.current_user.username == 'guest':
+        abort(403)
+    user = User.query.filter_by(public_id=public_id).first_or_404()
+    user_ids = follow_graph.intersection(('followers', user.id),
+            ('followed', g.current_user.id))
+    return collection_response(_id_collection_dict(user_ids,
+            'api.v1.get_known_followers', public_id=public_id))
+
+
+@bp.route('/users/common', methods=['GET'])
+@token_auth.login_required
+def get_common_follows():
+    """Retrieve the users followed by (relation=followed, the default) or
+    following (relation=followers) every user in the comma separated
+    public_ids argument."""
+    if g.current_user.username == 'guest':
+        abort(403)
+    relation = request.args.get('relation', 'followed')
+    if relation not in follow_graph.RELATIONS:
+        return bad_request('relation must be followed or followers')
+    users = _public_ids_arg()
+    if not users:
+        return bad_request('must include a list of public_ids')
+    user_ids = follow_graph.intersection(*[(relation, user.id)
+        for user in users])
+    return collection_response(_id_collection_dict(user_ids,
+            'api.v1.get_common_follows', relation=relation,
+            public_ids=request.args['public_ids']))
+
+
+@bp.route('/users/<public_id>/following', methods=['GET'])
+@token_auth.login_required
+def get_is_following(public_id):
+    """Check which of the users in the comma separated public_ids argument
+    the user follows. Unknown public ids are left out."""
+    if g.current_user.username == 'guest':
+        abort(403)
+    user = User.query.filter_by(public_id=public_id).first_or_404()
+    users = _public_ids_arg()
+    following = follow_graph.contains('followed', user.id,
+            [other.id for other in users])
+    return jsonify({other.public_id: bool(following[other.id])
+        for other in users})
+
+
+def _taken_error(username=None, email=None, user=None):
+    """Check the username against the blocked usernames, then check in a
+    single query that neither the username nor the email is used by another
+    user. Returns a 400 response, or None if both are available."""
+    if username is not None and \
+            username in current_app.config['BLOCKED_USERNAMES']:
+        return bad_request('please use a different username')
+    conditions = []
+    if username is not None:
+        conditions.append(User.username == username)
+    if email is not None:
+        conditions.append(User.email == email)
+    if not conditions:
+        return None
+    query = User.query.with_entities(User.username, User.email) \
+            .filter(db.or_(*conditions))
+    if user is not None:
+        query = query.filter(User.id != user.id)
+    taken = query.limit(2).all()
+    if any(row.username == username for row in taken):
+        return bad_request('please use a different username')
+    if taken:
+        return bad_request('please use a different email address')
+    return None
+
+
+# The unique indexes of the user table, by the name the database reports
+# them with: the index name on Postgres and MySQL, the column on SQLite
+_UNIQUE_ERRORS = (
+    (('ix_user_username', 'user.username'),
+        'please use a different username'),
+    (('ix_user_email', 'user.email'),
+        'please use a different email address'),
+)
+
+
+def _commit_user():
+    """Commit the user, relying on the unique constraints to catch a
+    concurrent request taking the same username or email. Returns a 400
+    response if that happened, otherwise None."""
+    try:
+        db.session.commit()
+    except exc.IntegrityError as e:
+        db.session.rollback()
+        constraint = violated_constraint(e)
+        for names, message in _UNIQUE_ERRORS:
+            if any(name in constraint for name in names):
+                return bad_request(message)
+        raise
+    return None
 
 
 @bp.route('/users', methods=['POST'])
@@ -95,11 +305,9 @@ def create_user():
     data['username'] = data['username'].lower().strip()
     data['email'] = data['email'].lower().strip()
     data['name'] = data['name'].strip()
-    if User.query.filter_by(username=data['username']).first() or \
-            data['username'] in current_app.config['BLOCKED_USERNAMES']:
-        return bad_request('please use a different username')
-    if User.query.filter_by(email=data['email']).first():
-        return bad_request('please use a different email address')
+    error = _taken_error(username=data['username'], email=data['email'])
+    if error:
+        return error
     if data['email'] in current_app.config['ADMINS']:
         data['group'] = 'admin'
     else:
@@ -107,7 +315,9 @@ def create_user():
     user = User()
     user.from_dict(data, new_user=True)     # Import and add user data
     db.session.add(user)
-    db.session.commit()
+    error = _commit_user()
+    if error:
+        return error
     response = jsonify(user.to_dict(include_email=True))
     response.status_code = 201  # Code to indicate new entity was created
     response.headers['Location'] = url_for('api.v1.get_user',
@@ -128,23 +338,25 @@ def update_user(public_id):
         abort(403)
     user = User.query.filter_by(public_id=public_id).first()
     data = request.get_json() or {}
+    username = email = None
     if 'username' in data:
         data['username'] = data['username'].lower().strip()
-        if data['username'] != user.username and \
-                (User.query.filter_by(username=data['username']).first() or
-                data['username'] in current_app.config['BLOCKED_USERNAMES']):
-            # If username is different and either username exists or is blocked
-            return bad_request('please use a different username')
+        if data['username'] != user.username:
+            username = data['username']
     if 'email' in data:
         data['email'] = data['email'].lower().strip()
-        if data['email'] != user.email and \
-                User.query.filter_by(email=data['email']).first():
-            # If email is different and already exists
-            return bad_request('please use a different email address')
+        if data['email'] != user.email:
+            email = data['email']
+    # Only a changed username or email has to be checked
+    error = _taken_error(username=username, email=email, user=user)
+    if error:
+        return error
     if 'name' in data:
         data['name'] = data['name'].strip()
     user.from_dict(data, new_user=False)    # Import and update user data
-    db.session.commit()
+    error = _commit_user()
+    if error:
+        return error
     return jsonify(user.to_dict(include_email=True))
 
 
@@ -0,0 +1,404 @@
+from collections import OrderedDict
+from datetime import datetime
+from functools import wraps
+import hashlib
+import json
+from threading import Lock
+from time import monotonic, sleep, time
+from urllib.parse import urlencode
+
+from flask import current_app, request
+import redis
+
+
+class LRUCache():
+    """Small thread safe LRU cache where every entry expires after a fixed
+    number of seconds. Lives inside a single worker process."""
+
+    def __init__(self, maxsize=1024, ttl=10):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            self._data[key] = (monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TokenCache():
+    """Two tier cache mapping an API token to the columns of the user it
+    belongs to. The first tier is a per-worker LRU, the second tier is shared
+    by all workers through Redis. Redis errors are treated as cache misses.
+
+    The password hash is never cached, and neither are the follow counters
+    and timestamps, which change through bulk updates that don't invalidate
+    the cache; they are loaded on demand if accessed.
+    """
+    excluded_columns = ('password_hash', 'follower_count', 'followed_count',
+            'updated', 'last_seen')
+
+    def __init__(self, app=None):
+        self.local = LRUCache()
+        self.redis = None
+        self.prefix = 'token'
+        self.redis_ttl = 300
+        self.enabled = True
+        self.hits = {'local': 0, 'redis': 0}
+        self.misses = 0
+        self.invalidations = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config['TOKEN_CACHE_ENABLED']
+        self.local = LRUCache(maxsize=app.config['TOKEN_CACHE_SIZE'],
+                ttl=app.config['TOKEN_CACHE_LOCAL_TTL'])
+        self.redis = app.redis if app.config['TOKEN_CACHE_REDIS'] else None
+        self.prefix = '%s:token' % app.config['APP_NICKNAME']
+        self.redis_ttl = app.config['TOKEN_CACHE_REDIS_TTL']
+        self.reset_stats()
+
+    @staticmethod
+    def _digest(token):
+        """Tokens are credentials, so only their digest is used as a key"""
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def _redis_key(self, digest):
+        return '%s:%s' % (self.prefix, digest)
+
+    @staticmethod
+    def _dump(row):
+        return json.dumps({k: v.isoformat() if isinstance(v, datetime) else v
+                for k, v in row.items()})
+
+    @staticmethod
+    def _load(columns, raw):
+        row = json.loads(raw)
+        for name, value in row.items():
+            if value is not None and \
+                    columns[name].type.python_type is datetime:
+                row[name] = datetime.fromisoformat(value)
+        return row
+
+    def get(self, token, columns):
+        """Return the cached column dictionary for the token, or None.
+
+        :param token: String of the API token
+        :param columns: Table column collection used to decode Redis values
+        """
+        if not self.enabled:
+            return None
+        digest = self._digest(token)
+        row = self.local.get(digest)
+        if row is not None:
+            self.hits['local'] += 1
+            return row
+        if self.redis is not None:
+            try:
+                raw = self.redis.get(self._redis_key(digest))
+            except redis.exceptions.RedisError:
+                raw = None
+            if raw is not None:
+                row = self._load(columns, raw)
+                self.local.set(digest, row)
+                self.hits['redis'] += 1
+                return row
+        self.misses += 1
+        return None
+
+    def set(self, token, row, ttl):
+        """Store the column dictionary for the token in both tiers.
+
+        :param ttl: Integer of seconds until the token itself expires
+        """
+        if not self.enabled or ttl <= 0:
+            return
+        digest = self._digest(token)
+        row = {k: v for k, v in row.items() if k not in self.excluded_columns}
+        self.local.set(digest, row, ttl)
+        if self.redis is not None:
+            try:
+                self.redis.setex(self._redis_key(digest),
+                        min(int(ttl), self.redis_ttl), self._dump(row))
+            except redis.exceptions.RedisError:
+                pass
+
+    def invalidate(self, token):
+        """Remove the token from both tiers. Other workers drop their local
+        copy once the local TTL runs out."""
+        if not token:
+            return
+        digest = self._digest(token)
+        self.local.delete(digest)
+        self.invalidations += 1
+        if self.redis is not None:
+            try:
+                self.redis.delete(self._redis_key(digest))
+            except redis.exceptions.RedisError:
+                pass
+
+    def reset_stats(self):
+        self.local.clear()
+        self.hits = {'local': 0, 'redis': 0}
+        self.misses = 0
+        self.invalidations = 0
+
+    def stats(self):
+        """Return the hit and miss counters for this worker"""
+        lookups = self.hits['local'] + self.hits['redis'] + self.misses
+        return {
+            'local_hits': self.hits['local'],
+            'redis_hits': self.hits['redis'],
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'hit_ratio': (lookups - self.misses) / lookups if lookups else 0.0,
+            'local_size': len(self.local),
+        }
+
+
+class TaggedCache():
+    """Redis cache where every entry carries tags, such as the names of the
+    tables it was computed from, so that all entries sharing a tag can be
+    dropped at once when the underlying data is written. Redis errors are
+    treated as cache misses."""
+
+    def __init__(self, namespace, app=None):
+        self.namespace = namespace
+        self.redis = None
+        self.prefix = namespace
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.redis = app.redis
+        self.prefix = '%s:%s' % (app.config['APP_NICKNAME'], self.namespace)
+
+    def _key(self, key):
+        return '%s:%s' % (self.prefix, key)
+
+    def _tag_key(self, tag):
+        return '%s:tag:%s' % (self.prefix, tag)
+
+    def get(self, key):
+        try:
+            return self.redis.get(self._key(key))
+        except redis.exceptions.RedisError:
+            return None
+
+    def set(self, key, value, tags=(), ttl=60):
+        key = self._key(key)
+        try:
+            pipe = self.redis.pipeline()
+            pipe.setex(key, ttl, value)
+            for tag in tags:
+                pipe.sadd(self._tag_key(tag), key)
+                pipe.expire(self._tag_key(tag), ttl)
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            pass
+
+    def lock(self, key, timeout):
+        """Try to take a lock on the key that expires after timeout seconds.
+        Returns True if Redis can't be reached, as there is nothing to
+        coordinate with."""
+        try:
+            return bool(self.redis.set(self._key('lock:%s' % key), 1, nx=True,
+                ex=timeout))
+        except redis.exceptions.RedisError:
+            return True
+
+    def unlock(self, key):
+        try:
+            self.redis.delete(self._key('lock:%s' % key))
+        except redis.exceptions.RedisError:
+            pass
+
+    def invalidate(self, *tags):
+        """Delete every entry carrying any of the tags"""
+        try:
+            for tag in tags:
+                tag_key = self._tag_key(tag)
+                keys = self.redis.smembers(tag_key)
+                self.redis.delete(tag_key, *keys)
+        except redis.exceptions.RedisError:
+            pass
+
+
+class ResponseCache():
+    """Cache of whole responses of public GET views, keyed by the endpoint,
+    its view arguments and the normalized query string. Entries are kept in
+    Redis, optionally behind a short lived per-worker LRU tier, and are
+    dropped by tag when the data they were built from is written.
+
+    An entry is fresh for the TTL and then served stale for the grace period
+    while a single worker, holding a Redis lock, rebuilds it. Workers that
+    find no entry at all while another worker builds it wait for that build
+    instead of querying the database themselves.
+    """
+    stored_headers = ('Content-Type', 'ETag', 'Last-Modified')
+
+    def __init__(self, app=None):
+        self.store = TaggedCache('response')
+        self.local = None
+        self.enabled = True
+        self.ttl = 30
+        self.grace = 30
+        self.lock_timeout = 5
+        self.hits = {'local': 0, 'redis': 0, 'stale': 0}
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config['RESPONSE_CACHE_ENABLED']
+        self.store.init_app(app)
+        self.ttl = app.config['RESPONSE_CACHE_TTL']
+        self.grace = app.config['RESPONSE_CACHE_GRACE']
+        self.lock_timeout = app.config['RESPONSE_CACHE_LOCK_TIMEOUT']
+        local_ttl = app.config['RESPONSE_CACHE_LOCAL_TTL']
+        self.local = LRUCache(maxsize=app.config['RESPONSE_CACHE_LOCAL_SIZE'],
+                ttl=local_ttl) if local_ttl else None
+        self.reset_stats()
+
+    def cached(self, tags):
+        """Decorator caching the 200 responses of a view.
+
+        :param tags: Function of the view's arguments returning the tags of
+            its entries
+        """
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if not self.enabled or request.method not in ('GET', 'HEAD'):
+                    return f(*args, **kwargs)
+                return self.get_or_build(self._request_key(),
+                        lambda: current_app.make_response(f(*args, **kwargs)),
+                        tags(**kwargs))
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def _request_key():
+        args = urlencode(sorted(request.args.items(multi=True)))
+        view_args = urlencode(sorted((request.view_args or {}).items()))
+        digest = hashlib.sha1(('%s?%s' % (view_args, args)).encode('utf-8'))
+        return '%s:%s' % (request.endpoint, digest.hexdigest())
+
+    def _load(self, key):
+        """Return the entry of the key and the tier it came from. A stale
+        local entry is passed over, as another worker may have rebuilt it."""
+        if self.local is not None:
+            entry = self.local.get(key)
+            if entry is not None and entry['expires'] > time():
+                return entry, 'local'
+        raw = self.store.get(key)
+        if raw is None:
+            return None, None
+        entry = json.loads(raw)
+        if self.local is not None:
+            self.local.set(key, entry)
+        return entry, 'redis'
+
+    def _save(self, key, response, tags):
+        if response.status_code != 200:
+            return
+        entry = {
+            'expires': time() + self.ttl,
+            'headers': [(name, response.headers[name])
+                for name in self.stored_headers if name in response.headers],
+            'body': response.get_data(as_text=True),
+        }
+        if self.local is not None:
+            self.local.set(key, entry)
+        self.store.set(key, json.dumps(entry), tags, self.ttl + self.grace)
+
+    @staticmethod
+    def _to_response(entry):
+        response = current_app.response_class(entry['body'],
+                headers=entry['headers'])
+        return response.make_conditional(request)
+
+    def get_or_build(self, key, build, tags=()):
+        """Return the cached response of the key, or build and cache it.
+
+        :param build: Function returning the response
+        :param tags: Tags to store the new entry with
+        """
+        entry, tier = self._load(key)
+        if entry is not None and entry['expires'] > time():
+            self.hits[tier] += 1
+            return self._to_response(entry)
+        if self.store.lock(key, self.lock_timeout):
+            self.misses += 1
+            try:
+                response = build()
+                self._save(key, response, tags)
+            finally:
+                self.store.unlock(key)
+            return response
+        if entry is not None:
+            # Another worker is rebuilding the entry; serve it stale
+            self.hits['stale'] += 1
+            return self._to_response(entry)
+        deadline = monotonic() + self.lock_timeout
+        while monotonic() < deadline:
+            sleep(0.05)
+            entry, tier = self._load(key)
+            if entry is not None:
+                self.hits[tier] += 1
+                return self._to_response(entry)
+        self.misses += 1
+        return build()
+
+    def invalidate(self, *tags):
+        """Drop the entries carrying any of the tags. Other workers drop their
+        local copies once the local TTL runs out."""
+        self.store.invalidate(*tags)
+        if self.local is not None:
+            self.local.clear()
+
+    def reset_stats(self):
+        if self.local is not None:
+            self.local.clear()
+        self.hits = {'local': 0, 'redis': 0, 'stale': 0}
+        self.misses = 0
+
+    def stats(self):
+        """Return the hit and miss counters for this worker"""
+        lookups = sum(self.hits.values()) + self.misses
+        return {
+            'local_hits': self.hits['local'],
+            'redis_hits': self.hits['redis'],
+            'stale_hits': self.hits['stale'],
+            'misses': self.misses,
+            'hit_ratio': (lookups - self.misses) / lookups if lookups else 0.0,
+            'local_size': len(self.local) if self.local is not None else 0,
+        }
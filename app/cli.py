@@ -0,0 +1,220 @@
+from datetime import datetime, timedelta
+
+import click
+
+from app import db, follow_graph
+from app.encoders import available_encoders, JSON_ENCODERS
+from app.encoders import benchmark as json_benchmark
+from app.hashing import benchmark, calibrate
+from app.models import Content, followers, new_public_id, User
+from app.plans import query_plan, time_query
+from app.revisions import benchmark as revisions_benchmark
+from app.text_storage import benchmark as text_storage_benchmark
+
+
+def register(app):
+    @app.cli.group(name='hash')
+    def password_hash():
+        """Password hashing commands."""
+        pass
+
+    @password_hash.command(name='calibrate')
+    @click.option('--target-ms', default=250, show_default=True,
+            help='Maximum milliseconds a single hash may take.')
+    @click.option('--memory', '-m', multiple=True, type=int,
+            default=(16384, 32768, 65536, 131072, 262144), show_default=True,
+            help='Candidate memory costs in KiB.')
+    @click.option('--rounds', '-r', multiple=True, type=int,
+            default=(1, 2, 3, 4, 6, 8, 10), show_default=True,
+            help='Candidate rounds (time cost).')
+    @click.option('--samples', default=3, show_default=True,
+            help='Hashes timed per candidate; the median is used.')
+    def calibrate_profile(target_ms, memory, rounds, samples):
+        """Benchmark argon2 parameters and recommend a hash profile."""
+        workers = max(app.config['PASSWORD_HASH_WORKERS'], 1)
+        results, best = calibrate(target_ms / 1000, memory, rounds, samples)
+        for settings, seconds in results:
+            click.echo('memory_cost=%-7d rounds=%-3d %7.1f ms' % (
+                settings['memory_cost'], settings['rounds'], seconds * 1000))
+        if best is None:
+            raise click.ClickException('no candidate hashes within %d ms' %
+                    target_ms)
+        click.echo('\nRecommended profile for PASSWORD_HASH_PROFILES:')
+        click.echo('    %r' % best)
+        click.echo('Peak hashing memory per uwsgi process: %d MiB' %
+                (best['memory_cost'] * workers // 1024))
+
+    @password_hash.command()
+    def profiles():
+        """Time the configured hash profiles on this machine."""
+        active = app.config['PASSWORD_HASH_PROFILE']
+        for name, settings in app.config['PASSWORD_HASH_PROFILES'].items():
+            click.echo('%s %-12s %7.1f ms  %r' % (
+                '*' if name == active else ' ', name,
+                benchmark(settings) * 1000, settings))
+
+    @app.cli.group()
+    def users():
+        """User maintenance commands."""
+        pass
+
+    @users.command()
+    def recount():
+        """Recompute the follower and followed counters of every user."""
+        updated = User.recount_follows()
+        db.session.commit()
+        click.echo('Recounted follows of %d users' % updated)
+
+    @users.command(name='import')
+    @click.argument('source', type=click.File('r'))
+    @click.option('--format', 'format_', type=click.Choice(['csv', 'ndjson']),
+            help='Defaults to csv for .csv files, otherwise ndjson.')
+    @click.option('--batch-size', default=1000, show_default=True,
+            help='Rows validated and inserted per statement.')
+    @click.option('--workers', type=int,
+            help='Password hashing processes. Defaults to the CPU count.')
+    @click.option('--errors', type=click.File('w'), default='-',
+            help='File the per-row errors are written to.')
+    def import_users(source, format_, batch_size, workers, errors):
+        """Import users from a CSV or NDJSON file.
+
+        Rows need username, email, name and password fields, and may have an
+        about_me field. Invalid rows are reported and skipped.
+        """
+        from app.user_import import read_rows, UserImport
+        if format_ is None:
+            format_ = 'csv' if source.name.endswith('.csv') else 'ndjson'
+        result = UserImport(batch_size, workers).run(
+                read_rows(source, format_))
+        for number, message in result.errors:
+            click.echo('row %d: %s' % (number, message), file=errors)
+        click.echo('Imported %d users in %.1f seconds (%.0f rows/sec), '
+                '%d rows failed' % (result.imported, result.seconds,
+                    result.rows_per_second, len(result.errors)))
+
+    @users.command(name='rebuild-graph')
+    def rebuild_graph():
+        """Rebuild the Redis follower graph cache from the database."""
+        edges = db.session.query(followers.c.follower_id,
+                followers.c.followed_id).yield_per(10000)
+        written = follow_graph.rebuild(edges)
+        click.echo('Wrote %d follower sets' % written)
+
+    @app.cli.group(name='json')
+    def json_group():
+        """JSON encoding commands."""
+        pass
+
+    @json_group.command(name='benchmark')
+    @click.option('--items', default=100, show_default=True,
+            help='Content items on the page.')
+    @click.option('--text-size', default=2000, show_default=True,
+            help='Characters of text in each item.')
+    @click.option('--repeat', default=20, show_default=True,
+            help='Times each encoder serializes the page; the best is used.')
+    def benchmark_json(items, text_size, repeat):
+        """Time the JSON encoders on a content collection page."""
+        now = datetime.utcnow()
+        author = User(public_id=new_public_id(), username='benchmark')
+        with app.test_request_context():
+            page = {
+                'items': [Content(public_id=new_public_id(),
+                    title='Content %d' % i, text='x' * text_size,
+                    created=now, updated=now, user=author).to_dict(text=True)
+                    for i in range(items)],
+                '_meta': {'page': 1, 'per_page': items, 'total_pages': 1,
+                    'total_items': items},
+                '_links': {'self': '/v1/content', 'next': None, 'prev': None},
+            }
+        baseline = None
+        for name in available_encoders():
+            seconds = json_benchmark(page, JSON_ENCODERS[name], repeat)
+            baseline = baseline or seconds
+            click.echo('%-8s %8.2f ms/page  %5.1fx' % (name, seconds * 1000,
+                baseline / seconds))
+
+    @app.cli.group()
+    def content():
+        """Content maintenance commands."""
+        pass
+
+    @content.command()
+    @click.option('--per-page', default=30, show_default=True,
+            help='Rows fetched per query, like a listing page.')
+    @click.option('--repeat', default=5, show_default=True,
+            help='Times each query runs; the median is used.')
+    def plans(per_page, repeat):
+        """Show the query plan and timing of each content listing filter."""
+        newest = Content.query.order_by(Content.created.desc()).first()
+        author = newest.user.username if newest is not None else 'nobody'
+        month_ago = datetime.utcnow() - timedelta(days=30)
+        listings = [
+            ('newest first', dict(sort='-created')),
+            ('by author %s' % author, dict(author=author)),
+            ('created in the last 30 days', dict(created_after=month_ago)),
+            ('comments enabled', dict(comments=True)),
+            ('by title', dict(sort='title')),
+        ]
+        for name, filters in listings:
+            query = Content.listing(**filters)[0].limit(per_page)
+            click.echo('%s: %.2f ms' % (name,
+                time_query(query, repeat) * 1000))
+            for line in query_plan(query):
+                click.echo('    %s' % line)
+
+    @content.command(name='history-benchmark')
+    @click.option('--lines', default=500, show_default=True,
+            help='Lines of text in the simulated document.')
+    @click.option('--revisions', default=200, show_default=True,
+            help='Revisions the document is edited through.')
+    @click.option('--edits', default=3, show_default=True,
+            help='Lines changed or added by each revision.')
+    @click.option('--interval', '-i', multiple=True, type=int,
+            default=(1, 10, 20, 50), show_default=True,
+            help='Snapshot intervals to compare; 1 stores every revision in '
+            'full.')
+    def history_benchmark(lines, revisions, edits, interval):
+        """Measure the storage and rebuild time of content revisions."""
+        active = app.config['CONTENT_HISTORY_SNAPSHOT_INTERVAL']
+        for snapshot_interval in interval:
+            result = revisions_benchmark(lines, revisions, snapshot_interval,
+                    edits)
+            click.echo('%s every %-4d %9d bytes (%5.1f%% of full copies)  '
+                    'rebuild %.2f ms average, %.2f ms worst' % (
+                '*' if snapshot_interval == active else ' ',
+                snapshot_interval, result['stored_bytes'],
+                100 * result['stored_bytes'] / result['full_bytes'],
+                result['average_ms'], result['worst_ms']))
+
+    @content.command(name='repack-text')
+    @click.option('--batch-size', default=500, show_default=True,
+            help='Rows rewritten per transaction.')
+    def repack_text(batch_size):
+        """Store all content text as TEXT_COMPRESS_MIN_SIZE says.
+
+        Run it after upgrading to compressed text, or after changing the
+        compression settings.
+        """
+        count, before = Content.text_storage()
+        rewritten = Content.repack_text(batch_size)
+        count, after = Content.text_storage()
+        click.echo('Rewrote the text of %d content items: %d bytes before, '
+                '%d bytes after' % (rewritten, before, after))
+        if db.engine.dialect.name == 'sqlite':
+            click.echo('Run VACUUM to return the freed pages to the disk')
+
+    @content.command(name='text-benchmark')
+    @click.option('--items', default=500, show_default=True,
+            help='Content items in the table.')
+    @click.option('--size', default=20000, show_default=True,
+            help='Characters of text in each item.')
+    def text_benchmark(items, size):
+        """Compare the size and read time of plain and compressed text."""
+        results = text_storage_benchmark(items, size,
+                app.config['TEXT_COMPRESS_MIN_SIZE'],
+                app.config['TEXT_COMPRESS_LEVEL'])
+        plain = results['plain']
+        for name, result in results.items():
+            click.echo('%-10s %10d bytes (%5.1f%%)  read %7.2f ms' % (name,
+                result['bytes'], 100 * result['bytes'] / plain['bytes'],
+                result['read_ms']))
@@ -0,0 +1,113 @@
+import gzip
+import hashlib
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:     # Optional; only gzip is offered without it
+    brotli = None
+
+
+class Compress():
+    """Compresses responses with brotli or gzip, as accepted by the client.
+
+    Only successful responses of the configured mimetypes that are at least
+    the minimum size are compressed, so small payloads such as the errors of
+    error_response are sent as they are. Responses that set their own
+    Content-Encoding, like StaticPayload, are left alone. A strong ETag is
+    made weak when the body is compressed, as the bytes no longer match.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.min_size = 1024
+        self.level = 6
+        self.brotli_quality = 4
+        self.mimetypes = ('application/json',)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config['COMPRESS_RESPONSES']
+        self.min_size = app.config['COMPRESS_MIN_SIZE']
+        self.level = app.config['COMPRESS_LEVEL']
+        self.brotli_quality = app.config['COMPRESS_BROTLI_QUALITY']
+        self.mimetypes = app.config['COMPRESS_MIMETYPES']
+        app.extensions['compress'] = self
+        app.after_request(self.after_request)
+
+    @property
+    def encodings(self):
+        return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+    def choose_encoding(self, size):
+        """Return the encoding accepted by the client to compress a body of
+        the size with, or None to send it uncompressed"""
+        if not self.enabled or size < self.min_size:
+            return None
+        return request.accept_encodings.best_match(self.encodings)
+
+    def compress(self, data, encoding):
+        if encoding == 'br':
+            return brotli.compress(data, quality=self.brotli_quality)
+        return gzip.compress(data, compresslevel=self.level, mtime=0)
+
+    def after_request(self, response):
+        if not self.enabled or response.mimetype not in self.mimetypes:
+            return response
+        response.vary.add('Accept-Encoding')
+        if response.status_code != 200 or response.direct_passthrough or \
+                response.is_streamed or 'Content-Encoding' in response.headers:
+            return response
+        data = response.get_data()
+        encoding = self.choose_encoding(len(data))
+        if encoding is None:
+            return response
+        response.set_data(self.compress(data, encoding))
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+
+class StaticPayload():
+    """Response body that never changes, such as a catalog. The body is built
+    on first use and each compressed form is made once and kept in memory.
+
+    :param build: Function returning the body as bytes; called within the
+        first request
+    """
+
+    def __init__(self, build, mimetype='application/json'):
+        self.build = build
+        self.mimetype = mimetype
+        self.etag = None
+        self._bodies = {}
+
+    def _body(self, encoding):
+        if None not in self._bodies:
+            body = self.build()
+            self.etag = hashlib.sha1(body).hexdigest()
+            self._bodies[None] = body
+        if encoding not in self._bodies:
+            self._bodies[encoding] = \
+                    self._compress.compress(self._bodies[None], encoding)
+        return self._bodies[encoding]
+
+    @property
+    def _compress(self):
+        return current_app.extensions['compress']
+
+    def response(self):
+        """Return the response in the encoding preferred by the client"""
+        encoding = self._compress.choose_encoding(len(self._body(None)))
+        response = current_app.response_class(self._body(encoding),
+                mimetype=self.mimetype)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        if self._compress.enabled:
+            response.vary.add('Accept-Encoding')
+        response.set_etag(self.etag, weak=encoding is not None)
+        return response.make_conditional(request)
@@ -0,0 +1,69 @@
+import hashlib
+
+from flask import current_app
+from sqlalchemy.sql.util import find_tables
+
+from app import count_cache, db
+
+
+def query_tables(query):
+    """Return the set of table names a query reads from"""
+    return {t.name for t in find_tables(query.statement, include_joins=True,
+            include_aliases=True)}
+
+
+def exact_count(query):
+    """COUNT(*) of the query. Always correct, but scans every matching row"""
+    return query.order_by(None).count(), False
+
+
+def cached_count(query):
+    """Exact count stored in Redis, tagged with the tables the query reads
+    from. The count is dropped when one of the tables is written to, or after
+    COLLECTION_COUNT_TTL seconds."""
+    compiled = query.order_by(None).statement.compile(dialect=db.engine.dialect)
+    key = hashlib.sha1(('%s %r' % (compiled, sorted(compiled.params.items(),
+            key=lambda p: p[0]))).encode('utf-8')).hexdigest()
+    cached = count_cache.get(key)
+    if cached is not None:
+        return int(cached), False
+    total, estimated = exact_count(query)
+    count_cache.set(key, total, tags=query_tables(query),
+            ttl=current_app.config['COLLECTION_COUNT_TTL'])
+    return total, estimated
+
+
+def estimated_count(query):
+    """Row estimate from the Postgres planner, which uses the table
+    statistics (reltuples) instead of scanning. Other databases, such as the
+    SQLite test database, fall back to an exact count."""
+    if db.engine.dialect.name != 'postgresql':
+        return exact_count(query)
+    compiled = query.order_by(None).statement.compile(
+            dialect=db.engine.dialect)
+    plan = db.session.connection().exec_driver_sql(
+            'EXPLAIN (FORMAT JSON) %s' % compiled, compiled.params).scalar()
+    return int(plan[0]['Plan']['Plan Rows']), True
+
+
+COUNT_STRATEGIES = {
+    'exact': exact_count,
+    'cached': cached_count,
+    'estimated': estimated_count,
+}
+
+
+def count_query(query, strategy=None):
+    """Count the items of a collection query using the named strategy, or
+    COLLECTION_COUNT when no strategy is given.
+
+    :return: Tuple of the count and whether it is an estimate
+    """
+    strategy = strategy or current_app.config['COLLECTION_COUNT']
+    return COUNT_STRATEGIES[strategy](query)
+
+
+def invalidate_counts(tables):
+    """Drop the cached counts of queries reading from any of the tables"""
+    if tables:
+        count_cache.invalidate(*tables)
@@ -0,0 +1,80 @@
+from datetime import date, datetime, timezone
+import json
+from time import perf_counter
+
+from flask.json import JSONEncoder
+
+try:
+    import orjson
+except ImportError:     # Optional; the stdlib encoder is used without it
+    orjson = None
+
+
+class ISOJSONEncoder(JSONEncoder):
+    """Flask's JSON encoder, except that dates and datetimes are ISO 8601
+    strings instead of HTTP dates. Naive datetimes are in UTC."""
+
+    def default(self, o):
+        if isinstance(o, datetime):
+            if o.tzinfo is None:
+                o = o.replace(tzinfo=timezone.utc)
+            return o.isoformat()
+        if isinstance(o, date):
+            return o.isoformat()
+        return super().default(o)
+
+
+class OrjsonEncoder(ISOJSONEncoder):
+    """Encodes with orjson, which serializes datetimes, dataclasses and UUIDs
+    natively in C and calls default for anything else. Falls back to the
+    stdlib encoder for indents orjson can't produce and for values it
+    rejects, such as integers over 64 bits."""
+
+    def encode(self, o):
+        option = orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if self.indent == 2:
+            option |= orjson.OPT_INDENT_2
+        elif self.indent is not None:
+            return super().encode(o)
+        try:
+            return orjson.dumps(o, default=self.default, option=option) \
+                    .decode('utf-8')
+        except TypeError:
+            return super().encode(o)
+
+
+JSON_ENCODERS = {
+    'stdlib': ISOJSONEncoder,
+    'orjson': OrjsonEncoder,
+}
+
+
+def available_encoders():
+    """Return the names of the encoders that can be used"""
+    return [name for name in JSON_ENCODERS
+            if name != 'orjson' or orjson is not None]
+
+
+def configure_json(app):
+    """Set the encoder used by jsonify from the JSON_ENCODER setting"""
+    name = app.config['JSON_ENCODER']
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'stdlib'
+    elif name == 'orjson' and orjson is None:
+        app.logger.warning('orjson is not installed; using the stdlib JSON '
+                'encoder')
+        name = 'stdlib'
+    app.json_encoder = JSON_ENCODERS[name]
+
+
+def benchmark(data, encoder, repeat=20):
+    """Return the best number of seconds the encoder took to serialize the
+    data the way jsonify does"""
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        json.dumps(data, cls=encoder, separators=(',', ':'))
+        times.append(perf_counter() - start)
+    return min(times)
@@ -0,0 +1,193 @@
+import redis
+
+
+# Applies a write-through change to the sets that are already loaded. Sets
+# that aren't loaded are left alone; they are read from the database in full
+# the next time they are needed. The version of every set is incremented,
+# loaded or not, so that a load that started before the change isn't stored.
+# KEYS holds the sets followed by their version keys.
+_WRITE_THROUGH = """
+local count = #KEYS / 2
+for i = 1, count do
+    redis.call('INCR', KEYS[count + i])
+    redis.call('EXPIRE', KEYS[count + i], ARGV[1])
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        redis.call(ARGV[2], KEYS[i], ARGV[i + 2])
+    end
+end
+"""
+
+# Stores a set read from the database, unless its version changed while it
+# was being read
+_STORE = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+for i = 3, #ARGV, 5000 do
+    redis.call('SADD', KEYS[1], unpack(ARGV, i, math.min(i + 4999, #ARGV)))
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+
+class FollowGraph():
+    """Adjacency cache of the follower graph, kept as one Redis set of user
+    ids per user and relation ('followers' or 'followed').
+
+    Sets are loaded from the database on first use and then kept up to date
+    by User.follow/unfollow once their transaction commits. A loaded set
+    always contains the SENTINEL id, so an empty relation can be told apart
+    from a set that was never loaded. Each set has a version that is
+    incremented by every change, and a load is only stored if the version
+    didn't change while it was read. If Redis can't be reached, or a set
+    keeps changing while it's loaded, the same queries are answered from
+    the database.
+    """
+    SENTINEL = '0'
+    RELATIONS = ('followers', 'followed')
+    LOAD_ATTEMPTS = 3
+
+    def __init__(self, app=None):
+        self.redis = None
+        self.prefix = 'graph'
+        self.ttl = 60*60*24
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.redis = app.redis
+        self.prefix = '%s:graph' % app.config['APP_NICKNAME']
+        self.ttl = app.config['FOLLOW_GRAPH_TTL']
+        self._write_through = self.redis.register_script(_WRITE_THROUGH)
+        self._store_script = self.redis.register_script(_STORE)
+
+    def _key(self, relation, user_id):
+        return '%s:%s:%s' % (self.prefix, relation, user_id)
+
+    @staticmethod
+    def _version_key(key):
+        return '%s:version' % key
+
+    @staticmethod
+    def _load_ids(relation, user_id):
+        from app.models import User     # Avoid a circular import
+        return User.follow_ids(user_id, relation)
+
+    def _ensure_loaded(self, relation, user_ids):
+        """Load the sets missing from Redis from the database"""
+        keys = [self._key(relation, user_id) for user_id in user_ids]
+        pipe = self.redis.pipeline()
+        for key in keys:
+            pipe.exists(key)
+        for user_id, key, exists in zip(user_ids, keys, pipe.execute()):
+            if not exists:
+                self._load(key, relation, user_id)
+        return keys
+
+    def _load(self, key, relation, user_id):
+        """Store the set read from the database, reading it again if a
+        follow or unfollow was committed meanwhile"""
+        version_key = self._version_key(key)
+        for _ in range(self.LOAD_ATTEMPTS):
+            version = self.redis.get(version_key) or b'0'
+            ids = self._load_ids(relation, user_id)
+            if self._store_script(keys=[key, version_key],
+                    args=[version, self.ttl, self.SENTINEL] + list(ids)):
+                return
+        raise redis.exceptions.WatchError('%s kept changing while loaded' %
+                key)
+
+    @staticmethod
+    def _to_ids(members):
+        return {int(m) for m in members} - {0}
+
+    def members(self, relation, user_id):
+        """Return the set of user ids related to the user"""
+        try:
+            key, = self._ensure_loaded(relation, [user_id])
+            return self._to_ids(self.redis.smembers(key))
+        except redis.exceptions.RedisError:
+            return set(self._load_ids(relation, user_id))
+
+    def intersection(self, *sets):
+        """Return the ids present in every one of the (relation, user_id)
+        sets, computed with SINTER."""
+        try:
+            keys = []
+            for relation, user_id in sets:
+                keys += self._ensure_loaded(relation, [user_id])
+            return self._to_ids(self.redis.sinter(keys))
+        except redis.exceptions.RedisError:
+            return set.intersection(*[set(self._load_ids(relation, user_id))
+                for relation, user_id in sets])
+
+    def contains(self, relation, user_id, other_ids):
+        """Return a dictionary of each of the other ids to whether it is in
+        the user's set."""
+        try:
+            key, = self._ensure_loaded(relation, [user_id])
+            pipe = self.redis.pipeline()
+            for other_id in other_ids:
+                pipe.sismember(key, other_id)
+            return dict(zip(other_ids, pipe.execute()))
+        except redis.exceptions.RedisError:
+            ids = set(self._load_ids(relation, user_id))
+            return {other_id: other_id in ids for other_id in other_ids}
+
+    def apply(self, changes):
+        """Write committed follow changes through to the loaded sets.
+
+        :param changes: List of (follow, follower_id, followed_ids) tuples,
+            where follow is True for follows and False for unfollows
+        """
+        try:
+            for follow, follower_id, followed_ids in changes:
+                command = 'SADD' if follow else 'SREM'
+                keys = [self._key('followed', follower_id)] * \
+                        len(followed_ids)
+                args = list(followed_ids)
+                for followed_id in followed_ids:
+                    keys.append(self._key('followers', followed_id))
+                    args.append(follower_id)
+                keys += [self._version_key(key) for key in keys]
+                self._write_through(keys=keys,
+                        args=[self.ttl, command] + args)
+        except redis.exceptions.RedisError:
+            # The sets may now be stale; drop them so they get reloaded
+            self.forget(changes)
+
+    def forget(self, changes):
+        try:
+            keys = []
+            for _, follower_id, followed_ids in changes:
+                keys.append(self._key('followed', follower_id))
+                keys += [self._key('followers', i) for i in followed_ids]
+            self.redis.delete(*keys)
+        except redis.exceptions.RedisError:
+            pass
+
+    def rebuild(self, edges):
+        """Replace every set with the ones built from the follower edges.
+
+        :param edges: Iterable of (follower_id, followed_id) tuples
+        :return: Number of sets written
+        """
+        for key in self.redis.scan_iter(match='%s:*' % self.prefix,
+                count=1000):
+            self.redis.delete(key)
+        sets = {}
+        for follower_id, followed_id in edges:
+            sets.setdefault(self._key('followed', follower_id), []) \
+                    .append(followed_id)
+            sets.setdefault(self._key('followers', followed_id), []) \
+                    .append(follower_id)
+        pipe = self.redis.pipeline(transaction=False)
+        for number, (key, ids) in enumerate(sets.items(), 1):
+            pipe.sadd(key, self.SENTINEL, *ids)
+            pipe.expire(key, self.ttl)
+            if number % 1000 == 0:
+                pipe.execute()
+        pipe.execute()
+        return len(sets)
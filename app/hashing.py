@@ -0,0 +1,200 @@
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from statistics import median
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+
+from passlib.hash import argon2
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when the password hashing queue is full"""
+    pass
+
+
+def hash_password(password, settings):
+    """Runs inside a pool process. Returns the hash and the seconds it took"""
+    start = perf_counter()
+    password_hash = argon2.using(**settings).hash(password)
+    return password_hash, perf_counter() - start
+
+
+def verify_password(password, password_hash):
+    """Runs inside a pool process. Returns the result and the seconds it took"""
+    start = perf_counter()
+    valid = argon2.verify(password, password_hash)
+    return valid, perf_counter() - start
+
+
+class PasswordHasher():
+    """Runs Argon2 hashing and verification in a dedicated process pool.
+
+    The number of concurrent hashes is capped by PASSWORD_HASH_WORKERS and at
+    most PASSWORD_HASH_QUEUE_DEPTH more requests may wait for a free process.
+    Beyond that PasswordHasherBusy is raised right away, so a burst of logins
+    can't exhaust the memory of the host. A request that waits longer than
+    PASSWORD_HASH_TIMEOUT also gets PasswordHasherBusy, but its hash keeps
+    its slot until the pool is done with it. With zero workers the hash runs in
+    the calling thread, still subject to the same limits.
+
+    The limits apply per uwsgi process, as each process owns its own pool.
+    """
+
+    def __init__(self, app=None):
+        self.workers = 0
+        self.profile = None
+        self.settings = {}
+        self.handler = argon2
+        self.timeout = 30
+        self._slots = BoundedSemaphore(1)
+        self._executor = None
+        self._lock = Lock()
+        self._stats_lock = Lock()
+        self.reset_stats()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.shutdown()
+        self.workers = app.config['PASSWORD_HASH_WORKERS']
+        self.timeout = app.config['PASSWORD_HASH_TIMEOUT']
+        self.use_profile(app.config['PASSWORD_HASH_PROFILES'],
+                app.config['PASSWORD_HASH_PROFILE'])
+        self._slots = BoundedSemaphore(max(self.workers, 1) +
+                app.config['PASSWORD_HASH_QUEUE_DEPTH'])
+        self.reset_stats()
+
+    def use_profile(self, profiles, name):
+        """Hash new passwords with the Argon2 parameters of the named profile
+
+        :param profiles: Dictionary of profile names to argon2 settings
+        :param name: String of the profile to use
+        """
+        if name not in profiles:
+            raise ValueError('unknown password hash profile %s' % name)
+        self.profile = name
+        self.settings = dict(profiles[name])
+        self.handler = argon2.using(**self.settings)
+
+    def _get_executor(self):
+        # Created lazily so the pool is started after uwsgi forks its workers
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            self._count('rejected')
+            raise PasswordHasherBusy()
+        start = perf_counter()
+        if self.workers:
+            try:
+                future = self._get_executor().submit(func, *args)
+            except BaseException:
+                self._slots.release()
+                raise
+            # The slot is only free once the pool is done with the hash, even
+            # if the request stops waiting for it
+            future.add_done_callback(lambda _: self._slots.release())
+            try:
+                result, hash_time = future.result(timeout=self.timeout)
+            except TimeoutError:
+                future.cancel()     # Frees the slot if it is still queued
+                self._count('timed_out')
+                raise PasswordHasherBusy()
+            except BrokenProcessPool:
+                self.shutdown()
+                raise
+        else:
+            try:
+                result, hash_time = func(*args)
+            finally:
+                self._slots.release()
+        wait_time = max(perf_counter() - start - hash_time, 0)
+        with self._stats_lock:
+            stats = self.stats_data
+            stats['completed'] += 1
+            stats['hash_time'] += hash_time
+            stats['wait_time'] += wait_time
+            stats['max_wait_time'] = max(stats['max_wait_time'], wait_time)
+        return result
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats_data[name] += 1
+
+    def hash(self, password):
+        """Return the Argon2 hash of the password"""
+        return self._run(hash_password, password, self.settings)
+
+    def verify(self, password, password_hash):
+        """Return True if the password matches the Argon2 hash"""
+        return self._run(verify_password, password, password_hash)
+
+    def needs_update(self, password_hash):
+        """Return True if the hash was made with different parameters than
+        the current profile. Only parses the hash, so it is cheap."""
+        return self.handler.needs_update(password_hash)
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.stats_data = {'completed': 0, 'rejected': 0,
+                    'timed_out': 0, 'hash_time': 0.0, 'wait_time': 0.0,
+                    'max_wait_time': 0.0}
+
+    def stats(self):
+        """Return the queue wait and hash time counters for this worker"""
+        with self._stats_lock:
+            stats = dict(self.stats_data)
+        completed = stats['completed'] or 1
+        return {
+            'profile': self.profile,
+            'workers': self.workers,
+            'completed': stats['completed'],
+            'rejected': stats['rejected'],
+            'timed_out': stats['timed_out'],
+            'avg_hash_time': stats['hash_time'] / completed,
+            'avg_wait_time': stats['wait_time'] / completed,
+            'max_wait_time': stats['max_wait_time'],
+        }
+
+
+def benchmark(settings, samples=3):
+    """Return the median seconds it takes to hash a password on this machine
+    with the given argon2 settings."""
+    handler = argon2.using(**settings)
+    timings = []
+    for _ in range(samples):
+        start = perf_counter()
+        handler.hash('correct horse battery staple')
+        timings.append(perf_counter() - start)
+    return median(timings)
+
+
+def calibrate(target, memory_costs, rounds, samples=3):
+    """Benchmark every combination of memory cost and rounds, and return a
+    list of (settings, seconds) tuples along with the strongest settings that
+    hash within the target seconds, or None if no candidate is fast enough.
+
+    Memory cost is preferred over rounds, as it is what makes GPU attacks
+    expensive.
+    """
+    results = []
+    best = None
+    for memory_cost in sorted(memory_costs):
+        for time_cost in sorted(rounds):
+            settings = dict(rounds=time_cost, digest_size=32, salt_size=32,
+                    memory_cost=memory_cost)
+            seconds = benchmark(settings, samples)
+            results.append((settings, seconds))
+            if seconds > target:
+                break   # More rounds will only be slower
+            best = settings
+    return results, best
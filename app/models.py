@@ -1,17 +1,32 @@
 import base64
 from datetime import datetime, timedelta
+import hashlib
 import json
+from math import ceil
 import os
+from threading import Thread
 from time import time
 
 from flask import current_app, url_for
 from flask_login import UserMixin
 import jwt
-from passlib.hash import argon2
 import redis
 import rq
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.orm import load_only, make_transient_to_detached, undefer
 
-from app import db
+from app import db, follow_graph, password_hasher, response_cache, \
+        token_cache
+from app.counts import count_query, invalidate_counts
+from app.hashing import PasswordHasherBusy
+from app.revisions import make_delta, rebuild
+from app.text_storage import pack_text, unpack_text
+
+
+def new_public_id():
+    """Return a random, url safe, 24 character public id"""
+    public_id = base64.b64encode(os.urandom(18)).decode('utf-8')
+    return public_id.replace('/', 'J').replace('+', 'k')
 
 
 class IdMixin():
@@ -22,72 +37,226 @@ class TimestampMixin():
     created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     updated = db.Column(db.DateTime, onupdate=datetime.utcnow)
 
+    @property
+    def last_modified(self):
+        """Time of the last change to the row"""
+        return self.updated or self.created
+
+    def etag(self, *variant):
+        """Return an entity tag that changes whenever the row changes. Pass
+        anything else the representation depends on, such as the requested
+        fields, as the variant."""
+        key = '%s:%s:%s:%r' % (self.__tablename__, self.id,
+                self.last_modified.isoformat(), variant)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class FieldsMixin():
+    """Lets API clients request a subset of the fields of to_dict. Models map
+    every field to the attributes it reads in api_fields, so a query can load
+    only the columns the requested fields need."""
+    api_fields = {}
+
+    @classmethod
+    def load_fields(cls, fields, *extra):
+        """Return a load_only option for the columns of the fields.
+
+        :param fields: Set of field names, all of which are in api_fields
+        :param extra: Other columns to load, such as a sort key
+        """
+        columns = set(extra)
+        for field in fields:
+            columns.update(getattr(cls, name) for name in cls.api_fields[field])
+        return load_only(*columns)
+
 
 class PaginatedApiMixin():
     @staticmethod
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
+    def _paginate(query, page, per_page, endpoint, total=True, **kwargs):
+        """Fetch a page of items with OFFSET/LIMIT and build the _meta and
+        _links of the collection. One extra row is fetched to know whether
+        there is a next page, so the count is only needed for the totals.
+
+        :param total: True to count with the COLLECTION_COUNT strategy, the
+            name of a count strategy, or False to skip counting
+        """
+        page, per_page = max(page, 1), max(per_page, 1)
+        items = query.limit(per_page + 1).offset((page - 1) * per_page).all()
+        has_next = len(items) > per_page
+        meta = {
+            'page': page,
+            'per_page': per_page,
+            'total_pages': None,
+            'total_items': None,
+        }
+        if total:
+            total_items, estimated = count_query(query,
+                    None if total is True else total)
+            meta['total_items'] = total_items
+            meta['total_pages'] = ceil(total_items / per_page)
+            meta['total_estimated'] = estimated
+        links = PaginatedApiMixin.page_links(page, per_page, endpoint,
+                has_next, **kwargs)
+        return items[:per_page], meta, links
+
+    @staticmethod
+    def page_links(page, per_page, endpoint, has_next, **kwargs):
+        """Return the _links of a page of a page number collection"""
+        return {
+            'self': url_for(endpoint, page=page, per_page=per_page, **kwargs),
+            'next': url_for(endpoint, page=page + 1, per_page=per_page,
+                    **kwargs) if has_next else None,
+            'prev': url_for(endpoint, page=page - 1, per_page=per_page,
+                    **kwargs) if page > 1 else None
+        }
+
+    @staticmethod
+    def to_collection_dict(query, page, per_page, endpoint, total=True,
+            to_dict=None, **kwargs):
         """Produces a dictionary representing a collection, including the
         items, _meta, and _links. Useful for returning collection of user
-        followers."""
-        resources = query.paginate(page, per_page, False)
+        followers.
+
+        :param to_dict: Optional function serializing each item
+        """
+        items, meta, links = PaginatedApiMixin._paginate(query, page,
+                per_page, endpoint, total, **kwargs)
+        to_dict = to_dict or (lambda item: item.to_dict())
         data = {
-            'items': [item.to_dict() for item in resources.items],
-            '_meta': {
-                'page': page,
-                'per_page': per_page,
-                'total_pages': resources.pages,
-                'total_items': resources.total,
-            },
-            '_links': {
-                'self': url_for(endpoint, page=page, per_page=per_page,
-                        **kwargs),
-                'next': url_for(endpoint, page=page + 1, per_page=per_page,
-                        **kwargs) if resources.has_next else None,
-                'prev': url_for(endpoint, page=page - 1, per_page=per_page,
-                        **kwargs) if resources.has_prev else None
-            },
+            'items': [to_dict(item) for item in items],
+            '_meta': meta,
+            '_links': links,
         }
         return data
 
     @staticmethod
-    def content_to_collection_dict(query, page, per_page, endpoint, **kwargs):
-        """Produces a dictionary representing a collection, including the
-        items, _meta, and _links. Useful for returning collection of user
-        followers."""
-        resources = query.paginate(page, per_page, False)
+    def to_cursor_collection_dict(query, per_page, endpoint, sort_key,
+            after=None, before=None, total=False, to_dict=None,
+            descending=False, **kwargs):
+        """Produces the same collection dictionary as to_collection_dict, but
+        pages with opaque after/before cursors over an indexed sort key
+        instead of OFFSET, so deep pages are as fast as the first one. The
+        total count is only queried when requested.
+
+        :param sort_key: Tuple of unique, indexed columns to order by, such as
+            (User.created, User.id)
+        :param to_dict: Optional function serializing each item
+        :param descending: True to order by the sort key in descending order
+        :raises ValueError: If a cursor can't be decoded
+        """
+        key = db.tuple_(*sort_key)
+        query = base_query = query.order_by(None)
+        # Walking backwards from a cursor is walking forwards in reverse
+        backwards = (before is not None) != descending
+        if before is not None:
+            cursor = decode_cursor(before, sort_key)
+            query = query.filter(key > cursor if descending else key < cursor)
+        elif after is not None:
+            cursor = decode_cursor(after, sort_key)
+            query = query.filter(key < cursor if descending else key > cursor)
+        query = query.order_by(*[c.desc() if backwards else c.asc()
+            for c in sort_key])
+        items = query.limit(per_page + 1).all()
+        more = len(items) > per_page
+        items = items[:per_page]
+        if before is not None:
+            items.reverse()
+            has_next, has_prev = True, more
+        else:
+            has_next, has_prev = more, after is not None
+        to_dict = to_dict or (lambda item: item.to_dict())
         data = {
+            'items': [to_dict(item) for item in items],
             '_meta': {
-                'page': page,
                 'per_page': per_page,
-                'total_pages': resources.pages,
-                'total_items': resources.total,
             },
             '_links': {
-                'self': url_for(endpoint, page=page, per_page=per_page,
-                        **kwargs),
-                'next': url_for(endpoint, page=page + 1, per_page=per_page,
-                        **kwargs) if resources.has_next else None,
-                'prev': url_for(endpoint, page=page - 1, per_page=per_page,
-                        **kwargs) if resources.has_prev else None
+                'self': url_for(endpoint, per_page=per_page, after=after,
+                        before=before, **kwargs),
+                'next': url_for(endpoint, per_page=per_page,
+                        after=encode_cursor(items[-1], sort_key), **kwargs)
+                        if has_next and items else None,
+                'prev': url_for(endpoint, per_page=per_page,
+                        before=encode_cursor(items[0], sort_key), **kwargs)
+                        if has_prev and items else None
             },
         }
-        content = kwargs.get('content')
-        tags = kwargs.get('tags')
-        history = kwargs.get('history')
-        track = kwargs.get('track')
-        data['items'] = [item.to_dict(content=content, tags=tags,
-            history=history, track=track) for item in resources.items]
+        if total:
+            data['_meta']['total_items'], data['_meta']['total_estimated'] = \
+                    count_query(base_query, None if total is True else total)
         return data
 
 
+def encode_cursor(item, sort_key):
+    """Return an opaque, url safe cursor of the item's sort key values"""
+    values = [getattr(item, c.key) for c in sort_key]
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')) \
+            .decode('utf-8').rstrip('=')
+
+
+def decode_cursor(cursor, sort_key):
+    """Return the tuple of sort key values encoded in the cursor"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(
+                cursor + '=' * (-len(cursor) % 4)))
+        if len(values) != len(sort_key):
+            raise ValueError('cursor does not match the sort key')
+        return tuple(datetime.fromisoformat(v)
+                if c.type.python_type is datetime else c.type.python_type(v)
+                for c, v in zip(sort_key, values))
+    except (TypeError, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError('invalid cursor') from e
+
+
 followers = db.Table(
         'followers',
-        db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-        db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+        db.Column('follower_id', db.Integer, db.ForeignKey('user.id'),
+            primary_key=True),
+        db.Column('followed_id', db.Integer, db.ForeignKey('user.id'),
+            primary_key=True),
+        # The primary key covers "who does X follow"; this covers "who follows X"
+        db.Index('ix_followers_followed_id_follower_id', 'followed_id',
+            'follower_id')
 )
 
 
-class User(UserMixin, IdMixin, TimestampMixin, PaginatedApiMixin, db.Model):
+def insert_ignore(table):
+    """Return an INSERT for the table that silently skips rows that would
+    violate its primary key or a unique constraint"""
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return sqlite.insert(table).on_conflict_do_nothing()
+    return table.insert().prefix_with('IGNORE')     # MySQL
+
+
+def upsert(table, keys, values, update):
+    """Return an INSERT of the values into the table that instead updates
+    the existing row when one has the same keys
+
+    :param keys: Names of the columns of a primary key or unique constraint
+    :param values: Dictionary of the column values to insert
+    :param update: Names of the columns overwritten in an existing row
+    """
+    dialect = db.engine.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert = (postgresql if dialect == 'postgresql' else sqlite) \
+                .insert(table).values(**values)
+        return insert.on_conflict_do_update(index_elements=keys,
+                set_={name: insert.excluded[name] for name in update})
+    insert = mysql.insert(table).values(**values)
+    return insert.on_duplicate_key_update(
+            **{name: insert.inserted[name] for name in update})
+
+
+class User(UserMixin, IdMixin, TimestampMixin, FieldsMixin,
+        PaginatedApiMixin, db.Model):
+    __table_args__ = (
+        # Keyset pagination sort key
+        db.Index('ix_user_created_id', 'created', 'id'),
+    )
     public_id = db.Column(db.String(24), index=True, unique=True, nullable=False)
     # Username: lowercase and strip
     username = db.Column(db.String(64), index=True, unique=True, nullable=False)
@@ -103,6 +272,11 @@ class User(UserMixin, IdMixin, TimestampMixin, PaginatedApiMixin, db.Model):
     token = db.Column(db.String(128), index=True, unique=True, nullable=True)
     token_expiration = db.Column(db.DateTime, nullable=True)
     last_seen = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    # Denormalized follow counts; repair with `flask users recount`
+    follower_count = db.Column(db.Integer, default=0, server_default='0',
+            nullable=False)
+    followed_count = db.Column(db.Integer, default=0, server_default='0',
+            nullable=False)
     followed = db.relationship('User', secondary=followers,
             primaryjoin='User.id == followers.c.follower_id',
             secondaryjoin='User.id == followers.c.followed_id',
@@ -119,11 +293,20 @@ class User(UserMixin, IdMixin, TimestampMixin, PaginatedApiMixin, db.Model):
         return '<User {}>'.format(self.username)
 
     def set_password(self, password):
-        self.password_hash = argon2.using(rounds=10, digest_size=32,
-                salt_size=32, memory_cost=128000).hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        return argon2.verify(password, self.password_hash)
+        """Verify the password. If the stored hash was made with an outdated
+        hash profile, rehash the password in the background after a
+        successful check."""
+        valid = password_hasher.verify(password, self.password_hash)
+        if valid and self.id is not None and \
+                current_app.config['PASSWORD_REHASH_ON_LOGIN'] and \
+                password_hasher.needs_update(self.password_hash):
+            Thread(target=rehash_password, name='password-rehash',
+                    args=(current_app._get_current_object(), self.id,
+                        self.password_hash, password)).start()
+        return valid
 
     def get_confirmation_token(self, expired_in=60*60*24*7):
         return jwt.encode(
@@ -154,16 +337,26 @@ class User(UserMixin, IdMixin, TimestampMixin, PaginatedApiMixin, db.Model):
         return User.query.get(id)
 
     def add_notification(self, name, data):
-        """Add a notification for the user. If the same notification already
-        exists in the database, delete it first then add it again.
+        """Add a notification for the user in the current transaction. If the
+        user already has a notification with the name, its data and
+        timestamp are replaced in the same statement.
+
+        The timestamp is taken now, not when the transaction commits, and the
+        ?since= feed only returns notifications with a later timestamp than
+        the last one a client saw. A notification committed after a newer one
+        was already polled is therefore never delivered to that client, so
+        keep the transactions adding notifications short.
 
         :param name: String of the name of the notification
         :data: Dictionary (json) type data
+        :return: Model object of the added or replaced notification
         """
-        self.notifications.filter_by(name=name).delete()
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
-        db.session.add(n)
-        return n
+        db.session.execute(upsert(Notification.__table__, ['user_id', 'name'],
+            dict(public_id=new_public_id(), name=name, user_id=self.id,
+                timestamp=time(), payload_json=json.dumps(data)),
+            ['timestamp', 'payload_json']))
+        return Notification.query.populate_existing() \
+                .filter_by(user_id=self.id, name=name).one()
 
     def launch_task(self, name, description, *args, **kwargs):
         """Submits a task to the RQ queue and adds it to the database
@@ -192,36 +385,147 @@ class User(UserMixin, IdMixin, TimestampMixin, PaginatedApiMixin, db.Model):
                 first()
 
     def is_following(self, user):
-        return self.followed.filter(
-                followers.c.followed_id == user.id).count() > 0
+        return db.session.query(db.exists().where(
+                (followers.c.follower_id == self.id) &
+                (followers.c.followed_id == user.id))).scalar()
 
     def follow(self, user):
-        if not self.is_following(user):
-            self.followed.append(user)
+        """Follow the user with a single idempotent insert"""
+        result = db.session.execute(insert_ignore(followers).values(
+                follower_id=self.id, followed_id=user.id))
+        if result.rowcount:
+            self._adjust_follow_counts([user], 1)
 
     def unfollow(self, user):
-        if self.is_following(user):
-            self.followed.remove(user)
+        """Unfollow the user with a single idempotent delete"""
+        result = db.session.execute(followers.delete().where(
+                (followers.c.follower_id == self.id) &
+                (followers.c.followed_id == user.id)))
+        if result.rowcount:
+            self._adjust_follow_counts([user], -1)
 
-    def to_dict(self, include_email=False):
-        """Convert the user object into a JSON object"""
-        data = {
-            'public_id': self.public_id,
-            'username': self.username,
-            'group': self.group,
-            'name': self.name,
-            'about_me': self.about_me,
-            'follower_count': self.followers.count(),
-            'followed_count': self.followed.count(),
-            '_links': {
+    def _followed_ids(self, users):
+        """Return the set of ids of the users this user already follows"""
+        return {row[0] for row in db.session.query(followers.c.followed_id)
+                .filter(followers.c.follower_id == self.id)
+                .filter(followers.c.followed_id.in_([u.id for u in users]))}
+
+    def follow_many(self, users):
+        """Follow every user that isn't followed yet, in the current
+        transaction. Returns the list of newly followed users."""
+        followed_ids = self._followed_ids(users)
+        ids = [u.id for u in users if u.id not in followed_ids]
+        written = self._write_follows(ids, lambda ids: insert_ignore(followers)
+                .values([{'follower_id': self.id, 'followed_id': i}
+                    for i in ids]))
+        new = [u for u in users if u.id in written]
+        if new:
+            self._adjust_follow_counts(new, 1)
+        return new
+
+    def unfollow_many(self, users):
+        """Unfollow every followed user, in the current transaction. Returns
+        the list of unfollowed users."""
+        followed_ids = self._followed_ids(users)
+        written = self._write_follows(list(followed_ids),
+                lambda ids: followers.delete().where(
+                    (followers.c.follower_id == self.id) &
+                    (followers.c.followed_id.in_(ids))))
+        old = [u for u in users if u.id in written]
+        if old:
+            self._adjust_follow_counts(old, -1)
+        return old
+
+    @staticmethod
+    def _write_follows(ids, statement):
+        """Execute the followers insert or delete made by statement(ids), and
+        return the set of followed ids whose rows it actually wrote. A
+        concurrent request may have written some of them since they were
+        read, so the counters must only follow these. Postgres reports them
+        with RETURNING in one statement; elsewhere each row is written on
+        its own and checked by its rowcount."""
+        if not ids:
+            return set()
+        if db.engine.dialect.name == 'postgresql':
+            return {row[0] for row in db.session.execute(
+                    statement(ids).returning(followers.c.followed_id))}
+        return {i for i in ids if db.session.execute(statement([i])).rowcount}
+
+    def _adjust_follow_counts(self, users, delta):
+        """Atomically change the denormalized counters of this user and the
+        (un)followed users in the current transaction, and expire the stale
+        values in the session."""
+        table = User.__table__
+        db.session.execute(table.update().where(table.c.id == self.id)
+                .values(followed_count=table.c.followed_count +
+                    delta * len(users)))
+        db.session.execute(table.update()
+                .where(table.c.id.in_([u.id for u in users]))
+                .values(follower_count=table.c.follower_count + delta))
+        db.session.expire(self, ['followed_count'])
+        for user in users:
+            db.session.expire(user, ['follower_count'])
+        db.session.info.setdefault('follow_changes', []).append(
+                (delta > 0, self.id, [u.id for u in users]))
+
+    @staticmethod
+    def follow_ids(user_id, relation):
+        """Return the ids of the user's followers or followed users
+
+        :param relation: String of either 'followers' or 'followed'
+        """
+        if relation == 'followers':
+            column, other = followers.c.follower_id, followers.c.followed_id
+        else:
+            column, other = followers.c.followed_id, followers.c.follower_id
+        return [row[0] for row in
+                db.session.query(column).filter(other == user_id)]
+
+    @staticmethod
+    def recount_follows():
+        """Recompute the denormalized follow counters of every user in bulk
+        from the followers table. Returns the number of users updated."""
+        table = User.__table__
+        follower_count = db.select([db.func.count()]) \
+                .where(followers.c.followed_id == table.c.id) \
+                .scalar_subquery()
+        followed_count = db.select([db.func.count()]) \
+                .where(followers.c.follower_id == table.c.id) \
+                .scalar_subquery()
+        result = db.session.execute(table.update().values(
+                follower_count=follower_count, followed_count=followed_count))
+        return result.rowcount
+
+    api_fields = {
+        'public_id': ('public_id',),
+        'username': ('username',),
+        'group': ('group',),
+        'name': ('name',),
+        'about_me': ('about_me',),
+        'follower_count': ('follower_count',),
+        'followed_count': ('followed_count',),
+        '_links': ('public_id',),
+        'email': ('email',),
+    }
+
+    def to_dict(self, include_email=False, fields=None):
+        """Convert the user object into a JSON object. If a set of fields is
+        given, only those fields are built, and the attributes of the others
+        aren't read, so they can be left out of the query."""
+        data = {}
+        for field in ('public_id', 'username', 'group', 'name', 'about_me',
+                'follower_count', 'followed_count'):
+            if fields is None or field in fields:
+                data[field] = getattr(self, field)
+        if fields is None or '_links' in fields:
+            data['_links'] = {
                 'self': url_for('api.v1.get_user', public_id=self.public_id),
                 'followers': url_for('api.v1.get_followers',
                     public_id=self.public_id),
                 'followed': url_for('api.v1.get_followed',
                     public_id=self.public_id),
             }
-        }
-        if include_email:
+        if include_email and (fields is None or 'email' in fields):
             data['email'] = self.email
         return data
 
@@ -239,8 +543,7 @@ class User(UserMixin, IdMixin, TimestampMixin, PaginatedApiMixin, db.Model):
         if 'password' in data:
             self.set_password(data['password'])
         if new_user:
-            public_id = base64.b64encode(os.urandom(18)).decode('utf-8')
-            self.public_id = public_id.replace('/', 'J')    # replace /
+            self.public_id = new_public_id()
 
     def get_token(self, expires_in=3600):
         """Return a token to the user. If there is an existing token that has
@@ -249,6 +552,7 @@ class User(UserMixin, IdMixin, TimestampMixin, PaginatedApiMixin, db.Model):
         now = datetime.utcnow()
         if self.token and self.token_expiration > now + timedelta(seconds=60):
             return self.token
+        _invalidate_token_on_commit(self.token)
         # Create a token with 128 random characters (96 bytes -> 128 char)
         self.token = base64.b64encode(os.urandom(96)).decode('utf-8')
         self.token_expiration = now + timedelta(seconds=expires_in)
@@ -258,17 +562,275 @@ class User(UserMixin, IdMixin, TimestampMixin, PaginatedApiMixin, db.Model):
     def revoke_token(self):
         """Immediately invoke the token via the expiration date"""
         self.token_expiration = datetime.utcnow() - timedelta(seconds=1)
+        _invalidate_token_on_commit(self.token)
 
     @staticmethod
     def check_token(token):
-        """Return the user the provided token belongs to."""
+        """Return the user the provided token belongs to. The user's columns
+        are served from the token cache when possible, and the cached user is
+        attached to the session without querying the database."""
+        now = datetime.utcnow()
+        row = token_cache.get(token, User.__table__.columns)
+        if row is not None:
+            if row['token_expiration'] < now:
+                return None
+            return User.from_columns(row)
         user = User.query.filter_by(token=token).first()
-        if user is None or user.token_expiration < datetime.utcnow():
+        if user is None or user.token_expiration < now:
             return None
+        token_cache.set(token, user.cached_columns(),
+                (user.token_expiration - now).total_seconds())
         return user
 
+    def get_access_token(self, expires_in=900):
+        """Return a short lived signed access token. It carries the columns
+        the routes rely on, so it can be verified without a database lookup.
+        The user's token column then acts as the refresh token."""
+        now = int(time())
+        return jwt.encode({
+            'type': 'access',
+            'jti': base64.urlsafe_b64encode(os.urandom(12)).decode('utf-8'),
+            'sub': self.id,
+            'pid': self.public_id,
+            'usr': self.username,
+            'grp': self.group,
+            'iat': now,
+            'exp': now + expires_in,
+        }, current_app.config['SECRET_KEY'], algorithm='HS512')
+
+    @staticmethod
+    def decode_access_token(token):
+        """Return the claims of a valid, unexpired access token, or None"""
+        try:
+            claims = jwt.decode(token, current_app.config['SECRET_KEY'],
+                    algorithms=['HS512'])
+        except jwt.InvalidTokenError:
+            return None
+        return claims if claims.get('type') == 'access' else None
+
+    @staticmethod
+    def check_access_token(claims):
+        """Return the user of the access token claims, unless the token was
+        revoked. If Redis can't be reached, fall back to checking that the
+        user's refresh token is still active in the database."""
+        try:
+            revoked_jti, cutoff = current_app.redis.mget(
+                    _revocation_key('jti', claims['jti']),
+                    _revocation_key('user', claims['sub']))
+        except redis.exceptions.RedisError:
+            user = User.query.get(claims['sub'])
+            if user is None or user.token_expiration is None or \
+                    user.token_expiration < datetime.utcnow():
+                return None
+            return user
+        if revoked_jti is not None or \
+                (cutoff is not None and claims['iat'] < int(cutoff)):
+            return None
+        return User.from_columns({'id': claims['sub'],
+            'public_id': claims['pid'], 'username': claims['usr'],
+            'group': claims['grp']})
+
+    @staticmethod
+    def revoke_access_token(claims):
+        """Add the access token ID to the revocation set until it expires"""
+        ttl = int(claims['exp'] - time()) + 1
+        if ttl > 0:
+            try:
+                current_app.redis.setex(_revocation_key('jti', claims['jti']),
+                        ttl, 1)
+            except redis.exceptions.RedisError:
+                pass
+
+    @staticmethod
+    def revoke_access_tokens(user_id):
+        """Revoke every access token issued to the user before this second.
+        Tokens carry their issue time in whole seconds, so one issued in the
+        same second as the revocation, e.g. on the next login, stays valid."""
+        try:
+            current_app.redis.setex(_revocation_key('user', user_id),
+                    current_app.config['ACCESS_TOKEN_EXPIRES'], int(time()))
+        except redis.exceptions.RedisError:
+            pass
+
+    @staticmethod
+    def from_columns(row):
+        """Attach a user built from known column values to the session
+        without querying the database. Columns missing from the row are loaded
+        on first access."""
+        user = User(**row)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    def cached_columns(self):
+        """Return a dictionary of the user's column values"""
+        return {c.name: getattr(self, c.name) for c in User.__table__.columns}
+
+
+def _invalidate_token_on_commit(token):
+    """Drop the token from the token cache once the transaction commits.
+    Dropping it sooner would let a concurrent request cache the row again
+    before the change is visible."""
+    if token:
+        db.session.info.setdefault('stale_tokens', set()).add(token)
+
+
+def _revocation_key(kind, value):
+    return '%s:revoked:%s:%s' % (current_app.config['APP_NICKNAME'], kind,
+            value)
+
+
+def rehash_password(app, user_id, old_hash, password):
+    """Store a new hash of the password using the current hash profile. Runs
+    in a background thread, and the hash is only replaced if it wasn't changed
+    in the meantime."""
+    with app.app_context():
+        try:
+            new_hash = password_hasher.hash(password)
+        except PasswordHasherBusy:
+            return  # Try again on the next login
+        try:
+            db.session.execute(User.__table__.update()
+                    .where(User.__table__.c.id == user_id)
+                    .where(User.__table__.c.password_hash == old_hash)
+                    .values(password_hash=new_hash))
+            db.session.commit()
+        finally:
+            db.session.remove()
+
+
+@db.event.listens_for(User, 'after_update')
+def _invalidate_cached_token(mapper, connection, target):
+    """Drop the cached user whenever a cached column changes, such as the
+    token being rotated or the user's group being changed."""
+    state = db.inspect(target)
+    changed = [c.name for c in User.__table__.columns
+            if c.name not in token_cache.excluded_columns and
+            state.attrs[c.name].history.has_changes()]
+    if changed:
+        _invalidate_token_on_commit(target.token)
+        for token in state.attrs.token.history.deleted or ():
+            _invalidate_token_on_commit(token)
+    if state.attrs.group.history.has_changes() and \
+            current_app.config['TOKEN_MODE'] == 'jwt':
+        User.revoke_access_tokens(target.id)
+
+
+@db.event.listens_for(db.Session, 'before_flush')
+def _unfollow_deleted_users(session, flush_context, instances):
+    """Decrement the follow counters of the users on the other side of the
+    deleted users' follows, whose rows the flush deletes along with them, and
+    drop the users from the cached follower graph sets."""
+    connection = session.connection()
+    table = User.__table__
+    for user in [obj for obj in session.deleted if isinstance(obj, User)]:
+        followed_ids = [row[0] for row in connection.execute(
+            db.select([followers.c.followed_id])
+            .where(followers.c.follower_id == user.id))]
+        follower_ids = [row[0] for row in connection.execute(
+            db.select([followers.c.follower_id])
+            .where(followers.c.followed_id == user.id))]
+        if followed_ids:
+            connection.execute(table.update()
+                    .where(table.c.id.in_(followed_ids))
+                    .values(follower_count=table.c.follower_count - 1))
+        if follower_ids:
+            connection.execute(table.update()
+                    .where(table.c.id.in_(follower_ids))
+                    .values(followed_count=table.c.followed_count - 1))
+        for other_id in followed_ids + follower_ids:
+            other = session.identity_map.get((User, (other_id,), None))
+            if other is not None:
+                session.expire(other, ['follower_count', 'followed_count'])
+        if followed_ids or follower_ids:
+            session.info.setdefault('written_tables', set()).add('followers')
+            session.info.setdefault('follow_changes', []).extend(
+                    [(False, user.id, followed_ids)] +
+                    [(False, follower_id, [user.id])
+                        for follower_id in follower_ids])
+
+
+@db.event.listens_for(User, 'after_delete')
+def _invalidate_deleted_user_token(mapper, connection, target):
+    _invalidate_token_on_commit(target.token)
+    if current_app.config['TOKEN_MODE'] == 'jwt':
+        User.revoke_access_tokens(target.id)
+
+
+@db.event.listens_for(db.Session, 'after_flush')
+def _track_written_tables(session, flush_context):
+    """Remember which tables had rows inserted, updated or deleted in the
+    transaction"""
+    tables = session.info.setdefault('written_tables', set())
+    for obj in list(session.new) + list(session.deleted):
+        tables.add(obj.__table__.name)
+    for obj in session.dirty:
+        if session.is_modified(obj):
+            tables.add(obj.__table__.name)
+
+
+@db.event.listens_for(db.Session, 'do_orm_execute')
+def _track_executed_writes(state):
+    """Remember the tables written by statements run with session.execute,
+    such as the bulk follower and content tag writes"""
+    if state.is_insert or state.is_update or state.is_delete:
+        state.session.info.setdefault('written_tables', set()).add(
+                state.statement.table.name)
+
+
+@db.event.listens_for(db.Session, 'after_flush')
+def _track_stale_responses(session, flush_context):
+    """Remember the response cache tags of the content written in the
+    transaction. Renaming a user also changes the username shown in their
+    content; deleting one deletes their content by cascade."""
+    tags = session.info.setdefault('stale_responses', set())
+    for obj in list(session.new) + list(session.dirty) + \
+            list(session.deleted):
+        if isinstance(obj, Content):
+            if obj in session.dirty and not session.is_modified(obj):
+                continue
+            tags.update(('content', 'content:%s' % obj.public_id))
+        elif isinstance(obj, User) and obj in session.dirty and \
+                db.inspect(obj).attrs.username.history.has_changes():
+            table = Content.__table__
+            tags.add('content')
+            tags.update('content:%s' % row[0] for row in
+                    session.connection().execute(db.select([table.c.public_id])
+                        .where(table.c.user_id == obj.id)))
+
+
+@db.event.listens_for(db.Session, 'after_commit')
+def _invalidate_written_tables(session):
+    """Drop the cached collection counts of the committed tables, the cached
+    responses of the committed content and the cached tokens of the
+    committed users, and write committed follows through to the follower
+    graph cache"""
+    invalidate_counts(session.info.pop('written_tables', None))
+    stale_responses = session.info.pop('stale_responses', None)
+    if stale_responses:
+        response_cache.invalidate(*stale_responses)
+    for token in session.info.pop('stale_tokens', ()):
+        token_cache.invalidate(token)
+    follow_changes = session.info.pop('follow_changes', None)
+    if follow_changes:
+        follow_graph.apply(follow_changes)
+
+
+@db.event.listens_for(db.Session, 'after_rollback')
+def _forget_written_tables(session):
+    session.info.pop('written_tables', None)
+    session.info.pop('stale_responses', None)
+    session.info.pop('stale_tokens', None)
+    session.info.pop('follow_changes', None)
+
 
 class Notification(IdMixin, db.Model):
+    __table_args__ = (
+        # One notification per name, replaced by User.add_notification
+        db.UniqueConstraint('user_id', 'name',
+            name='uq_notification_user_id_name'),
+        # A user's notifications since a time
+        db.Index('ix_notification_user_id_timestamp', 'user_id', 'timestamp'),
+    )
     public_id = db.Column(db.String(24), index=True, unique=True, nullable=False)
     name = db.Column(db.String(128), index=True, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -278,6 +840,14 @@ class Notification(IdMixin, db.Model):
     def get_data(self):
         return json.loads(str(self.payload_json))
 
+    def to_dict(self):
+        return {
+            'public_id': self.public_id,
+            'name': self.name,
+            'data': self.get_data(),
+            'timestamp': self.timestamp,
+        }
+
 
 class Task(TimestampMixin, db.Model):
     """Maintain state of what tasks each user is running"""
@@ -306,34 +876,505 @@ class Task(TimestampMixin, db.Model):
         return job.meta.get('progress', 0) if job is not None else 100
 
 
-class Content(IdMixin, TimestampMixin, PaginatedApiMixin,  db.Model):
+class TSVector(db.TypeDecorator):
+    """Postgres tsvector. Other databases get a text column that stays
+    empty, as they search content in other ways."""
+    impl = db.Text
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(postgresql.TSVECTOR())
+        return dialect.type_descriptor(db.Text())
+
+
+class CompressedText(db.TypeDecorator):
+    """Text stored with pack_text, which compresses it with zlib once it
+    reaches TEXT_COMPRESS_MIN_SIZE bytes. Postgres keeps a text column, as
+    TOAST already compresses large values there and the full text search
+    functions need to read it."""
+    impl = db.LargeBinary
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(db.Text())
+        return dialect.type_descriptor(db.LargeBinary())
+
+    def process_bind_param(self, value, dialect):
+        if value is None or dialect.name == 'postgresql':
+            return value
+        return pack_text(value, current_app.config['TEXT_COMPRESS_MIN_SIZE'],
+                current_app.config['TEXT_COMPRESS_LEVEL'])
+
+    def process_result_value(self, value, dialect):
+        if value is None or dialect.name == 'postgresql':
+            return value
+        return unpack_text(value)
+
+    def coerce_compared_value(self, op, value):
+        # Patterns and other compared values are plain text, not stored text
+        return db.Text()
+
+
+content_tags = db.Table(
+        'content_tags',
+        db.Column('content_id', db.Integer, db.ForeignKey('content.id'),
+            primary_key=True),
+        db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'),
+            primary_key=True),
+        # The primary key covers "what are the tags of X"; this covers "what
+        # is tagged X", in content id order so tag filters intersect cheaply
+        db.Index('ix_content_tags_tag_id_content_id', 'tag_id', 'content_id')
+)
+
+
+class Tag(IdMixin, db.Model):
+    """Content tag. The number of content items carrying the tag is kept
+    up to date as content is tagged, so the tag cloud never scans content."""
+    __table_args__ = (
+        db.Index('ix_tag_content_count', 'content_count'),
+    )
+    max_length = 50
+
+    name = db.Column(db.String(max_length), index=True, unique=True,
+            nullable=False)
+    content_count = db.Column(db.Integer, default=0, server_default='0',
+            nullable=False)
+
+    @classmethod
+    def normalize(cls, names):
+        """Return the lowercase, deduplicated tag names, in order. Raises a
+        ValueError if a name is empty or too long."""
+        normalized = []
+        for name in names:
+            name = name.lower().strip()
+            if not name or len(name) > cls.max_length:
+                raise ValueError('tags must have 1 to %d characters' %
+                        cls.max_length)
+            if name not in normalized:
+                normalized.append(name)
+        return normalized
+
+    @staticmethod
+    def ids(names):
+        """Return a dictionary of the existing tag names to their ids"""
+        if not names:
+            return {}
+        return dict(db.session.query(Tag.name, Tag.id)
+                .filter(Tag.name.in_(names)))
+
+    @staticmethod
+    def adjust_counts(tag_ids, delta):
+        """Atomically change the content counts of the tags in the current
+        transaction"""
+        table = Tag.__table__
+        db.session.execute(table.update().where(table.c.id.in_(tag_ids))
+                .values(content_count=table.c.content_count + delta))
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'count': self.content_count,
+            '_links': {
+                'content': url_for('api.v1.get_all_content', tags=self.name)
+            }
+        }
+
+
+class Content(IdMixin, TimestampMixin, FieldsMixin, PaginatedApiMixin,
+        db.Model):
+    __table_args__ = (
+        # Keyset pagination sort key
+        db.Index('ix_content_created_id', 'created', 'id'),
+        # Listing filters combined with their sort keys
+        db.Index('ix_content_user_id_created_id', 'user_id', 'created', 'id'),
+        db.Index('ix_content_comments_created_id', 'comments', 'created',
+            'id'),
+        db.Index('ix_content_title_id', 'title', 'id'),
+        db.Index('ix_content_search_vector', 'search_vector',
+            postgresql_using='gin'),
+    )
     public_id = db.Column(db.String(24), index=True, unique=True, nullable=False)
     title = db.Column(db.String(100), nullable=False)
-    text = db.Column(db.Text(), nullable=True)
+    text = db.Column(CompressedText(), nullable=True)
     comments = db.Column(db.Boolean, default=True, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    # Number of the latest revision; see ContentRevision
+    revision = db.Column(db.Integer, nullable=False, default=1,
+            server_default='1')
+    # Weighted full text search document of the title and text, kept up to
+    # date on every write. Only used on Postgres; SQLite uses content_fts.
+    search_vector = db.deferred(db.Column(TSVector(), nullable=True))
+    # Written with set_tags; only read through the relationship
+    tags = db.relationship('Tag', secondary=content_tags, order_by=Tag.name,
+            viewonly=True)
+
+    # Sorts of the content listing: the sort key column names, each ending
+    # with the unique id, and whether the order is descending
+    listing_sorts = {
+        'created': (('created', 'id'), False),
+        '-created': (('created', 'id'), True),
+        'title': (('title', 'id'), False),
+        '-title': (('title', 'id'), True),
+    }
+
+    @classmethod
+    def listing(cls, author=None, created_after=None, created_before=None,
+            comments=None, tags=None, match='all', sort='created'):
+        """Return the query of the content listing, its sort key, and whether
+        the sort is descending. An author or comments filter sorted by
+        created is covered by a composite index, as is a created range.
+
+        :param author: Username of the author
+        :param created_after: Datetime the content was created at or after
+        :param created_before: Datetime the content was created before
+        :param comments: True or False to filter on whether comments are on
+        :param tags: List of normalized tag names
+        :param match: 'all' to require every tag, or 'any' to require one
+        :param sort: One of the listing_sorts
+        """
+        names, descending = cls.listing_sorts[sort]
+        sort_key = tuple(getattr(cls, name) for name in names)
+        query = cls.query
+        if author is not None:
+            user_id = db.session.query(User.id) \
+                    .filter_by(username=author.lower().strip()).scalar()
+            query = query.filter(cls.user_id == user_id
+                    if user_id is not None else db.false())
+        if created_after is not None:
+            query = query.filter(cls.created >= created_after)
+        if created_before is not None:
+            query = query.filter(cls.created < created_before)
+        if comments is not None:
+            query = query.filter(cls.comments == comments)
+        if tags:
+            query = query.filter(cls._tagged(tags, match))
+        query = query.order_by(*[c.desc() if descending else c.asc()
+            for c in sort_key])
+        return query, sort_key, descending
+
+    @classmethod
+    def _tagged(cls, tags, match):
+        """Return the filter of content carrying all or any of the tags. Both
+        are answered from the (tag_id, content_id) index alone: any is the
+        union of the tags' content ids, and all is their intersection."""
+        tag_ids = Tag.ids(tags)
+        if not tag_ids or (match == 'all' and len(tag_ids) < len(tags)):
+            return db.false()
+        if match == 'any':
+            return cls.id.in_(db.select([content_tags.c.content_id])
+                    .where(content_tags.c.tag_id.in_(tag_ids.values())))
+        return cls.id.in_(db.intersect(*[
+            db.select([content_tags.c.content_id])
+            .where(content_tags.c.tag_id == tag_id)
+            for tag_id in tag_ids.values()]))
+
+    def set_tags(self, names):
+        """Replace the tags of the content in the current transaction,
+        creating the tags that don't exist yet and adjusting the content
+        counts of the added and removed tags. The updated time changes with
+        the tags, so that ETags do too. The content must have an id.
+
+        :param names: List of tag names, as normalized by Tag.normalize
+        """
+        if names:
+            db.session.execute(insert_ignore(Tag.__table__),
+                    [{'name': name} for name in names])
+        tag_ids = set(Tag.ids(names).values())
+        current = {row[0] for row in db.session.query(content_tags.c.tag_id)
+                .filter(content_tags.c.content_id == self.id)}
+        added, removed = tag_ids - current, current - tag_ids
+        if added:
+            db.session.execute(content_tags.insert(), [
+                {'content_id': self.id, 'tag_id': tag_id} for tag_id in added])
+            Tag.adjust_counts(added, 1)
+        if removed:
+            db.session.execute(content_tags.delete().where(
+                    (content_tags.c.content_id == self.id) &
+                    (content_tags.c.tag_id.in_(removed))))
+            Tag.adjust_counts(removed, -1)
+        if added or removed:
+            self.updated = datetime.utcnow()
+        db.session.expire(self, ['tags'])
+
+    @staticmethod
+    def repack_text(batch_size=500):
+        """Rewrite the text of all content in batches, so that it's stored
+        as the current TEXT_COMPRESS_MIN_SIZE and TEXT_COMPRESS_LEVEL say.
+        Doesn't change the updated times or make new revisions. Returns the
+        number of rows rewritten."""
+        table = Content.__table__
+        last_id, rewritten = 0, 0
+        while True:
+            rows = db.session.execute(db.select([table.c.id, table.c.text])
+                    .where(table.c.id > last_id).order_by(table.c.id)
+                    .limit(batch_size)).fetchall()
+            if not rows:
+                return rewritten
+            db.session.execute(table.update()
+                    .where(table.c.id == db.bindparam('content_id'))
+                    .values(text=db.bindparam('content_text'),
+                        updated=table.c.updated),
+                    [{'content_id': row.id, 'content_text': row.text}
+                        for row in rows])
+            db.session.commit()
+            last_id = rows[-1].id
+            rewritten += len(rows)
+
+    @staticmethod
+    def text_storage():
+        """Return the number of content rows and the total bytes taken by
+        their stored text"""
+        text = Content.__table__.c.text
+        if db.engine.dialect.name == 'postgresql':
+            size = db.func.pg_column_size(text)     # After TOAST compression
+        else:
+            size = db.func.length(text)     # Of the stored blobs
+        return db.session.query(db.func.count(),
+                db.func.coalesce(db.func.sum(size), 0)).one()
 
     def from_dict(self, data, new=True):
         for field in ['title', 'text', 'comments', 'user_id']:
             if field in data:
                 setattr(self, field, data[field])
         if new:
-            public_id = base64.b64encode(os.urandom(18)).decode('utf-8')
-            self.public_id = public_id.replace('/', 'J').replace('+', 'k')
+            self.public_id = new_public_id()
 
-    def to_dict(self, text=False):
-        """Convert the content object into a JSON object"""
-        data = {
-            'public_id': self.public_id,
-            'title': self.title,
-            'username': self.user.username,
-            'created': self.created,
-            'updated': self.updated,
-            '_links': {
+    api_fields = {
+        'public_id': ('public_id',),
+        'title': ('title',),
+        'username': ('user_id',),
+        'created': ('created',),
+        'updated': ('updated',),
+        'revision': ('revision',),
+        'tags': (),
+        '_links': ('public_id',),
+        'text': ('text',),
+    }
+
+    def to_dict(self, text=False, fields=None):
+        """Convert the content object into a JSON object. The text is only
+        included if requested, either with text or in the set of fields. If a
+        set of fields is given, the attributes of the others aren't read."""
+        data = {}
+        for field in ('public_id', 'title'):
+            if fields is None or field in fields:
+                data[field] = getattr(self, field)
+        if fields is None or 'username' in fields:
+            data['username'] = self.user.username
+        for field in ('created', 'updated', 'revision'):
+            if fields is None or field in fields:
+                data[field] = getattr(self, field)
+        if fields is None or 'tags' in fields:
+            data['tags'] = [tag.name for tag in self.tags]
+        if fields is None or '_links' in fields:
+            data['_links'] = {
                 'self': url_for('api.v1.get_content', public_id=self.public_id),
+                'text': url_for('api.v1.get_content_text',
+                    public_id=self.public_id),
+                'history': url_for('api.v1.get_content_history',
+                    public_id=self.public_id),
                 'content': url_for('api.v1.get_all_content')
             }
-        }
-        if text:
+        if text if fields is None else 'text' in fields:
             data['text'] = self.text if self.text else ''
         return data
+
+    @staticmethod
+    def search(terms):
+        """Return a query of (Content, rank, snippet) rows matching the search
+        terms, best match first. The snippet is an excerpt of the text with
+        the matching words in <mark> tags.
+
+        Postgres uses the search_vector GIN index, SQLite the content_fts
+        FTS5 table, and other databases fall back to unranked LIKE matching,
+        which can't see into compressed text.
+        """
+        dialect = db.engine.dialect.name
+        if dialect == 'postgresql':
+            language = current_app.config['SEARCH_LANGUAGE']
+            tsquery = db.func.websearch_to_tsquery(language, terms)
+            rank = db.func.ts_rank_cd(Content.search_vector, tsquery)
+            snippet = db.func.ts_headline(language,
+                    db.func.coalesce(Content.text, ''), tsquery,
+                    'StartSel=<mark>, StopSel=</mark>, MaxFragments=2')
+            return db.session.query(Content, rank.label('rank'),
+                    snippet.label('snippet')) \
+                    .filter(Content.search_vector.op('@@')(tsquery)) \
+                    .order_by(rank.desc(), Content.id)
+        if dialect == 'sqlite':
+            fts = db.literal_column('content_fts')
+            # Quote every word, so that FTS5 query syntax in the terms is
+            # searched for instead of parsed; words are ANDed together
+            match = ' '.join('"%s"' % word.replace('"', '""')
+                    for word in terms.split())
+            rank = db.func.bm25(fts)     # Lower is better
+            snippet = db.func.snippet(fts, 1, '<mark>', '</mark>', '...', 16)
+            return db.session.query(Content, (-rank).label('rank'),
+                    snippet.label('snippet')) \
+                    .join(content_fts, content_fts.c.rowid == Content.id) \
+                    .filter(fts.op('MATCH')(match)) \
+                    .order_by(rank, Content.id)
+        pattern = '%%%s%%' % terms
+        return db.session.query(Content, db.literal(0.0).label('rank'),
+                db.null().label('snippet')) \
+                .filter(db.or_(Content.title.ilike(pattern),
+                    Content.text.ilike(pattern))) \
+                .order_by(Content.id)
+
+
+# SQLite full text index of the content, with the content id as its rowid
+content_fts = db.table('content_fts', db.column('rowid'), db.column('title'),
+        db.column('text'))
+db.event.listen(Content.__table__, 'after_create', db.DDL(
+    'CREATE VIRTUAL TABLE IF NOT EXISTS content_fts USING fts5(title, text)')
+    .execute_if(dialect='sqlite'))
+db.event.listen(Content.__table__, 'before_drop',
+        db.DDL('DROP TABLE IF EXISTS content_fts').execute_if(dialect='sqlite'))
+
+
+def _search_text_changed(target):
+    state = db.inspect(target)
+    return state.attrs.title.history.has_changes() or \
+            state.attrs.text.history.has_changes()
+
+
+@db.event.listens_for(Content, 'before_insert')
+@db.event.listens_for(Content, 'before_update')
+def _index_content_vector(mapper, connection, target):
+    """Compute the Postgres search vector of new or edited content within
+    the same INSERT or UPDATE statement"""
+    if connection.dialect.name != 'postgresql' or \
+            not _search_text_changed(target):
+        return
+    language = current_app.config['SEARCH_LANGUAGE']
+    title = db.func.setweight(db.func.to_tsvector(language,
+        target.title or ''), 'A')
+    text = db.func.setweight(db.func.to_tsvector(language,
+        target.text or ''), 'B')
+    target.search_vector = title.op('||')(text)
+
+
+@db.event.listens_for(Content, 'after_insert')
+@db.event.listens_for(Content, 'after_update')
+def _index_content_fts(mapper, connection, target):
+    """Replace the SQLite full text index row of new or edited content"""
+    if connection.dialect.name != 'sqlite' or \
+            not _search_text_changed(target):
+        return
+    connection.execute(content_fts.delete()
+            .where(content_fts.c.rowid == target.id))
+    connection.execute(content_fts.insert().values(rowid=target.id,
+        title=target.title, text=target.text or ''))
+
+
+@db.event.listens_for(Content, 'after_delete')
+def _unindex_content_fts(mapper, connection, target):
+    if connection.dialect.name == 'sqlite':
+        connection.execute(content_fts.delete()
+                .where(content_fts.c.rowid == target.id))
+
+
+class ContentRevision(IdMixin, PaginatedApiMixin, db.Model):
+    """Past versions of a content's title and text. Every update is stored
+    as a delta against the previous revision, except for every
+    CONTENT_HISTORY_SNAPSHOT_INTERVAL-th revision, which is a full snapshot,
+    so that rebuilding a revision never applies more deltas than that."""
+    __table_args__ = (
+        db.UniqueConstraint('content_id', 'revision'),
+    )
+    content_id = db.Column(db.Integer, db.ForeignKey('content.id'),
+            nullable=False)
+    revision = db.Column(db.Integer, nullable=False)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    title = db.Column(db.String(100), nullable=False)
+    snapshot = db.Column(db.Boolean, nullable=False)
+    # The full text of snapshots, and the make_delta delta of the others
+    data = db.deferred(db.Column(db.Text(), nullable=False))
+
+    @classmethod
+    def text_of(cls, content_id, revision):
+        """Return the revision and its text, or (None, None) if it doesn't
+        exist. Loads the nearest snapshot and the deltas after it in a single
+        query."""
+        snapshot = db.session.query(db.func.max(cls.revision)).filter(
+                cls.content_id == content_id, cls.snapshot.is_(True),
+                cls.revision <= revision).scalar_subquery()
+        rows = cls.query.options(undefer(cls.data)).filter(
+                cls.content_id == content_id, cls.revision >= snapshot,
+                cls.revision <= revision).order_by(cls.revision).all()
+        if not rows or rows[-1].revision != revision:
+            return None, None
+        return rows[-1], rebuild(rows[0].data, [r.data for r in rows[1:]])
+
+    def to_dict(self, text=None):
+        data = {
+            'revision': self.revision,
+            'title': self.title,
+            'created': self.created,
+        }
+        if text is not None:
+            data['text'] = text
+        return data
+
+
+def _revision_texts(connection, target):
+    """Return the text before and after the pending update of the content.
+    The previous text is None if it wasn't loaded before being replaced."""
+    state = db.inspect(target)
+    history = state.attrs.text.history
+    if history.has_changes():
+        return (history.deleted[0] if history.deleted else None), target.text
+    if 'text' in state.dict:
+        return target.text, target.text
+    # Unchanged and never loaded, so the stored text is still current
+    text = connection.scalar(db.select([Content.__table__.c.text])
+            .where(Content.__table__.c.id == target.id))
+    return text, text
+
+
+@db.event.listens_for(Content, 'before_update')
+def _count_content_revision(mapper, connection, target):
+    if _search_text_changed(target):
+        target.revision += 1
+
+
+def _insert_revision(connection, target, previous, text):
+    interval = current_app.config['CONTENT_HISTORY_SNAPSHOT_INTERVAL']
+    snapshot = previous is None or (target.revision - 1) % interval == 0
+    connection.execute(ContentRevision.__table__.insert().values(
+        content_id=target.id, revision=target.revision, title=target.title,
+        snapshot=snapshot,
+        data=(text or '') if snapshot else make_delta(previous, text)))
+
+
+@db.event.listens_for(Content, 'after_insert')
+def _record_first_content_revision(mapper, connection, target):
+    _insert_revision(connection, target, None, target.text)
+
+
+@db.event.listens_for(Content, 'after_update')
+def _record_content_revision(mapper, connection, target):
+    """Store the new revision of edited content"""
+    if _search_text_changed(target):
+        _insert_revision(connection, target,
+                *_revision_texts(connection, target))
+
+
+@db.event.listens_for(Content, 'before_delete')
+def _untag_deleted_content(mapper, connection, target):
+    """Remove the tags of deleted content, and decrement their counts"""
+    tag_ids = db.select([content_tags.c.tag_id]) \
+            .where(content_tags.c.content_id == target.id)
+    connection.execute(Tag.__table__.update()
+            .where(Tag.__table__.c.id.in_(tag_ids))
+            .values(content_count=Tag.__table__.c.content_count - 1))
+    connection.execute(content_tags.delete()
+            .where(content_tags.c.content_id == target.id))
+
+
+@db.event.listens_for(Content, 'before_delete')
+def _delete_content_revisions(mapper, connection, target):
+    connection.execute(ContentRevision.__table__.delete()
+            .where(ContentRevision.__table__.c.content_id == target.id))
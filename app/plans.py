@@ -0,0 +1,31 @@
+from statistics import median
+from time import perf_counter
+
+from app import db
+
+
+def query_plan(query):
+    """Return the lines of the database's plan for the query, from EXPLAIN
+    QUERY PLAN on SQLite and EXPLAIN elsewhere"""
+    dialect = db.engine.dialect
+    # Compile with named parameters, so they can be bound again with their
+    # types by text() whatever the driver's parameter style is
+    compiled = query.statement.compile(
+            dialect=type(dialect)(paramstyle='named'))
+    explain = 'EXPLAIN QUERY PLAN ' if dialect.name == 'sqlite' else 'EXPLAIN '
+    statement = db.text(explain + str(compiled)).bindparams(*[
+        db.bindparam(name, compiled.params[name], type_=bind.type)
+        for bind, name in compiled.bind_names.items()])
+    rows = db.session.execute(statement).fetchall()
+    return [row[-1] for row in rows]
+
+
+def time_query(query, repeat=5):
+    """Return the median seconds taken to fetch every row of the query"""
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        query.all()
+        times.append(perf_counter() - start)
+        db.session.expunge_all()
+    return median(times)
@@ -0,0 +1,85 @@
+from difflib import SequenceMatcher
+import json
+import random
+from time import perf_counter
+
+
+def make_delta(old, new):
+    """Return the delta turning the old text into the new one, as a compact
+    JSON list of operations: [start, end] copies those lines of the old
+    text, and a string is inserted as is."""
+    old_lines = (old or '').splitlines(True)
+    new_lines = (new or '').splitlines(True)
+    ops = []
+    matcher = SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(''.join(new_lines[j1:j2]))
+    return json.dumps(ops, separators=(',', ':'))
+
+
+def apply_delta(old, delta):
+    """Return the text made by applying a make_delta delta to the old text"""
+    old_lines = (old or '').splitlines(True)
+    parts = []
+    for op in json.loads(delta):
+        if isinstance(op, str):
+            parts.append(op)
+        else:
+            parts.extend(old_lines[op[0]:op[1]])
+    return ''.join(parts)
+
+
+def rebuild(snapshot, deltas):
+    """Return the text of a revision from the nearest full snapshot at or
+    before it, and the deltas of the revisions after that snapshot, oldest
+    first"""
+    text = snapshot
+    for delta in deltas:
+        text = apply_delta(text, delta)
+    return text
+
+
+def benchmark(lines=500, revisions=200, interval=20, edits=3, seed=0):
+    """Simulate a document edited revisions times, changing a few lines at
+    a time, and measure the revision store with a snapshot every interval
+    revisions.
+
+    :return: Dictionary of the bytes stored as full copies and as deltas
+        with snapshots, and the average and worst milliseconds taken to
+        rebuild a revision
+    """
+    rng = random.Random(seed)
+    document = ['Line %d of the document, with some words in it.\n' % i
+            for i in range(lines)]
+    texts, stored = [], []
+    for revision in range(1, revisions + 1):
+        if revision > 1:
+            for _ in range(edits):
+                position = rng.randrange(len(document))
+                if rng.random() < 0.5:
+                    document[position] = 'Edited in revision %d.\n' % revision
+                else:
+                    document.insert(position, 'Added in revision %d.\n' %
+                            revision)
+        texts.append(''.join(document))
+        if (revision - 1) % interval == 0:
+            stored.append((True, texts[-1]))
+        else:
+            stored.append((False, make_delta(texts[-2], texts[-1])))
+    timings = []
+    for revision in range(1, revisions + 1):
+        start = perf_counter()
+        base = revision - (revision - 1) % interval
+        text = rebuild(stored[base - 1][1],
+                [data for _, data in stored[base:revision]])
+        timings.append(perf_counter() - start)
+        assert text == texts[revision - 1]
+    return {
+        'full_bytes': sum(len(text.encode('utf-8')) for text in texts),
+        'stored_bytes': sum(len(data.encode('utf-8')) for _, data in stored),
+        'average_ms': sum(timings) / len(timings) * 1000,
+        'worst_ms': max(timings) * 1000,
+    }
@@ -0,0 +1,87 @@
+import os
+import random
+import sqlite3
+import tempfile
+from time import perf_counter
+import zlib
+
+
+# First byte of a stored value, telling how the rest of it is stored
+RAW = b'\x00'
+ZLIB = b'\x01'
+
+
+def pack_text(text, min_size=1024, level=6):
+    """Return the stored form of the text: zlib compressed if it is at least
+    min_size bytes and compression makes it smaller, otherwise as is"""
+    data = text.encode('utf-8')
+    if len(data) >= min_size:
+        compressed = zlib.compress(data, level)
+        if len(compressed) < len(data):
+            return ZLIB + compressed
+    return RAW + data
+
+
+def unpack_text(value):
+    """Return the text of a value stored by pack_text"""
+    value = bytes(value)
+    if value[:1] == ZLIB:
+        return zlib.decompress(value[1:]).decode('utf-8')
+    return value[1:].decode('utf-8')
+
+
+def article(size, rng):
+    """Return a repetitive article of about size characters, like the
+    content bodies"""
+    words = ['the', 'flight', 'airline', 'route', 'passenger', 'cargo',
+            'engine', 'boeing', 'airbus', 'fuel', 'runway', 'schedule',
+            'delay', 'airport', 'crew', 'cabin', 'seat', 'ticket']
+    paragraphs = []
+    length = 0
+    while length < size:
+        paragraph = ' '.join(rng.choice(words) for _ in range(60)) + '.\n\n'
+        paragraphs.append(paragraph)
+        length += len(paragraph)
+    return ''.join(paragraphs)[:size]
+
+
+def _measure(texts, pack=None):
+    """Return the bytes of a SQLite database holding the texts, and the
+    best seconds taken to read them all back"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'benchmark.db')
+        connection = sqlite3.connect(path)
+        try:
+            connection.execute('CREATE TABLE content (id INTEGER PRIMARY KEY, '
+                    'text BLOB)')
+            connection.executemany('INSERT INTO content (text) VALUES (?)',
+                    [(pack(text) if pack else text,) for text in texts])
+            connection.commit()
+            size = os.path.getsize(path)
+            times = []
+            for _ in range(5):
+                start = perf_counter()
+                for row in connection.execute('SELECT text FROM content'):
+                    if pack:
+                        unpack_text(row[0])
+                times.append(perf_counter() - start)
+        finally:
+            connection.close()
+    return size, min(times)
+
+
+def benchmark(items=500, size=20000, min_size=1024, level=6, seed=0):
+    """Compare a SQLite table of plain content text with one of compressed
+    text.
+
+    :return: Dictionary of the database bytes and the milliseconds taken to
+        read every text, for the 'plain' and 'compressed' tables
+    """
+    rng = random.Random(seed)
+    texts = [article(size, rng) for _ in range(items)]
+    results = {}
+    for name, pack in [('plain', None),
+            ('compressed', lambda text: pack_text(text, min_size, level))]:
+        table_bytes, seconds = _measure(texts, pack)
+        results[name] = {'bytes': table_bytes, 'read_ms': seconds * 1000}
+    return results
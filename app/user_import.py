@@ -0,0 +1,179 @@
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import json
+from time import perf_counter
+
+from flask import current_app
+from sqlalchemy import exc
+
+from app import db, password_hasher
+from app.hashing import hash_password
+from app.models import new_public_id, User
+
+
+REQUIRED_FIELDS = ('username', 'email', 'name', 'password')
+TEXT_FIELDS = REQUIRED_FIELDS + ('about_me',)
+
+
+def read_rows(stream, format):
+    """Yield (row dictionary, error) tuples from a CSV file with a header
+    line, or from a file with one JSON object per line (NDJSON). The error is
+    None unless the line couldn't be parsed."""
+    if format == 'csv':
+        for row in csv.DictReader(stream):
+            yield row, None
+        return
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line), None
+        except ValueError:
+            yield None, 'line %d is not valid JSON' % line_number
+
+
+def _field_error(row):
+    """Return why the row's fields can't be stored, or None if they can"""
+    for field in TEXT_FIELDS:
+        value = row.get(field)
+        if value is None:
+            continue
+        if not isinstance(value, str):
+            return '%s is not a string' % field
+        column = User.__table__.c.get(field)
+        if column is not None and column.type.length and \
+                len(value.strip()) > column.type.length:
+            return '%s is longer than %d characters' % (field,
+                    column.type.length)
+    return None
+
+
+def _chunks(rows, size):
+    chunk = []
+    for number, (row, error) in enumerate(rows, 1):
+        chunk.append((number, row, error))
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class UserImport():
+    """Imports users in chunks. Each chunk is validated, checked for taken
+    usernames and emails in a single query, hashed in a process pool, and
+    inserted with one executemany INSERT. Invalid rows are collected in
+    errors as (row number, message) tuples instead of stopping the import.
+    """
+
+    def __init__(self, batch_size=1000, workers=None):
+        self.batch_size = batch_size
+        self.workers = workers
+        self.imported = 0
+        self.errors = []
+        self.seconds = 0.0
+        self._seen = set()
+
+    @property
+    def rows_per_second(self):
+        return self.imported / self.seconds if self.seconds else 0.0
+
+    def run(self, rows):
+        """Import the (row, error) tuples yielded by read_rows"""
+        start = perf_counter()
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            for chunk in _chunks(rows, self.batch_size):
+                self._import_chunk(pool, chunk)
+        self.seconds = perf_counter() - start
+        return self
+
+    def _clean(self, number, row, error):
+        """Return the normalized row, or None after recording its error"""
+        if error is None and not isinstance(row, dict):
+            error = 'row is not an object'
+        elif error is None:
+            missing = [f for f in REQUIRED_FIELDS if not row.get(f)]
+            if missing:
+                error = 'missing %s' % ', '.join(missing)
+            else:
+                error = _field_error(row)
+        if error:
+            self.errors.append((number, error))
+            return None
+        user = {
+            'username': row['username'].lower().strip(),
+            'email': row['email'].lower().strip(),
+            'name': row['name'].strip(),
+            'about_me': (row.get('about_me') or '').strip() or None,
+            'password': row['password'],
+        }
+        if user['username'] in current_app.config['BLOCKED_USERNAMES']:
+            error = 'username %s is blocked' % user['username']
+        elif ('username', user['username']) in self._seen:
+            error = 'username %s is repeated' % user['username']
+        elif ('email', user['email']) in self._seen:
+            error = 'email %s is repeated' % user['email']
+        if error:
+            self.errors.append((number, error))
+            return None
+        self._seen.add(('username', user['username']))
+        self._seen.add(('email', user['email']))
+        return user
+
+    def _remove_taken(self, users):
+        """Drop the users whose username or email already exists, using a
+        single query for the whole chunk"""
+        usernames = [u['username'] for u in users.values()]
+        emails = [u['email'] for u in users.values()]
+        taken = User.query.with_entities(User.username, User.email).filter(
+                db.or_(User.username.in_(usernames), User.email.in_(emails)))
+        taken_usernames, taken_emails = set(), set()
+        for username, email in taken:
+            taken_usernames.add(username)
+            taken_emails.add(email)
+        for number, user in list(users.items()):
+            if user['username'] in taken_usernames:
+                self.errors.append((number, 'username %s is taken' %
+                    user['username']))
+                del users[number]
+            elif user['email'] in taken_emails:
+                self.errors.append((number, 'email %s is taken' %
+                    user['email']))
+                del users[number]
+
+    def _import_chunk(self, pool, chunk):
+        users = {}
+        for number, row, error in chunk:
+            user = self._clean(number, row, error)
+            if user is not None:
+                users[number] = user
+        if users:
+            self._remove_taken(users)
+        if not users:
+            return
+        settings = password_hasher.settings
+        passwords = [user.pop('password') for user in users.values()]
+        hashes = pool.map(hash_password, passwords, [settings] * len(users),
+                chunksize=16)
+        admins = current_app.config['ADMINS']
+        for user, (password_hash, _) in zip(users.values(), hashes):
+            user['password_hash'] = password_hash
+            user['public_id'] = new_public_id()
+            user['group'] = 'admin' if user['email'] in admins else 'user'
+        try:
+            db.session.execute(User.__table__.insert(), list(users.values()))
+            db.session.commit()
+            self.imported += len(users)
+        except exc.DBAPIError:
+            # Someone took a username or email since the check, or the
+            # database refused a value; find out which rows are affected by
+            # inserting them one by one
+            db.session.rollback()
+            for number, user in users.items():
+                try:
+                    db.session.execute(User.__table__.insert(), user)
+                    db.session.commit()
+                    self.imported += 1
+                except exc.DBAPIError as e:
+                    db.session.rollback()
+                    self.errors.append((number, str(e.orig)))
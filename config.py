@@ -20,11 +20,85 @@ class BaseConfig:
     MAILGUN_API = ''
 
     ITEMS_PER_PAGE = 25
+    EXPORT_BATCH_SIZE = 1000        # Rows fetched per batch by NDJSON exports
+    SEARCH_LANGUAGE = 'english'     # Postgres text search configuration
+    # Every Nth content revision is stored in full instead of as a delta,
+    # which bounds the deltas applied to rebuild a revision
+    CONTENT_HISTORY_SNAPSHOT_INTERVAL = 20
+    # How collections count their total items: 'exact' runs COUNT(*),
+    # 'cached' keeps exact counts in Redis until the tables are written to or
+    # the TTL passes, and 'estimated' uses the Postgres planner's row estimate
+    COLLECTION_COUNT = os.environ.get('COLLECTION_COUNT') or 'exact'
+    COLLECTION_COUNT_TTL = 60       # Seconds
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Encoder used by jsonify: 'orjson' (C accelerated, when installed),
+    # 'stdlib', or 'auto' for orjson if it's installed. Both write datetimes
+    # as ISO 8601 in UTC. Compare them with `flask json benchmark`.
+    JSON_ENCODER = os.environ.get('JSON_ENCODER') or 'auto'
+
+    # Response compression with brotli (if installed) or gzip. Leave it off
+    # when a proxy in front of uwsgi already compresses responses.
+    COMPRESS_RESPONSES = os.environ.get('COMPRESS_RESPONSES') is not None
+    COMPRESS_MIN_SIZE = 1024        # Bytes; smaller bodies are sent as is
+    COMPRESS_LEVEL = 6              # gzip level, 1 (fast) to 9 (small)
+    COMPRESS_BROTLI_QUALITY = 4     # 0 (fast) to 11 (small)
+    COMPRESS_MIMETYPES = ('application/json',)
+    # Content text of at least this many bytes is stored compressed, except
+    # on Postgres, which compresses large values itself
+    TEXT_COMPRESS_MIN_SIZE = 1024
+    TEXT_COMPRESS_LEVEL = 6         # zlib level, 1 (fast) to 9 (small)
 
     # Redis database
     REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
 
+    # API token mode: 'opaque' stores a random token on the user row, while
+    # 'jwt' issues short lived signed access tokens that are verified without
+    # a database lookup, plus a database backed refresh token
+    TOKEN_MODE = os.environ.get('TOKEN_MODE') or 'opaque'
+    ACCESS_TOKEN_EXPIRES = 60*15            # Seconds
+    REFRESH_TOKEN_EXPIRES = 60*60*24*7      # Seconds
+
+    # API token cache: per-worker LRU in front of a shared Redis tier
+    TOKEN_CACHE_ENABLED = True
+    TOKEN_CACHE_SIZE = 4096         # Max tokens held by each worker
+    TOKEN_CACHE_LOCAL_TTL = 10      # Seconds; bounds staleness across workers
+    TOKEN_CACHE_REDIS = True
+    TOKEN_CACHE_REDIS_TTL = 300     # Seconds
+
+    # Cache of public content responses. An expired entry is served for the
+    # grace period while one worker rebuilds it. The optional per-worker tier
+    # isn't cleared by writes in other workers, so keep its TTL short.
+    RESPONSE_CACHE_ENABLED = True
+    RESPONSE_CACHE_TTL = 30             # Seconds
+    RESPONSE_CACHE_GRACE = 30           # Seconds
+    RESPONSE_CACHE_LOCK_TIMEOUT = 5     # Seconds
+    RESPONSE_CACHE_LOCAL_TTL = 0        # Seconds; 0 disables the local tier
+    RESPONSE_CACHE_LOCAL_SIZE = 256     # Max responses held by each worker
+
+    # Redis sets of each user's followers and followed users
+    FOLLOW_GRAPH_TTL = 60*60*24     # Seconds a set stays in Redis
+
+    # Argon2 process pool, per uwsgi process. Each hash uses ~128 MB of memory
+    PASSWORD_HASH_WORKERS = 2       # 0 hashes inline in the request thread
+    PASSWORD_HASH_QUEUE_DEPTH = 4   # Requests waiting beyond this get a 503
+    PASSWORD_HASH_TIMEOUT = 30      # Seconds
+
+    # Named argon2 parameter sets; memory_cost is in KiB. Tune them for your
+    # hardware with `flask hash calibrate`. Users whose hash was made with a
+    # different profile are transparently rehashed on their next login.
+    PASSWORD_HASH_PROFILES = {
+        'default': dict(rounds=10, digest_size=32, salt_size=32,
+            memory_cost=128000),
+        'interactive': dict(rounds=3, digest_size=32, salt_size=32,
+            memory_cost=65536),
+        'sensitive': dict(rounds=4, digest_size=32, salt_size=32,
+            memory_cost=262144),
+        'testing': dict(rounds=1, digest_size=16, salt_size=16,
+            memory_cost=1024),
+    }
+    PASSWORD_HASH_PROFILE = os.environ.get('PASSWORD_HASH_PROFILE') or 'default'
+    PASSWORD_REHASH_ON_LOGIN = True
+
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
@@ -33,10 +107,10 @@ class BaseConfig:
     OUTBOUND_EMAIL = 'hello@flasker.com'    # Change this to your outbound email
     FEEDBACK_EMAILS = ADMINS    # Email list where contact forms should be sent
 
-    BLOCKED_USERNAMES = [
+    BLOCKED_USERNAMES = frozenset([
         'admin', 'python', 'python3', 'postgres', 'sqlite', 'sqlite3', 'root',
         'url', 'ubuntu', 'debian', 'docker', 'flask', 'com', APP_NICKNAME,
-    ]
+    ])
 
 
 class DevelopmentDockerConfig(BaseConfig):
@@ -63,6 +137,8 @@ class TestingConfig(BaseConfig):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
     REDIS_URL = 'redis://'
+    PASSWORD_HASH_WORKERS = 0
+    PASSWORD_HASH_PROFILE = 'testing'
 
 
 class ProductionConfig(BaseConfig):
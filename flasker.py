@@ -1,7 +1,8 @@
-from app import create_app, db
+from app import cli, create_app, db
 from app.models import User, Notification, Task
 
 app = create_app()
+cli.register(app)
 
 
 @app.shell_context_processor
@@ -0,0 +1,60 @@
+"""compress content text
+
+Revision ID: 7b8a7e6b78ec
+Revises: d1ba31b7aab0
+Create Date: 2026-10-18 20:52:48.597897
+
+"""
+import zlib
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b8a7e6b78ec'
+down_revision = 'd1ba31b7aab0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Postgres keeps the text column, which TOAST compresses already
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return
+    with op.batch_alter_table('content') as batch_op:
+        batch_op.alter_column('text', existing_type=sa.Text(),
+                              type_=sa.LargeBinary(), existing_nullable=True)
+    # Mark the existing text as stored uncompressed; flask content
+    # repack-text then compresses the large bodies
+    if dialect == 'sqlite':
+        op.execute("UPDATE content SET text = "
+                   "CAST(X'00' || CAST(text AS BLOB) AS BLOB) "
+                   "WHERE text IS NOT NULL")
+    else:
+        op.execute("UPDATE content SET text = CONCAT(X'00', text) "
+                   "WHERE text IS NOT NULL")
+
+
+def downgrade():
+    connection = op.get_bind()
+    if connection.dialect.name == 'postgresql':
+        return
+    content = sa.table('content', sa.column('id', sa.Integer()),
+                       sa.column('text', sa.LargeBinary()))
+    rows = connection.execute(sa.select([content.c.id, content.c.text])
+                              .where(content.c.text.isnot(None))).fetchall()
+    with op.batch_alter_table('content') as batch_op:
+        batch_op.alter_column('text', existing_type=sa.LargeBinary(),
+                              type_=sa.Text(), existing_nullable=True)
+    text = sa.table('content', sa.column('id', sa.Integer()),
+                    sa.column('text', sa.Text()))
+    for id, value in rows:
+        value = bytes(value)
+        if value[:1] == b'\x01':
+            value = zlib.decompress(value[1:])
+        else:
+            value = value[1:]
+        connection.execute(text.update().where(text.c.id == id)
+                           .values(text=value.decode('utf-8')))
@@ -0,0 +1,44 @@
+"""add full text search of content
+
+Revision ID: a41c7d2e9b63
+Revises: 5e7a0c3d9f12
+Create Date: 2026-10-18 21:02:13.604518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'a41c7d2e9b63'
+down_revision = '5e7a0c3d9f12'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    op.add_column('content', sa.Column('search_vector',
+        postgresql.TSVECTOR() if dialect == 'postgresql' else sa.Text(),
+        nullable=True))
+    if dialect == 'postgresql':
+        # Index the existing content; the app keeps it up to date from here.
+        # Uses the default SEARCH_LANGUAGE.
+        op.execute("UPDATE content SET search_vector = "
+                   "setweight(to_tsvector('english', title), 'A') || "
+                   "setweight(to_tsvector('english', coalesce(text, '')), 'B')")
+    op.create_index('ix_content_search_vector', 'content', ['search_vector'],
+                    unique=False, postgresql_using='gin')
+    if dialect == 'sqlite':
+        op.execute('CREATE VIRTUAL TABLE content_fts USING fts5(title, text)')
+        op.execute("INSERT INTO content_fts (rowid, title, text) "
+                   "SELECT id, title, coalesce(text, '') FROM content")
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        op.execute('DROP TABLE content_fts')
+    op.drop_index('ix_content_search_vector', table_name='content')
+    with op.batch_alter_table('content') as batch_op:
+        batch_op.drop_column('search_vector')
@@ -0,0 +1,34 @@
+"""add notification upsert key
+
+Revision ID: bf3932473589
+Revises: 7b8a7e6b78ec
+Create Date: 2026-10-18 20:55:40.870689
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'bf3932473589'
+down_revision = '7b8a7e6b78ec'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Keep only the newest notification of each name, which is all
+    # add_notification ever left behind
+    op.execute('DELETE FROM notification WHERE id NOT IN '
+               '(SELECT max(id) FROM notification GROUP BY user_id, name)')
+    op.create_index('ix_notification_user_id_timestamp', 'notification', ['user_id', 'timestamp'], unique=False)
+    with op.batch_alter_table('notification') as batch_op:
+        batch_op.create_unique_constraint('uq_notification_user_id_name',
+                                          ['user_id', 'name'])
+
+
+def downgrade():
+    with op.batch_alter_table('notification') as batch_op:
+        batch_op.drop_constraint('uq_notification_user_id_name',
+                                 type_='unique')
+    op.drop_index('ix_notification_user_id_timestamp', table_name='notification')
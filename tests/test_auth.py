@@ -186,6 +186,94 @@ class UserApiCase(BaseTestCase):
                 headers={'Authorization': 'Bearer ' + user_token_json['token']})
         self.assertEqual(users.status_code, 401)
 
+    def test_token_cache(self):
+        """Test that repeated token lookups are served from the token cache,
+        and that a group change is seen on the next request."""
+        _register_user(self.client)
+        user_token = self.client.post('/v1/tokens',
+                headers={'Authorization': 'Basic ' +
+                    base64.b64encode(('josh:secret')
+                        .encode('utf-8')).decode('utf-8')})
+        headers = {'Authorization': 'Bearer ' + user_token.get_json()['token']}
+
+        for _ in range(3):
+            users = self.client.get('/v1/users', headers=headers)
+            self.assertEqual(users.status_code, 200)
+        metrics = self.client.get('/v1/metrics', headers=headers)
+        self.assertEqual(metrics.status_code, 200)
+        token_stats = metrics.get_json()['token_cache']
+        self.assertEqual(token_stats['misses'], 1)
+        self.assertEqual(token_stats['local_hits'], 3)
+
+        # Demote the user; the cached admin group must not be used anymore
+        from app import db
+        from app.models import User
+        user = User.query.filter_by(username='josh').first()
+        user.group = 'user'
+        db.session.commit()
+        metrics = self.client.get('/v1/metrics', headers=headers)
+        self.assertEqual(metrics.status_code, 403)
+
+    def test_token_cache_invalidated_on_commit(self):
+        """Test that a revoked token is only dropped from the token cache once
+        the revocation is committed, so that no request can cache the still
+        active row again in between."""
+        from app import db, token_cache
+        from app.models import User
+        _register_user(self.client)
+        token = self.client.post('/v1/tokens',
+                headers={'Authorization': 'Basic ' +
+                    base64.b64encode(('josh:secret')
+                        .encode('utf-8')).decode('utf-8')}).get_json()['token']
+        user = User.check_token(token)
+        self.assertIsNotNone(token_cache.get(token, User.__table__.columns))
+
+        user.revoke_token()
+        db.session.flush()
+        self.assertIsNotNone(token_cache.get(token, User.__table__.columns))
+        db.session.commit()
+        self.assertIsNone(token_cache.get(token, User.__table__.columns))
+        users = self.client.get('/v1/users',
+                headers={'Authorization': 'Bearer ' + token})
+        self.assertEqual(users.status_code, 401)
+
+    def test_jwt_tokens(self):
+        """Test the signed access token mode, including refreshing and
+        revoking the access token."""
+        self.app.config['TOKEN_MODE'] = 'jwt'
+        _register_user(self.client)
+        user_token = self.client.post('/v1/tokens',
+                headers={'Authorization': 'Basic ' +
+                    base64.b64encode(('josh:secret')
+                        .encode('utf-8')).decode('utf-8')})
+        self.assertEqual(user_token.status_code, 200)
+        user_token_json = user_token.get_json()
+        self.assertTrue(user_token_json['refresh_token'])
+        headers = {'Authorization': 'Bearer ' + user_token_json['token']}
+
+        users = self.client.get('/v1/users', headers=headers)
+        self.assertEqual(users.status_code, 200)
+
+        # The refresh token is not an access token
+        users = self.client.get('/v1/users', headers={
+            'Authorization': 'Bearer ' + user_token_json['refresh_token']})
+        self.assertEqual(users.status_code, 401)
+
+        refreshed = self.client.post('/v1/tokens/refresh',
+                json={'refresh_token': user_token_json['refresh_token']})
+        self.assertEqual(refreshed.status_code, 200)
+        users = self.client.get('/v1/users', headers={
+            'Authorization': 'Bearer ' + refreshed.get_json()['token']})
+        self.assertEqual(users.status_code, 200)
+
+        revokation = self.client.delete('/v1/tokens', headers=headers)
+        self.assertEqual(revokation.status_code, 204)
+        users = self.client.get('/v1/users', headers=headers)
+        self.assertEqual(users.status_code, 401)
+        refreshed = self.client.post('/v1/tokens/refresh',
+                json={'refresh_token': user_token_json['refresh_token']})
+        self.assertEqual(refreshed.status_code, 401)
+
 
 if __name__ == '__main__':
     unittest.main()
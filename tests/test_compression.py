@@ -0,0 +1,80 @@
+import base64
+import gzip
+import sys
+import unittest
+
+sys.path.append('../')
+from app import compress    # NOQA
+from app.api.v1.planes import catalog   # NOQA
+from tests.base import BaseTestCase     # NOQA
+
+
+class CompressionCase(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        compress.enabled = True
+
+    def _add_content(self, count):
+        self.client.post('/v1/users', json={
+            'username': 'josh', 'email': 'josh@joshschertz.com',
+            'name': 'Josh', 'password': 'secret'})
+        user_token = self.client.post('/v1/tokens',
+                headers={'Authorization': 'Basic ' +
+                    base64.b64encode(('josh:secret')
+                        .encode('utf-8')).decode('utf-8')})
+        headers = {'Authorization': 'Bearer ' + user_token.get_json()['token']}
+        for i in range(count):
+            self.client.post('/v1/content', headers=headers,
+                    json={'title': 'Content %d' % i, 'text': 'Hello world'})
+
+    def test_compress_collection(self):
+        """Test that large collections are gzipped for clients accepting it,
+        and that conditional requests still work."""
+        self._add_content(20)
+        plain = self.client.get('/v1/content?per_page=20&text=true')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+
+        response = self.client.get('/v1/content?per_page=20&text=true',
+                headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+        self.assertLess(len(response.data), len(plain.data))
+        self.assertTrue(response.headers['ETag'].startswith('W/'))
+
+        response = self.client.get('/v1/content?per_page=20&text=true',
+                headers={'Accept-Encoding': 'gzip',
+                    'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_compress_skips_small_responses(self):
+        """Test that small responses, such as errors, are not compressed."""
+        response = self.client.get('/v1/content/missing',
+                headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self._add_content(1)
+        response = self.client.get('/v1/content',
+                headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_precompressed_catalog(self):
+        """Test that the planes catalog is compressed once and then served
+        from memory."""
+        compress.min_size = 100
+        plain = self.client.get('/v1/planes')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        response = self.client.get('/v1/planes',
+                headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+        self.assertIs(catalog._body('gzip'), catalog._body('gzip'))
+        response = self.client.get('/v1/planes',
+                headers={'Accept-Encoding': 'gzip',
+                    'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,14 @@
+from datetime import date, datetime
+import json
 import sys
 import unittest
 
 from flask import current_app
+from flask import json as flask_json
 
 sys.path.append('../')
 from app import create_app  # NOQA
+from app.encoders import available_encoders, configure_json, JSON_ENCODERS  # NOQA
 from config import DevelopmentConfig, ProductionConfig, TestingConfig   # NOQA
 
 
@@ -27,6 +31,22 @@ class TestTestingConfig(unittest.TestCase):
         self.assertTrue(self.app.config['TESTING'])
         self.assertTrue(self.app.config['SQLALCHEMY_DATABASE_URI'] == 'sqlite://')
 
+    def test_json_encoders(self):
+        """Test that every JSON encoder writes the same ISO 8601 output."""
+        data = {'created': datetime(2021, 5, 1, 12, 30, 15, 250),
+                'day': date(2021, 5, 1), 'big': 2**70, 'name': 'caf\xe9'}
+        outputs = set()
+        for name in available_encoders():
+            self.app.config['JSON_ENCODER'] = name
+            configure_json(self.app)
+            self.assertIs(self.app.json_encoder, JSON_ENCODERS[name])
+            with self.app.app_context():
+                outputs.add(json.dumps(json.loads(flask_json.dumps(data)),
+                    sort_keys=True))
+        self.assertEqual(len(outputs), 1)
+        self.assertEqual(json.loads(outputs.pop())['created'],
+                '2021-05-01T12:30:15.000250+00:00')
+
 
 class TestProductionConfig(unittest.TestCase):
 
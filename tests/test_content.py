@@ -0,0 +1,555 @@
+import base64
+from datetime import datetime, timezone
+import json
+import sys
+import unittest
+
+sys.path.append('../')
+from app import db                      # NOQA
+from app.models import Content, ContentRevision, User  # NOQA
+from app.plans import query_plan        # NOQA
+from tests.base import BaseTestCase     # NOQA
+
+
+def _admin_headers(client):
+    """Register the admin user and return the headers with their token"""
+    client.post('/v1/users', json={
+        'username': 'josh', 'email': 'josh@joshschertz.com',
+        'name': 'Josh', 'password': 'secret'})
+    user_token = client.post('/v1/tokens',
+            headers={'Authorization': 'Basic ' +
+                base64.b64encode(('josh:secret')
+                    .encode('utf-8')).decode('utf-8')})
+    return {'Authorization': 'Bearer ' + user_token.get_json()['token']}
+
+
+class ContentApiCase(BaseTestCase):
+
+    def test_content(self):
+        """Test creating, listing, editing, and deleting content."""
+        headers = _admin_headers(self.client)
+        response = self.client.post('/v1/content', headers=headers,
+                json={'title': 'First', 'text': 'Hello world'})
+        self.assertEqual(response.status_code, 201)
+        public_id = response.get_json()['public_id']
+        self.assertEqual(response.headers['Location'],
+                'http://localhost/v1/content/%s' % public_id)
+
+        content = self.client.get('/v1/content/%s' % public_id).get_json()
+        self.assertEqual(content['title'], 'First')
+        self.assertEqual(content['username'], 'josh')
+        self.assertEqual(content['text'], 'Hello world')
+        self.assertEqual(datetime.fromisoformat(content['created']).tzinfo,
+                timezone.utc)
+
+        collection = self.client.get('/v1/content').get_json()
+        self.assertEqual(collection['_meta']['total_items'], 1)
+        self.assertNotIn('text', collection['items'][0])
+        collection = self.client.get('/v1/content?text=true').get_json()
+        self.assertEqual(collection['items'][0]['text'], 'Hello world')
+
+        response = self.client.put('/v1/content/%s' % public_id,
+                headers=headers, json={'title': 'Second'})
+        self.assertEqual(response.get_json()['title'], 'Second')
+        response = self.client.delete('/v1/content/%s' % public_id,
+                headers=headers)
+        self.assertEqual(response.status_code, 204)
+        response = self.client.get('/v1/content/%s' % public_id)
+        self.assertEqual(response.status_code, 404)
+
+    def test_content_sparse_fields(self):
+        """Test that ?fields= limits the serialized content fields."""
+        headers = _admin_headers(self.client)
+        public_id = self.client.post('/v1/content', headers=headers,
+                json={'title': 'First', 'text': 'Hello world'}) \
+                .get_json()['public_id']
+        content = self.client.get('/v1/content/%s?fields=title' %
+                public_id).get_json()
+        self.assertEqual(content, {'title': 'First'})
+        collection = self.client.get('/v1/content?fields=title,text') \
+                .get_json()
+        self.assertEqual(collection['items'],
+                [{'title': 'First', 'text': 'Hello world'}])
+        response = self.client.get('/v1/content?fields=body')
+        self.assertEqual(response.status_code, 400)
+
+    def test_content_conditional_get(self):
+        """Test the ETag and Last-Modified validators of content, and that
+        they change when the content does."""
+        headers = _admin_headers(self.client)
+        public_id = self.client.post('/v1/content', headers=headers,
+                json={'title': 'First', 'text': 'Hello world'}) \
+                .get_json()['public_id']
+        response = self.client.get('/v1/content/%s' % public_id)
+        etag = response.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        last_modified = response.headers['Last-Modified']
+
+        response = self.client.get('/v1/content/%s' % public_id,
+                headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        response = self.client.get('/v1/content/%s' % public_id,
+                headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+        # Each set of fields is a different representation
+        response = self.client.get('/v1/content/%s?fields=title' % public_id,
+                headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+        collection = self.client.get('/v1/content')
+        collection_etag = collection.headers['ETag']
+        response = self.client.get('/v1/content',
+                headers={'If-None-Match': collection_etag})
+        self.assertEqual(response.status_code, 304)
+
+        self.client.put('/v1/content/%s' % public_id, headers=headers,
+                json={'title': 'Second'})
+        response = self.client.get('/v1/content/%s' % public_id,
+                headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        response = self.client.get('/v1/content',
+                headers={'If-None-Match': collection_etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_content_response_cache(self):
+        """Test that public content reads are served from the response cache
+        and that writes invalidate it."""
+        from app import response_cache
+        self.app.config['RESPONSE_CACHE_LOCAL_TTL'] = 10
+        response_cache.init_app(self.app)
+        headers = _admin_headers(self.client)
+        public_id = self.client.post('/v1/content', headers=headers,
+                json={'title': 'First', 'text': 'Hello world'}) \
+                .get_json()['public_id']
+        for _ in range(3):
+            content = self.client.get('/v1/content/%s' % public_id)
+            self.assertEqual(content.get_json()['title'], 'First')
+        # The order of the arguments doesn't matter
+        self.client.get('/v1/content?per_page=5&text=true')
+        collection = self.client.get('/v1/content?text=true&per_page=5')
+        self.assertEqual(collection.get_json()['items'][0]['text'],
+                'Hello world')
+        stats = response_cache.stats()
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['local_hits'], 3)
+        response = self.client.get('/v1/content/%s' % public_id,
+                headers={'If-None-Match': content.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+        self.client.put('/v1/content/%s' % public_id, headers=headers,
+                json={'title': 'Second'})
+        content = self.client.get('/v1/content/%s' % public_id)
+        self.assertEqual(content.get_json()['title'], 'Second')
+        collection = self.client.get('/v1/content?text=true&per_page=5')
+        self.assertEqual(collection.get_json()['items'][0]['title'], 'Second')
+
+        # Renaming the author changes the cached content too
+        josh = User.query.filter_by(username='josh').first()
+        self.client.put('/v1/users/%s' % josh.public_id, headers=headers,
+                json={'username': 'joshua'})
+        content = self.client.get('/v1/content/%s' % public_id)
+        self.assertEqual(content.get_json()['username'], 'joshua')
+        collection = self.client.get('/v1/content?text=true&per_page=5')
+        self.assertEqual(collection.get_json()['items'][0]['username'],
+                'joshua')
+
+        # Deleting the author deletes their cached content
+        db.session.delete(User.query.filter_by(username='joshua').first())
+        db.session.commit()
+        content = self.client.get('/v1/content/%s' % public_id)
+        self.assertEqual(content.status_code, 404)
+        collection = self.client.get('/v1/content?text=true&per_page=5')
+        self.assertEqual(collection.get_json()['items'], [])
+
+    def test_content_export(self):
+        """Test streaming all content as NDJSON, and only the content changed
+        since a time."""
+        headers = _admin_headers(self.client)
+        for title in ['First', 'Second']:
+            self.client.post('/v1/content', headers=headers,
+                    json={'title': title, 'text': 'Hello world'})
+        response = self.client.get('/v1/content/export', headers=headers)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertTrue(response.is_streamed)
+        rows = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEqual([row['title'] for row in rows], ['First', 'Second'])
+        self.assertEqual(rows[0]['username'], 'josh')
+        self.assertEqual(rows[0]['text'], 'Hello world')
+
+        since = datetime.utcnow().isoformat()
+        self.client.put('/v1/content/%s' % rows[0]['public_id'],
+                headers=headers, json={'title': 'Third'})
+        response = self.client.get('/v1/content/export?since=%s' % since,
+                headers=headers)
+        rows = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEqual([row['title'] for row in rows], ['Third'])
+        response = self.client.get('/v1/content/export?since=yesterday',
+                headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_content_search(self):
+        """Test ranked full text search over the title and text, and that
+        the index follows edits and deletes."""
+        headers = _admin_headers(self.client)
+        ids = {}
+        for title, text in [
+                ('Flying the 747', 'The jumbo jet flies long haul routes.'),
+                ('Jet engines', 'How a jet engine works, jet by jet.'),
+                ('Gardening', 'Planting tomatoes in spring.')]:
+            ids[title] = self.client.post('/v1/content', headers=headers,
+                    json={'title': title, 'text': text}).get_json()['public_id']
+
+        results = self.client.get('/v1/content/search?q=jet').get_json()
+        self.assertEqual([item['title'] for item in results['items']],
+                ['Jet engines', 'Flying the 747'])
+        self.assertEqual(results['_meta']['total_items'], 2)
+        self.assertIn('<mark>jet</mark>', results['items'][0]['snippet'])
+        self.assertNotIn('text', results['items'][0])
+        self.assertIn('q=jet', results['_links']['self'])
+
+        results = self.client.get('/v1/content/search?q=jumbo+jet&per_page=1'
+                '&fields=title').get_json()
+        self.assertEqual(results['items'][0]['title'], 'Flying the 747')
+        self.assertEqual(set(results['items'][0]), {'title', 'rank', 'snippet'})
+        results = self.client.get('/v1/content/search?q=jet&per_page=0')
+        self.assertEqual(results.status_code, 200)
+        self.assertEqual(results.get_json()['_meta']['total_pages'], 2)
+        # Query syntax is searched for as words
+        response = self.client.get('/v1/content/search?q="jet')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get('/v1/content/search')
+        self.assertEqual(response.status_code, 400)
+
+        self.client.put('/v1/content/%s' % ids['Gardening'], headers=headers,
+                json={'text': 'Planting a jet black rose.'})
+        self.client.delete('/v1/content/%s' % ids['Jet engines'],
+                headers=headers)
+        results = self.client.get('/v1/content/search?q=jet').get_json()
+        self.assertEqual(sorted(item['title'] for item in results['items']),
+                ['Flying the 747', 'Gardening'])
+
+    def test_content_listing(self):
+        """Test filtering and sorting the content listing, and that the
+        filters are answered from their composite indexes."""
+        headers = _admin_headers(self.client)
+        self.client.post('/v1/users', json={
+            'username': 'sara', 'email': 'sara@joshschertz.com',
+            'name': 'Sara', 'password': 'secret'})
+        sara = User.query.filter_by(username='sara').first()
+        for title, comments, user_id in [('Bravo', True, None),
+                ('Alpha', False, sara.id), ('Charlie', True, sara.id)]:
+            data = {'title': title, 'comments': comments}
+            if user_id:
+                data['user_id'] = user_id
+            self.client.post('/v1/content', headers=headers, json=data)
+
+        def titles(url):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            return [item['title'] for item in response.get_json()['items']]
+        self.assertEqual(titles('/v1/content'), ['Bravo', 'Alpha', 'Charlie'])
+        self.assertEqual(titles('/v1/content?sort=-created'),
+                ['Charlie', 'Alpha', 'Bravo'])
+        self.assertEqual(titles('/v1/content?sort=title'),
+                ['Alpha', 'Bravo', 'Charlie'])
+        self.assertEqual(titles('/v1/content?author=sara'),
+                ['Alpha', 'Charlie'])
+        self.assertEqual(titles('/v1/content?author=nobody'), [])
+        self.assertEqual(titles('/v1/content?comments=false'), ['Alpha'])
+        self.assertEqual(titles('/v1/content?author=sara&comments=true'),
+                ['Charlie'])
+        created = Content.query.filter_by(title='Alpha').first().created
+        self.assertEqual(titles('/v1/content?created_after=%s' %
+            created.isoformat()), ['Alpha', 'Charlie'])
+        self.assertEqual(titles('/v1/content?created_before=%s' %
+            created.isoformat()), ['Bravo'])
+
+        # Descending keyset pages keep the filters in their links
+        page = self.client.get('/v1/content?sort=-title&pagination=cursor'
+                '&per_page=1&comments=true').get_json()
+        self.assertEqual(page['items'][0]['title'], 'Charlie')
+        self.assertIn('comments=true', page['_links']['next'])
+        page = self.client.get(page['_links']['next']).get_json()
+        self.assertEqual(page['items'][0]['title'], 'Bravo')
+        self.assertIsNone(page['_links']['next'])
+        page = self.client.get(page['_links']['prev']).get_json()
+        self.assertEqual(page['items'][0]['title'], 'Charlie')
+
+        response = self.client.get('/v1/content?sort=text')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/v1/content?created_after=today')
+        self.assertEqual(response.status_code, 400)
+
+        plan = ' '.join(query_plan(Content.listing(author='sara')[0]))
+        self.assertIn('ix_content_user_id_created_id', plan)
+        plan = ' '.join(query_plan(Content.listing(comments=True)[0]))
+        self.assertIn('ix_content_comments_created_id', plan)
+
+    def test_content_query_count(self):
+        """Test that a page of content is served in the same number of
+        queries however many authors it has, and without the text."""
+        from sqlalchemy import event
+        from app import db
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        def count_queries(url):
+            db.session.expunge_all()    # Authors must not come from the session
+            del statements[:]
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                response = self.client.get(url)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+            self.assertEqual(response.status_code, 200)
+            return len(statements)
+
+        def add_content(count):
+            for number in range(count):
+                user = User(username='user%d' % number, public_id='p%d' % number,
+                        email='user%d@joshschertz.com' % number, group='user',
+                        password_hash='-')
+                db.session.add(user)
+                db.session.flush()
+                db.session.add(Content(title='Shared title %d' % number,
+                    text='Shared text', user_id=user.id,
+                    public_id='c%d' % number))
+            db.session.commit()
+
+        urls = ['/v1/content', '/v1/content?pagination=cursor',
+                '/v1/content?fields=title,username', '/v1/content/search?q=shared']
+        add_content(2)
+        few = [count_queries(url) for url in urls]
+        db.session.query(ContentRevision).delete()
+        db.session.query(Content).delete()
+        db.session.query(User).delete()
+        db.session.commit()
+        add_content(20)
+        self.assertEqual([count_queries(url) for url in urls], few)
+        selects = [s for s in statements if 'FROM content' in s]
+        self.assertTrue(all('JOIN user' in s for s in selects if 'LIMIT' in s))
+        self.assertFalse(any('content.text' in s for s in selects
+            if 'LIMIT' in s))
+
+    def test_content_history(self):
+        """Test that every edit is kept as a revision, stored as deltas
+        between snapshots, and that each revision can be rebuilt."""
+        from app.revisions import benchmark
+        self.app.config['CONTENT_HISTORY_SNAPSHOT_INTERVAL'] = 3
+        headers = _admin_headers(self.client)
+        lines = ['Line %d\n' % i for i in range(20)]
+        content = self.client.post('/v1/content', headers=headers,
+                json={'title': 'Draft', 'text': ''.join(lines)}).get_json()
+        self.assertEqual(content['revision'], 1)
+        texts = [''.join(lines)]
+        for number in range(2, 8):
+            lines[number] = 'Edited in revision %d\n' % number
+            texts.append(''.join(lines))
+            response = self.client.put('/v1/content/%s' %
+                    content['public_id'], headers=headers,
+                    json={'title': 'Draft %d' % number, 'text': texts[-1]})
+            self.assertEqual(response.get_json()['revision'], number)
+        # An edit racing another one for the next revision is a conflict
+        content_id = Content.query.filter_by(
+                public_id=content['public_id']).first().id
+        db.session.execute(ContentRevision.__table__.insert().values(
+                content_id=content_id, revision=8, title='Other',
+                snapshot=True, data=''))
+        db.session.commit()
+        response = self.client.put('/v1/content/%s' % content['public_id'],
+                headers=headers, json={'title': 'Draft 8'})
+        self.assertEqual(response.status_code, 409)
+        response = self.client.put('/v1/content/%s' % content['public_id'],
+                headers=headers, json={'text': 5})
+        self.assertEqual(response.status_code, 400)
+        # Other integrity errors are the client's
+        response = self.client.put('/v1/content/%s' % content['public_id'],
+                headers=headers, json={'title': None})
+        self.assertEqual(response.status_code, 400)
+        ContentRevision.query.filter_by(content_id=content_id,
+                revision=8).delete()
+        db.session.commit()
+        # Changing neither the title nor the text isn't a new revision
+        self.client.put('/v1/content/%s' % content['public_id'],
+                headers=headers, json={'comments': False})
+
+        history = self.client.get(content['_links']['history']).get_json()
+        self.assertEqual(history['_meta']['total_items'], 7)
+        self.assertEqual([item['revision'] for item in history['items']],
+                [7, 6, 5, 4, 3, 2, 1])
+        self.assertNotIn('text', history['items'][0])
+        snapshots = [r.revision for r in ContentRevision.query
+                .filter_by(snapshot=True).order_by(ContentRevision.revision)]
+        self.assertEqual(snapshots, [1, 4, 7])
+        for number, text in enumerate(texts, 1):
+            revision = self.client.get('/v1/content/%s/history/%d' %
+                    (content['public_id'], number)).get_json()
+            self.assertEqual(revision['text'], text)
+            self.assertEqual(revision['title'],
+                    'Draft %d' % number if number > 1 else 'Draft')
+        response = self.client.get('/v1/content/%s/history/8' %
+                content['public_id'])
+        self.assertEqual(response.status_code, 404)
+
+        self.client.delete('/v1/content/%s' % content['public_id'],
+                headers=headers)
+        self.assertEqual(ContentRevision.query.count(), 0)
+
+        result = benchmark(lines=50, revisions=20, interval=5)
+        self.assertLess(result['stored_bytes'], result['full_bytes'] / 2)
+
+    def test_content_tags(self):
+        """Test tagging content, filtering by all or any of the tags, and
+        that the tag counts are kept up to date."""
+        headers = _admin_headers(self.client)
+        items = {}
+        for title, tags in [('Alpha', ['Python', 'flask']),
+                ('Bravo', ['python']), ('Charlie', ['flask', 'redis'])]:
+            response = self.client.post('/v1/content', headers=headers,
+                    json={'title': title, 'tags': tags})
+            self.assertEqual(response.status_code, 201)
+            items[title] = response.get_json()
+        self.assertEqual(items['Alpha']['tags'], ['flask', 'python'])
+
+        def titles(url):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            return [item['title'] for item in response.get_json()['items']]
+        self.assertEqual(titles('/v1/content?tags=python'), ['Alpha', 'Bravo'])
+        self.assertEqual(titles('/v1/content?tags=python,flask'), ['Alpha'])
+        self.assertEqual(titles('/v1/content?tags=python,flask&match=any'),
+                ['Alpha', 'Bravo', 'Charlie'])
+        self.assertEqual(titles('/v1/content?tags=python,nothing'), [])
+        self.assertEqual(titles('/v1/content?tags=redis,nothing&match=any'),
+                ['Charlie'])
+
+        def cloud():
+            return {tag['name']: tag['count'] for tag in
+                    self.client.get('/v1/tags').get_json()['items']}
+        self.assertEqual(cloud(), {'flask': 2, 'python': 2, 'redis': 1})
+        bravo = self.client.get('/v1/content/%s' %
+                items['Bravo']['public_id'])
+        self.client.put('/v1/content/%s' % items['Bravo']['public_id'],
+                headers=headers, json={'tags': ['redis']})
+        # Changing only the tags changes the ETag
+        response = self.client.get('/v1/content/%s' %
+                items['Bravo']['public_id'],
+                headers={'If-None-Match': bravo.headers['ETag']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['tags'], ['redis'])
+        self.client.delete('/v1/content/%s' % items['Charlie']['public_id'],
+                headers=headers)
+        self.assertEqual(cloud(), {'flask': 1, 'python': 1, 'redis': 1})
+        tags = self.client.get('/v1/tags?limit=1').get_json()['items']
+        self.assertEqual(len(tags), 1)
+        for limit in [0, -1]:
+            response = self.client.get('/v1/tags?limit=%d' % limit)
+            self.assertEqual(len(response.get_json()['items']), 1)
+        self.assertEqual(titles(tags[0]['_links']['content']), ['Alpha'])
+
+        response = self.client.post('/v1/content', headers=headers,
+                json={'title': 'Delta', 'tags': 'python'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/v1/content?tags=python&match=some')
+        self.assertEqual(response.status_code, 400)
+        query = Content.listing(tags=['python', 'flask'])[0]
+        plan = ' '.join(query_plan(query))
+        self.assertIn('COVERING INDEX ix_content_tags_tag_id_content_id', plan)
+
+    def test_content_text_compression(self):
+        """Test that large text is stored compressed and read back as is, and
+        that existing text can be repacked without changing its content."""
+        from app import db
+        from app.text_storage import benchmark
+        headers = _admin_headers(self.client)
+        texts = {'Short': 'Short text. ' * 10,
+                'Long': 'Repetitive text. ' * 200}
+        items = {title: self.client.post('/v1/content', headers=headers,
+            json={'title': title, 'text': text}).get_json()
+            for title, text in texts.items()}
+        table = Content.__table__
+
+        def stored(title):
+            return db.session.execute(db.select([
+                db.type_coerce(table.c.text, db.LargeBinary)])
+                .where(table.c.title == title)).scalar()
+        self.assertEqual(stored('Short'), b'\x00' + texts['Short'].encode())
+        self.assertEqual(stored('Long')[:1], b'\x01')
+        self.assertLess(len(stored('Long')), len(texts['Long']) / 10)
+        for title, item in items.items():
+            response = self.client.get('/v1/content/%s' % item['public_id'])
+            self.assertEqual(response.get_json()['text'], texts[title])
+        results = self.client.get('/v1/content/search?q=repetitive')
+        self.assertEqual(results.get_json()['items'][0]['title'], 'Long')
+
+        self.app.config['TEXT_COMPRESS_MIN_SIZE'] = 100
+        updated = Content.query.filter_by(title='Short').first().updated
+        self.assertEqual(Content.repack_text(batch_size=1), 2)
+        self.assertEqual(stored('Short')[:1], b'\x01')
+        db.session.expire_all()
+        short = Content.query.filter_by(title='Short').first()
+        self.assertEqual(short.text, texts['Short'])
+        self.assertEqual(short.updated, updated)
+        self.assertEqual(short.revision, 1)
+
+        result = benchmark(items=5, size=5000)
+        self.assertLess(result['compressed']['bytes'],
+                result['plain']['bytes'])
+
+    def test_content_text_ranges(self):
+        """Test the raw text body, fetching parts of it with Range requests,
+        resuming with If-Range, and conditional requests."""
+        headers = _admin_headers(self.client)
+        text = ''.join('Line %d of a long text, caf\u00e9.\n' % i
+                for i in range(500))
+        body = text.encode('utf-8')
+        content = self.client.post('/v1/content', headers=headers,
+                json={'title': 'Long', 'text': text}).get_json()
+        url = content['_links']['text']
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/plain')
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+        self.assertEqual(response.content_length, len(body))
+        self.assertEqual(response.get_data(), body)
+        etag, weak = response.get_etag()
+        self.assertFalse(weak)
+
+        # The first screenful, then the rest if the text hasn't changed
+        response = self.client.get(url, headers={'Range': 'bytes=0-99'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.get_data(), body[:100])
+        self.assertEqual(response.headers['Content-Range'],
+                'bytes 0-99/%d' % len(body))
+        self.assertEqual(response.content_length, 100)
+        response = self.client.get(url, headers={'Range': 'bytes=100-',
+            'If-Range': '"%s"' % etag})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.get_data(), body[100:])
+        response = self.client.get(url, headers={'Range': 'bytes=100-',
+            'If-Range': '"stale"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(), body)
+
+        response = self.client.get(url, headers={
+            'If-None-Match': '"%s"' % etag})
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(url, headers={
+            'Range': 'bytes=%d-' % (len(body) + 10)})
+        self.assertEqual(response.status_code, 416)
+        self.client.put('/v1/content/%s' % content['public_id'],
+                headers=headers, json={'text': 'Edited'})
+        response = self.client.get(url, headers={
+            'If-None-Match': '"%s"' % etag})
+        self.assertEqual(response.get_data(), b'Edited')
+        self.assertEqual(self.client.get('/v1/content/none/text').status_code,
+                404)
+
+
+if __name__ == '__main__':
+    unittest.main()
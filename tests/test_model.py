@@ -1,9 +1,14 @@
+import io
 import sys
+import threading
 import unittest
+from unittest import mock
 
 sys.path.append('../')
-from app import db                      # NOQA
-from app.models import User             # NOQA
+from app import db, password_hasher     # NOQA
+from app.hashing import PasswordHasherBusy  # NOQA
+from app.models import Content, User    # NOQA
+from app.user_import import read_rows, UserImport   # NOQA
 from tests.base import BaseTestCase     # NOQA
 
 
@@ -16,6 +21,58 @@ class UserModelCase(BaseTestCase):
         self.assertFalse(u.check_password('dog'))
         self.assertTrue(u.check_password('cat'))
 
+    def test_model_password_hashing_pool(self):
+        """Test hashing through the process pool, and that a full queue is
+        rejected instead of waiting."""
+        self.app.config['PASSWORD_HASH_WORKERS'] = 1
+        self.app.config['PASSWORD_HASH_QUEUE_DEPTH'] = 0
+        password_hasher.init_app(self.app)
+        try:
+            u = User(username='susan')
+            u.set_password('cat')
+            self.assertTrue(u.check_password('cat'))
+            self.assertEqual(password_hasher.stats()['completed'], 2)
+
+            password_hasher._slots.acquire()    # Occupy the only slot
+            self.assertRaises(PasswordHasherBusy, u.check_password, 'cat')
+            self.assertEqual(password_hasher.stats()['rejected'], 1)
+            password_hasher._slots.release()
+
+            # A timed out hash keeps its slot until the pool finishes it
+            password_hasher.timeout = 0
+            self.assertRaises(PasswordHasherBusy, u.check_password, 'cat')
+            self.assertEqual(password_hasher.stats()['timed_out'], 1)
+            password_hasher.timeout = 30
+            password_hasher._executor.shutdown(wait=True)
+            self.assertTrue(password_hasher._slots.acquire(blocking=False))
+            password_hasher._slots.release()
+        finally:
+            password_hasher.shutdown()
+
+    def test_model_password_rehash(self):
+        """Test that a hash made with an outdated profile is replaced in the
+        background after a successful login."""
+        u = User(username='susan', email='susan@example.com', public_id='1',
+                group='user')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        old_hash = u.password_hash
+
+        profiles = dict(self.app.config['PASSWORD_HASH_PROFILES'])
+        profiles['stronger'] = dict(profiles['testing'], rounds=2)
+        password_hasher.use_profile(profiles, 'stronger')
+        self.assertTrue(password_hasher.needs_update(old_hash))
+        self.assertTrue(u.check_password('cat'))
+        for thread in threading.enumerate():
+            if thread.name == 'password-rehash':
+                thread.join()
+
+        db.session.refresh(u)
+        self.assertNotEqual(u.password_hash, old_hash)
+        self.assertFalse(password_hasher.needs_update(u.password_hash))
+        self.assertTrue(u.check_password('cat'))
+
     def test_model_follow(self):
         """Test the user following mechanic."""
         u1 = User(username='josh', email='josh@example.com', public_id='1',
@@ -38,6 +95,15 @@ class UserModelCase(BaseTestCase):
         self.assertEqual(u1.followed.first().username, 'sara')
         self.assertEqual(u2.followers.count(), 1)
         self.assertEqual(u2.followers.first().username, 'josh')
+        self.assertEqual(u1.followed_count, 1)
+        self.assertEqual(u2.follower_count, 1)
+        self.assertEqual(u2.followed_count, 0)
+
+        # Following twice doesn't change the counters
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_count, 1)
+        self.assertEqual(u2.follower_count, 1)
 
         # Test the unfollow mechanic
         u1.unfollow(u2)
@@ -45,6 +111,133 @@ class UserModelCase(BaseTestCase):
         self.assertFalse(u1.is_following(u2))
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
+        self.assertEqual(u1.followed_count, 0)
+        self.assertEqual(u2.follower_count, 0)
+
+        # Repair counters that drifted from the followers table
+        u1.follow(u2)
+        db.session.execute(User.__table__.update().values(follower_count=7))
+        db.session.commit()
+        self.assertEqual(User.recount_follows(), 2)
+        db.session.commit()
+        self.assertEqual(u2.follower_count, 1)
+        self.assertEqual(u1.follower_count, 0)
+
+    def test_model_delete_followed_user(self):
+        """Test that deleting a user keeps the follow counters of the users
+        they followed, or were followed by, in line."""
+        users = {}
+        for name in ['amy', 'bob', 'cat']:
+            users[name] = User(username=name, email='%s@example.com' % name,
+                    public_id=name, group='user', password_hash='-')
+            db.session.add(users[name])
+        db.session.commit()
+        users['amy'].follow(users['cat'])
+        users['bob'].follow(users['cat'])
+        users['cat'].follow(users['amy'])
+        db.session.commit()
+        self.assertEqual(users['cat'].follower_count, 2)
+
+        db.session.delete(users['amy'])
+        db.session.commit()
+        cat = users['cat']
+        self.assertEqual((cat.follower_count, cat.followed_count), (1, 0))
+        self.assertEqual(cat.followers.count(), 1)
+        self.assertEqual(cat.followed.count(), 0)
+        self.assertEqual(User.recount_follows(), 2)
+        db.session.commit()
+        self.assertEqual((cat.follower_count, cat.followed_count), (1, 0))
+
+    def test_model_follow_many_race(self):
+        """Test that bulk follows only count the rows they wrote, when
+        another request followed some of the users since they were read."""
+        users = {}
+        for name in ['amy', 'bob', 'cat']:
+            users[name] = User(username=name, email='%s@example.com' % name,
+                    public_id=name, group='user', password_hash='-')
+            db.session.add(users[name])
+        db.session.commit()
+        amy, bob, cat = users['amy'], users['bob'], users['cat']
+        amy.follow(bob)
+        db.session.commit()
+
+        with mock.patch.object(User, '_followed_ids', return_value=set()):
+            self.assertEqual(amy.follow_many([bob, cat]), [cat])
+            db.session.commit()
+            self.assertEqual((amy.followed_count, bob.follower_count,
+                    cat.follower_count), (2, 1, 1))
+            with mock.patch.object(User, '_followed_ids',
+                    return_value={bob.id, cat.id}):
+                amy.unfollow(cat)
+                self.assertEqual(amy.unfollow_many([bob, cat]), [bob])
+            db.session.commit()
+        self.assertEqual((amy.followed_count, bob.follower_count,
+                cat.follower_count), (0, 0, 0))
+
+    def test_model_written_tables(self):
+        """Test that updates and statements run with session.execute mark
+        their tables as written, so their cached counts are dropped."""
+        amy = User(username='amy', email='amy@example.com', public_id='amy',
+                group='user', password_hash='-')
+        bob = User(username='bob', email='bob@example.com', public_id='bob',
+                group='user', password_hash='-')
+        db.session.add_all([amy, bob])
+        db.session.flush()
+        content = Content(title='Title', text='Text', user_id=amy.id,
+                public_id='c1')
+        db.session.add(content)
+        db.session.commit()
+
+        def written(write):
+            write()
+            db.session.flush()
+            tables = set(db.session.info.get('written_tables', ()))
+            db.session.commit()
+            self.assertNotIn('written_tables', db.session.info)
+            return tables
+
+        self.assertEqual(written(lambda: setattr(content, 'comments', False)),
+                {'content'})
+        self.assertEqual(written(lambda: amy.follow_many([bob])),
+                {'followers', 'user'})
+        self.assertEqual(written(lambda: content.set_tags(['jets'])),
+                {'content', 'content_tags', 'tag'})
+
+    def test_model_user_import(self):
+        """Test the bulk user import, including rows that are rejected."""
+        u = User(username='josh', email='josh@example.com', public_id='1',
+                group='user')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        ndjson = io.StringIO('\n'.join([
+            '{"username": "Sara", "email": "sara@example.com", '
+            '"name": "Sara", "password": "cat"}',
+            '{"username": "josh", "email": "josh2@example.com", '
+            '"name": "Josh", "password": "cat"}',
+            '{"username": "bob", "email": "bob@example.com", "name": "Bob"}',
+            'not json',
+            '{"username": "sara", "email": "sara2@example.com", '
+            '"name": "Sara", "password": "cat"}',
+            '{"username": "amy", "email": "amy@example.com", '
+            '"name": "Amy", "password": "dog"}',
+            '{"username": 7, "email": "tim@example.com", '
+            '"name": "Tim", "password": "cat"}',
+            '{"username": "%s", "email": "ann@example.com", '
+            '"name": "Ann", "password": "cat"}' % ('a' * 65),
+        ]))
+        result = UserImport(batch_size=2, workers=1).run(
+                read_rows(ndjson, 'ndjson'))
+        self.assertEqual(result.imported, 2)
+        self.assertEqual([number for number, _ in result.errors],
+                [2, 3, 4, 5, 7, 8])
+        self.assertEqual(result.errors[-2][1], 'username is not a string')
+        self.assertEqual(result.errors[-1][1],
+                'username is longer than 64 characters')
+        amy = User.query.filter_by(username='amy').first()
+        self.assertTrue(amy.check_password('dog'))
+        self.assertEqual(len(amy.public_id), 24)
+        self.assertEqual(User.query.filter_by(username='sara').count(), 1)
 
 
 if __name__ == '__main__':
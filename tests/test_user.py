@@ -1,7 +1,9 @@
 import base64
+import json
 #import pprint
 import sys
 import unittest
+from unittest import mock
 
 sys.path.append('../')
 from tests.base import BaseTestCase     # NOQA
@@ -48,6 +50,125 @@ class UserApiCase(BaseTestCase):
         #pprint.pprint(users_json)
         self.assertEqual(users_json['_meta']['page'], 1)
         self.assertEqual(users_json['_meta']['total_items'], 3)
+        self.assertEqual(users_json['_meta']['total_pages'], 1)
+
+        # Clients can opt out of counting
+        users = self.client.get('/v1/users?count=false&per_page=2',
+                headers={'Authorization': 'Bearer ' + user_token_json['token']})
+        users_json = users.get_json()
+        self.assertIsNone(users_json['_meta']['total_items'])
+        self.assertEqual(len(users_json['items']), 2)
+        self.assertIn('count=false', users_json['_links']['next'])
+
+        # Page sizes are kept between 1 and 100
+        for per_page, expected in [(0, 1), (-5, 1), (1000, 100)]:
+            users = self.client.get('/v1/users?per_page=%d' % per_page,
+                    headers={'Authorization': 'Bearer ' +
+                        user_token_json['token']})
+            self.assertEqual(users.status_code, 200)
+            self.assertEqual(users.get_json()['_meta']['per_page'], expected)
+
+        # The cached strategy falls back to an exact count without Redis
+        self.app.config['COLLECTION_COUNT'] = 'cached'
+        users = self.client.get('/v1/users',
+                headers={'Authorization': 'Bearer ' + user_token_json['token']})
+        self.assertEqual(users.get_json()['_meta']['total_items'], 3)
+
+    def test_create_user_unique_race(self):
+        """Test that a username or email taken after the check is reported
+        from the unique constraint that caught it."""
+        _register_user(self.client)
+        with mock.patch('app.api.v1.users._taken_error', return_value=None):
+            response = self.client.post('/v1/users', json={
+                'username': 'josh', 'email': 'other@joshschertz.com',
+                'name': 'Josh', 'password': 'secret'})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.get_json()['message'],
+                    'please use a different username')
+            response = self.client.post('/v1/users', json={
+                'username': 'other', 'email': 'josh@joshschertz.com',
+                'name': 'Josh', 'password': 'secret'})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.get_json()['message'],
+                    'please use a different email address')
+
+    def test_get_users_cursor_pagination(self):
+        """Test walking the user list forwards and backwards with keyset
+        pagination cursors."""
+        for name in ['josh', 'bob', 'sara']:
+            self.client.post('/v1/users', json={
+                'username': name, 'email': '%s@joshschertz.com' % name,
+                'name': name.title(), 'password': 'secret'})
+        user_token = self.client.post('/v1/tokens',
+                headers={'Authorization': 'Basic ' +
+                    base64.b64encode(('josh:secret')
+                        .encode('utf-8')).decode('utf-8')})
+        headers = {'Authorization': 'Bearer ' + user_token.get_json()['token']}
+
+        first = self.client.get('/v1/users?pagination=cursor&per_page=2',
+                headers=headers).get_json()
+        self.assertEqual([u['username'] for u in first['items']],
+                ['josh', 'bob'])
+        self.assertIsNone(first['_links']['prev'])
+        self.assertNotIn('total_items', first['_meta'])
+
+        second = self.client.get(first['_links']['next'] + '&total=true',
+                headers=headers).get_json()
+        self.assertEqual([u['username'] for u in second['items']], ['sara'])
+        self.assertIsNone(second['_links']['next'])
+        self.assertEqual(second['_meta']['total_items'], 3)
+
+        previous = self.client.get(second['_links']['prev'],
+                headers=headers).get_json()
+        self.assertEqual([u['username'] for u in previous['items']],
+                ['josh', 'bob'])
+
+        response = self.client.get('/v1/users?after=garbage', headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_users_sparse_fields(self):
+        """Test that ?fields= limits both the serialized fields and the
+        columns selected from the database."""
+        from sqlalchemy import event
+        from app import db
+        for name in ['josh', 'bob']:
+            self.client.post('/v1/users', json={
+                'username': name, 'email': '%s@joshschertz.com' % name,
+                'name': name.title(), 'password': 'secret'})
+        user_token = self.client.post('/v1/tokens',
+                headers={'Authorization': 'Basic ' +
+                    base64.b64encode(('josh:secret')
+                        .encode('utf-8')).decode('utf-8')})
+        headers = {'Authorization': 'Bearer ' + user_token.get_json()['token']}
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            users = self.client.get('/v1/users?fields=username,public_id',
+                    headers=headers).get_json()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        josh = users['items'][0]
+        self.assertEqual(josh, {'username': 'josh',
+            'public_id': josh['public_id']})
+        self.assertIn('fields=username', users['_links']['self'])
+        selects = [s for s in statements if 'FROM user' in s and
+                'LIMIT' in s and 'user.token =' not in s]
+        self.assertEqual(len(selects), 1)
+        self.assertNotIn('password_hash', selects[0])
+        self.assertNotIn('about_me', selects[0])
+
+        own = self.client.get('/v1/users/%s?fields=email,name' %
+                users['items'][0]['public_id'], headers=headers).get_json()
+        self.assertEqual(own, {'email': 'josh@joshschertz.com', 'name': 'Josh'})
+        cursor = self.client.get('/v1/users?fields=name&pagination=cursor',
+                headers=headers).get_json()
+        self.assertEqual(cursor['items'], [{'name': 'Josh'}, {'name': 'Bob'}])
+        response = self.client.get('/v1/users?fields=password_hash',
+                headers=headers)
+        self.assertEqual(response.status_code, 400)
 
     def test_get_own_user_profile(self):
         """Test process to retrieve a user's own profile. Requires creating a
@@ -197,6 +318,202 @@ class UserApiCase(BaseTestCase):
         user_following_json = user_following.get_json()
         self.assertEqual(len(user_following_json['items']), 0)
 
+    def test_bulk_follow(self):
+        """Test following and unfollowing a list of users at once"""
+        _register_user(self.client)
+        public_ids = [self.client.post('/v1/users', json={
+            'username': name, 'email': '%s@joshschertz.com' % name,
+            'name': name.title(), 'password': 'secret'}).get_json()['public_id']
+            for name in ['bob', 'sara']]
+        user_token = self.client.post('/v1/tokens',
+                headers={'Authorization': 'Basic ' +
+                    base64.b64encode(('josh:secret')
+                        .encode('utf-8')).decode('utf-8')})
+        headers = {'Authorization': 'Bearer ' + user_token.get_json()['token']}
+
+        self.client.post('/v1/users/%s/follow' % public_ids[0],
+                headers=headers)
+        response = self.client.post('/v1/users/follow', headers=headers,
+                json={'public_ids': public_ids + ['missing']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['followed'], [public_ids[1]])
+        self.assertEqual(response.get_json()['unknown'], ['missing'])
+        profile = self.client.get('/v1/users/%s' % public_ids[1],
+                headers=headers).get_json()
+        self.assertEqual(profile['follower_count'], 1)
+
+        response = self.client.post('/v1/users/unfollow', headers=headers,
+                json={'public_ids': public_ids})
+        self.assertEqual(sorted(response.get_json()['unfollowed']),
+                sorted(public_ids))
+        followed = self.client.get('/v1/users/%s/followed' %
+                user_token.get_json()['public_id'], headers=headers).get_json()
+        self.assertEqual(followed['_meta']['total_items'], 0)
+
+        for body in [{'public_ids': []}, {'public_ids': [['x']]},
+                {'public_ids': [{}]}, ['x']]:
+            response = self.client.post('/v1/users/follow', headers=headers,
+                    json=body)
+            self.assertEqual(response.status_code, 400)
+
+    def test_follow_graph_queries(self):
+        """Test the mutual follow, common follow, and batch is following
+        queries of the follower graph."""
+        _register_user(self.client)
+        public_ids = {}
+        for name in ['josh', 'bob', 'sara']:
+            if name != 'josh':
+                self.client.post('/v1/users', json={
+                    'username': name, 'email': '%s@joshschertz.com' % name,
+                    'name': name.title(), 'password': 'secret'})
+            token = self.client.post('/v1/tokens', headers={
+                'Authorization': 'Basic ' + base64.b64encode(
+                    ('%s:secret' % name).encode('utf-8')).decode('utf-8')})
+            public_ids[name] = (token.get_json()['public_id'],
+                    {'Authorization': 'Bearer ' + token.get_json()['token']})
+        josh, josh_headers = public_ids['josh']
+        bob, bob_headers = public_ids['bob']
+        sara, sara_headers = public_ids['sara']
+
+        # josh and bob follow each other, and both follow sara
+        self.client.post('/v1/users/follow', json={'public_ids': [bob, sara]},
+                headers=josh_headers)
+        self.client.post('/v1/users/follow', json={'public_ids': [josh, sara]},
+                headers=bob_headers)
+
+        mutuals = self.client.get('/v1/users/%s/mutuals' % josh,
+                headers=josh_headers).get_json()
+        self.assertEqual([u['username'] for u in mutuals['items']], ['bob'])
+        # Page sizes below one are raised to one
+        mutuals = self.client.get('/v1/users/%s/mutuals?per_page=0' % josh,
+                headers=josh_headers).get_json()
+        self.assertEqual(mutuals['_meta']['per_page'], 1)
+        self.assertEqual(mutuals['_meta']['total_pages'], 1)
+
+        common = self.client.get('/v1/users/common?public_ids=%s,%s' %
+                (josh, bob), headers=josh_headers).get_json()
+        self.assertEqual([u['username'] for u in common['items']], ['sara'])
+
+        # sara's followers that sara follows: nobody yet
+        known = self.client.get('/v1/users/%s/known_followers' % sara,
+                headers=sara_headers).get_json()
+        self.assertEqual(known['_meta']['total_items'], 0)
+        known = self.client.get('/v1/users/%s/known_followers' % sara,
+                headers=josh_headers).get_json()
+        self.assertEqual([u['username'] for u in known['items']], ['bob'])
+
+        self.client.delete('/v1/users/%s/follow' % sara, headers=josh_headers)
+        following = self.client.get('/v1/users/%s/following?public_ids=%s,%s'
+                % (josh, bob, sara), headers=josh_headers).get_json()
+        self.assertEqual(following, {bob: True, sara: False})
+
+    def test_own_profile_etag_after_follow(self):
+        """Test that the user's own profile isn't served from the columns in
+        the token cache once another user follows them."""
+        tokens = {}
+        for name in ['alice', 'bob']:
+            self.client.post('/v1/users', json={
+                'username': name, 'email': '%s@joshschertz.com' % name,
+                'name': name.title(), 'password': 'secret'})
+            tokens[name] = self.client.post('/v1/tokens',
+                    headers={'Authorization': 'Basic ' +
+                        base64.b64encode(('%s:secret' % name)
+                            .encode('utf-8')).decode('utf-8')}).get_json()
+        alice = {'Authorization': 'Bearer ' + tokens['alice']['token']}
+        bob = {'Authorization': 'Bearer ' + tokens['bob']['token']}
+        url = '/v1/users/%s' % tokens['alice']['public_id']
+        profile = self.client.get(url, headers=alice)
+        self.assertEqual(profile.get_json()['follower_count'], 0)
+
+        self.client.post('%s/follow' % url, headers=bob)
+        profile = self.client.get(url, headers={
+            'If-None-Match': profile.headers['ETag'], **alice})
+        self.assertEqual(profile.status_code, 200)
+        self.assertEqual(profile.get_json()['follower_count'], 1)
+
+    def test_export_users(self):
+        """Test that only admins can stream the users and follows."""
+        for name in ['josh', 'bob']:
+            self.client.post('/v1/users', json={
+                'username': name, 'email': '%s@joshschertz.com' % name,
+                'name': name.title(), 'password': 'secret'})
+        tokens = {}
+        for name in ['josh', 'bob']:
+            tokens[name] = self.client.post('/v1/tokens',
+                    headers={'Authorization': 'Basic ' +
+                        base64.b64encode(('%s:secret' % name)
+                            .encode('utf-8')).decode('utf-8')}).get_json()
+        admin = {'Authorization': 'Bearer ' + tokens['josh']['token']}
+        user = {'Authorization': 'Bearer ' + tokens['bob']['token']}
+        self.client.post('/v1/users/%s/follow' % tokens['josh']['public_id'],
+                headers=user)
+
+        response = self.client.get('/v1/users/export', headers=user)
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get('/v1/users/export', headers=admin)
+        rows = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEqual([row['username'] for row in rows], ['josh', 'bob'])
+        self.assertNotIn('password_hash', rows[0])
+        self.assertEqual(rows[0]['follower_count'], 1)
+        response = self.client.get('/v1/followers/export', headers=admin)
+        self.assertEqual([json.loads(line) for line in
+            response.data.splitlines()],
+            [{'follower_id': rows[1]['id'], 'followed_id': rows[0]['id']}])
+
+    def test_notifications(self):
+        """Test polling the notifications added since a time, and that adding
+        a notification again replaces it."""
+        from sqlalchemy import event
+        from app import db
+        from app.models import Notification, User
+        _register_user(self.client)
+        user_token = self.client.post('/v1/tokens',
+                headers={'Authorization': 'Basic ' +
+                    base64.b64encode(('josh:secret')
+                        .encode('utf-8')).decode('utf-8')})
+        headers = {'Authorization': 'Bearer ' + user_token.get_json()['token']}
+        response = self.client.get('/v1/notifications')
+        self.assertEqual(response.status_code, 401)
+        feed = self.client.get('/v1/notifications', headers=headers).get_json()
+        self.assertEqual(feed['items'], [])
+
+        user = User.query.filter_by(username='josh').first()
+        user.add_notification('unread_count', {'count': 1})
+        user.add_notification('task_progress', {'progress': 50})
+        db.session.commit()
+        feed = self.client.get(feed['_links']['next'], headers=headers) \
+                .get_json()
+        self.assertEqual([(n['name'], n['data']) for n in feed['items']],
+                [('unread_count', {'count': 1}),
+                    ('task_progress', {'progress': 50})])
+        public_id = feed['items'][0]['public_id']
+
+        # Only the replaced notification is new, in a single statement
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            notification = user.add_notification('unread_count',
+                    {'count': 2})
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        db.session.commit()
+        # The upsert, then the select of the notification it returns
+        self.assertEqual(len(statements), 2)
+        self.assertTrue(statements[0].startswith('INSERT'))
+        self.assertEqual(notification.public_id, public_id)
+        self.assertEqual(notification.get_data(), {'count': 2})
+        feed = self.client.get(feed['_links']['next'], headers=headers) \
+                .get_json()
+        self.assertEqual([(n['public_id'], n['data']) for n in feed['items']],
+                [(public_id, {'count': 2})])
+        self.assertEqual(Notification.query.count(), 2)
+        feed = self.client.get(feed['_links']['next'], headers=headers) \
+                .get_json()
+        self.assertEqual(feed['items'], [])
+
 
 if __name__ == '__main__':
     unittest.main()